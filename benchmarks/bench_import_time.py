@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+#
+# Startup cost of the Python plugins' hook paths, measured with
+# python -X importtime.
+#
+# Each scenario runs a plugin script in a fresh interpreter with a hook
+# input on stdin that makes it exit before any network call, the way most
+# hook invocations do. The import time of the plugin's own imports, the
+# slowest modules and the process wall time are printed, so imports that
+# creep into the hook path show up.
+#
+# Usage: python benchmarks/bench_import_time.py [--runs N] [--top N]
+#
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+PLUGINS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "plugins")
+
+# Nothing listens on this port; the scenarios exit before contacting Stash
+SERVER_CONNECTION = {"Scheme": "http", "Host": "127.0.0.1", "Port": 9}
+
+SCENARIOS = [
+    (
+        "whisparrUpdate: hook without scene id",
+        os.path.join(PLUGINS_DIR, "whisparrUpdate", "whisparrUpdate.py"),
+        {"server_connection": SERVER_CONNECTION, "args": {"hookContext": {"type": "Scene.Update.Post"}}},
+    ),
+    (
+        "setStashboxFavorites: unhandled hook",
+        os.path.join(PLUGINS_DIR, "setStashboxFavorites", "setStashboxFavorites.py"),
+        {"server_connection": SERVER_CONNECTION, "args": {"hookContext": {"type": "Tag.Update.Post", "id": "1"}}},
+    ),
+]
+
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def run(script, stdin):
+    """Run a plugin once; returns (wall seconds, [(module, self us, cumulative us, depth)])."""
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", script],
+        input=json.dumps(stdin), capture_output=True, text=True, cwd=os.path.dirname(script),
+    )
+    wall = time.perf_counter() - start
+    modules = []
+    for line in proc.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules.append((name, int(self_us), int(cumulative_us), len(indent) // 2))
+    if proc.returncode:
+        errors = [line for line in proc.stderr.splitlines() if not line.startswith("import time:")]
+        raise RuntimeError(f"{script} exited with {proc.returncode}: {errors[-1] if errors else ''}")
+    return wall, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure plugin hook startup import time")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=8)
+    args = parser.parse_args()
+
+    # Import time of an empty interpreter, subtracted to get the plugin's own share
+    _, baseline = run(os.devnull, {})
+    baseline_us = sum(cumulative for _, _, cumulative, depth in baseline if depth == 0)
+
+    for label, script, stdin in SCENARIOS:
+        walls = []
+        totals = []
+        slowest = {}
+        for _ in range(args.runs):
+            wall, modules = run(script, stdin)
+            walls.append(wall)
+            totals.append(sum(cumulative for _, _, cumulative, depth in modules if depth == 0) - baseline_us)
+            for name, self_us, _, _ in modules:
+                slowest.setdefault(name, []).append(self_us)
+
+        print(f"{label}")
+        print(f"  wall time      {statistics.median(walls) * 1000:8.1f} ms (median of {args.runs})")
+        print(f"  plugin imports {statistics.median(totals) / 1000:8.1f} ms over interpreter startup")
+        print(f"  modules        {len(slowest):8d}")
+        top = sorted(slowest.items(), key=lambda item: statistics.median(item[1]), reverse=True)[:args.top]
+        for name, times in top:
+            print(f"    {statistics.median(times) / 1000:6.2f} ms  {name}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
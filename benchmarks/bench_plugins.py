@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+#
+# End-to-end benchmark of the Python plugins against local stub servers
+# (stub_servers.py) standing in for Stash, stash-box and Whisparr, so sync
+# changes can be measured without a real Stash library or network.
+#
+# Usage: python benchmarks/bench_plugins.py [--sizes 1000,10000,100000]
+#            [--latency-ms MS] [--stash-latency-ms MS] [--error-rate R]
+#            [--concurrency N] [--batch-size N] [--hooks N] [--scenes N]
+#
+# For every library size the plugin directories are copied to a temporary
+# directory (so their state files start empty) and these scenarios run, each
+# in its own process:
+#   performers full         favorite_performers_sync task, full reconcile
+#   performers incremental  the same task after 1% of the local favorites
+#                           changed (uses the snapshot of the full run)
+#   studios full / incremental  the same for favorite_studios_sync
+#   performer hooks         --hooks updated performers synced one at a time
+#                           with set_stashbox_favorites_by_id, as a drainer
+#                           does for updates that arrive seconds apart
+#   studio hooks            the same for studios
+#   whisparr hooks          whisparrUpdate.py run once per updated scene
+#                           (--scenes scenes, each added to Whisparr)
+# Each scenario reports its wall time, the requests the stubs answered per
+# service (and how many of them were injected 502s) and the peak RSS of the
+# plugin process.
+#
+# --latency-ms delays every stash-box and Whisparr answer, --stash-latency-ms
+# every Stash answer. --error-rate fails that share of stash-box and
+# Whisparr requests with 502, exercising the retry paths (retries back off
+# for seconds, so keep it small). The Whisparr bulk push task is not run: it
+# talks to Stash through stashapi.
+#
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from stub_servers import Library, StashBoxStub, StashStub, WhisparrStub  # noqa: E402
+
+PLUGINS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "plugins")
+
+# Files the plugins keep between runs; not copied, so every size starts clean
+STATE_FILES = ("__pycache__", "*.json", "*.jsonl", "*.tmp", "*.lock", "*.draining", "*.prof", "memory-*.txt", "retry_queue.txt")
+
+# Runs a plugin script and, when it exits, writes its peak RSS (KB) to the
+# file named in BENCH_PEAK_FILE. The rusage of a child is no use here: Linux
+# carries the benchmark's own peak over into the processes it starts.
+PEAK_WRAPPER = """
+import atexit, os, runpy, sys
+
+def write_peak():
+    peak = 0
+    try:
+        with open("/proc/self/status") as f:
+            peak = next(int(line.split()[1]) for line in f if line.startswith("VmHWM:"))
+    except (OSError, StopIteration):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with open(os.environ["BENCH_PEAK_FILE"], "w") as f:
+        f.write(str(peak))
+
+atexit.register(write_peak)
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+# Runs set_stashbox_favorites_by_id once per id; run_plugin starts it in the
+# plugin directory, which python -c puts on sys.path
+HOOK_DRIVER = """
+import json, sys
+import favorite_performers_sync as sync, log
+args = json.loads(sys.stdin.read())
+log.set_level(args["log_level"])
+for entity_id in args["ids"]:
+    sync.set_stashbox_favorites_by_id(args["server_connection"], args["entity_type"], args["endpoint"], "benchmark",
+                                      [entity_id], args["concurrency"], args["batch_size"])
+"""
+
+
+def run_plugin(cwd, argv, stdin):
+    """Run a plugin process to completion.
+
+    Args:
+        cwd: Plugin directory to run in
+        argv: Script path and arguments
+        stdin: JSON input of the plugin
+
+    Returns:
+        Tuple of (exit status, peak RSS in MB, stderr tail)
+    """
+    with tempfile.TemporaryFile() as stderr, tempfile.NamedTemporaryFile("r") as peak:
+        proc = subprocess.run(
+            [sys.executable, "-c", PEAK_WRAPPER] + argv, cwd=cwd, input=json.dumps(stdin).encode("utf-8"),
+            stdout=subprocess.DEVNULL, stderr=stderr, env=dict(os.environ, BENCH_PEAK_FILE=peak.name),
+        )
+        stderr.seek(0)
+        tail = stderr.read().decode("utf-8", "replace").splitlines()[-5:]
+        rss = int(peak.read() or 0) / 1024
+    return proc.returncode, rss, tail
+
+
+def run_scenario(name, stubs, runs):
+    """Run plugin processes one after another and print one result row.
+
+    Args:
+        name: Scenario name
+        stubs: Dict of {service: stub server}
+        runs: List of (cwd, argv, stdin) of the processes to run
+    """
+    for stub in stubs.values():
+        stub.reset_counts()
+    peak = 0.0
+    failed = []
+    start = time.perf_counter()
+    for cwd, argv, stdin in runs:
+        code, rss, tail = run_plugin(cwd, argv, stdin)
+        peak = max(peak, rss)
+        if code:
+            failed.append((code, tail))
+    seconds = time.perf_counter() - start
+    requests = []
+    for service, stub in stubs.items():
+        counts = stub.reset_counts()
+        total = sum(counts.values())
+        if total:
+            errors = counts.get("502", 0)
+            requests.append(f"{service} {total}" + (f" ({errors} 502)" if errors else ""))
+    print(f"  {name:<24} {seconds:>8.2f}s {peak:>8.1f} MB  {', '.join(requests) or 'no requests'}")
+    for code, tail in failed:
+        print(f"    exited with {code}:")
+        for line in tail:
+            print(f"      {line}")
+
+
+def bench_size(size, args, workdir):
+    print(f"{size} performers, {size} studios, {size} scenes")
+    plugins = os.path.join(workdir, str(size))
+    shutil.copytree(PLUGINS_DIR, plugins, ignore=shutil.ignore_patterns(*STATE_FILES))
+    favorites_dir = os.path.join(plugins, "setStashboxFavorites")
+    whisparr_dir = os.path.join(plugins, "whisparrUpdate")
+    config_file = os.path.join(workdir, f"config-{size}.yml")
+    with open(config_file, "w", encoding="utf-8") as f:
+        f.write("# stub Stash configuration\n")
+    hook_driver = os.path.join(workdir, "hook_driver.py")
+    with open(hook_driver, "w", encoding="utf-8") as f:
+        f.write(HOOK_DRIVER)
+
+    latency = args.latency_ms / 1000
+    stashbox = StashBoxStub(None, latency=latency, error_rate=args.error_rate)
+    whisparr = WhisparrStub(size, latency=latency, error_rate=args.error_rate)
+    library = Library(size, stashbox.url + "/graphql")
+    stashbox.library = library
+    stash = StashStub(library, config_file, {
+        "setStashboxFavorites": {"concurrency": args.concurrency, "batchSize": args.batch_size, "tagErrors": True, "tagName": "Invalid stash_id"},
+        "whisparrUpdate": {"WHISPARR_URL": whisparr.url, "WHISPARR_API_KEY": "benchmark", "MONITORED": True},
+    }, log_level=args.log_level, latency=args.stash_latency_ms / 1000)
+    stubs = {"stash": stash, "stash-box": stashbox, "whisparr": whisparr}
+    server_connection = {"Scheme": "http", "Host": "127.0.0.1", "Port": stash.server.server_port}
+    endpoint = library.stashbox_url
+    try:
+        for entity_type, task in (("performers", "favorite_performers_sync"), ("studios", "favorite_studios_sync")):
+            argv = ["setStashboxFavorites.py"]
+            task_args = {"name": task, "endpoint": endpoint, "api_key": "benchmark"}
+            run_scenario(f"{entity_type} full", stubs, [
+                (favorites_dir, argv, {"server_connection": server_connection, "args": dict(task_args, full_reconcile=True)}),
+            ])
+            library.touch(entity_type, 0.01)
+            run_scenario(f"{entity_type} incremental", stubs, [
+                (favorites_dir, argv, {"server_connection": server_connection, "args": task_args}),
+            ])
+
+        for entity_type in ("performers", "studios"):
+            ids = library.touch(entity_type, args.hooks / size)[:args.hooks]
+            run_scenario(f"{entity_type[:-1]} hooks", stubs, [
+                (favorites_dir, [hook_driver], {
+                    "server_connection": server_connection, "entity_type": entity_type, "endpoint": endpoint,
+                    "ids": ids, "concurrency": args.concurrency, "batch_size": args.batch_size,
+                    "log_level": args.log_level,
+                }),
+            ])
+
+        # Scenes with a StashDB id, spread over the library
+        scene_ids = [scene["id"] for scene in library.scenes if scene["stash_ids"]]
+        scene_ids = scene_ids[::max(1, len(scene_ids) // args.scenes)][:args.scenes]
+        run_scenario("whisparr hooks", stubs, [
+            (whisparr_dir, ["whisparrUpdate.py"], {
+                "server_connection": server_connection,
+                "args": {"hookContext": {"type": "Scene.Update.Post", "id": scene_id, "inputFields": ["stash_ids"]}},
+            }) for scene_id in scene_ids
+        ])
+    finally:
+        for stub in stubs.values():
+            stub.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma-separated library sizes")
+    parser.add_argument("--latency-ms", type=float, default=20, help="delay of every stash-box and Whisparr answer")
+    parser.add_argument("--stash-latency-ms", type=float, default=1, help="delay of every Stash answer")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of stash-box and Whisparr requests failed with 502")
+    parser.add_argument("--concurrency", type=int, default=4, help="plugin concurrency setting")
+    parser.add_argument("--batch-size", type=int, default=25, help="plugin batch size setting")
+    parser.add_argument("--hooks", type=int, default=20, help="performer and studio updates per hook scenario")
+    parser.add_argument("--scenes", type=int, default=20, help="scene updates in the Whisparr hook scenario")
+    parser.add_argument("--log-level", default="Info", help="Stash log level reported to the plugins")
+    args = parser.parse_args()
+
+    print(f"stash-box/Whisparr latency {args.latency_ms:g} ms, Stash latency {args.stash_latency_ms:g} ms, "
+          f"error rate {args.error_rate:g}, concurrency {args.concurrency}, batch size {args.batch_size}")
+    print(f"  {'scenario':<24} {'wall':>9} {'peak RSS':>11}  requests")
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in (int(s) for s in args.sizes.split(",")):
+            bench_size(size, args, workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+#
+# Peak memory of decoding one large findPerformers page: the whole response
+# at once (json.loads(response.read())) versus the streaming decoder that
+# favorite_performers_sync uses for its paged list queries.
+#
+# The stub server and each decoding mode run in their own process so peak
+# RSS is measured per mode. Rows are only counted, not kept, so the figures
+# show decoding overhead alone.
+#
+# Usage: python benchmarks/bench_stream_memory.py [--rows 100000 ...]
+#
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "plugins", "setStashboxFavorites")
+sys.path.insert(0, PLUGIN_DIR)
+import graphql_stream  # noqa: E402
+import http_transport  # noqa: E402
+
+ENDPOINT = "https://stashdb.org/graphql"
+
+
+def build_response(rows):
+    performers = [{
+        "id": str(n),
+        "name": f"Performer {n}",
+        "tags": [{"id": str(n % 50)}],
+        "stash_ids": [{"endpoint": ENDPOINT, "stash_id": f"{n:08x}-0000-4000-8000-000000000000"}],
+    } for n in range(rows)]
+    return json.dumps({"data": {"findPerformers": {"count": rows, "performers": performers}}}).encode("utf-8")
+
+
+def serve(rows):
+    body = build_response(rows)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    print(server.server_address[1], len(body), flush=True)
+    server.serve_forever()
+
+
+def client(mode, url):
+    req = urllib.request.Request(url, data=b'{"query": "query FindFavoritePerformers { }"}',
+                                 headers={"Content-Type": "application/json"}, method="POST")
+    tracemalloc.start()
+    start = time.perf_counter()
+    rows = 0
+    matched = 0
+    if mode == "buffered":
+        with http_transport.urlopen(req) as response:
+            data = json.loads(response.read().decode("utf-8"))
+        for performer in data["data"]["findPerformers"]["performers"]:
+            rows += 1
+            matched += sum(1 for sid in performer["stash_ids"] if sid["endpoint"] == ENDPOINT)
+        del data
+    else:
+        with http_transport.urlopen(req, stream=True) as response:
+            for performer in graphql_stream.StreamedList(response, "performers"):
+                rows += 1
+                matched += sum(1 for sid in performer["stash_ids"] if sid["endpoint"] == ENDPOINT)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    print(json.dumps({
+        "rows": rows,
+        "matched": matched,
+        "seconds": elapsed,
+        "peak_traced": peak,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare buffered and streaming decoding memory")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--client", choices=["buffered", "streaming"], help=argparse.SUPPRESS)
+    parser.add_argument("--url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve is not None:
+        serve(args.serve)
+        return
+    if args.client:
+        client(args.client, args.url)
+        return
+
+    print(f"{'rows':>8} {'body MB':>8} {'mode':>10} {'peak traced MB':>15} {'max RSS MB':>11} {'seconds':>8}")
+    for rows in args.rows:
+        server = subprocess.Popen([sys.executable, __file__, "--serve", str(rows)], stdout=subprocess.PIPE, text=True)
+        try:
+            port, size = server.stdout.readline().split()
+            url = f"http://127.0.0.1:{port}/graphql"
+            for mode in ("buffered", "streaming"):
+                out = subprocess.run([sys.executable, __file__, "--client", mode, "--url", url],
+                                     check=True, capture_output=True, text=True).stdout
+                result = json.loads(out)
+                print(f"{rows:>8} {int(size) / 2**20:>8.1f} {mode:>10} {result['peak_traced'] / 2**20:>15.1f} "
+                      f"{result['max_rss_kb'] / 1024:>11.1f} {result['seconds']:>8.2f}")
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+#
+# Requests per second through urllib.request.urlopen (a new connection per
+# call) versus the pooled keep-alive transport, against a local stub
+# GraphQL server.
+#
+# Usage: python benchmarks/bench_transport.py [--requests N] [--threads N] [--tls]
+#
+# --tls serves https with a throwaway self-signed certificate (needs the
+# openssl command), which is where reusing connections matters most.
+#
+
+import argparse
+import json
+import os
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "plugins", "setStashboxFavorites"))
+import http_transport  # noqa: E402
+
+RESPONSE = json.dumps({"data": {"favoritePerformer": True}}).encode("utf-8")
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Go servers (Stash, stash-box) set TCP_NODELAY; without it small
+    # keep-alive responses stall on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(RESPONSE)))
+        self.end_headers()
+        self.wfile.write(RESPONSE)
+
+
+def make_request(url):
+    body = json.dumps({
+        "query": "mutation FavoritePerformer($id: ID!, $favorite: Boolean!) { favoritePerformer(id: $id, favorite: $favorite) }",
+        "variables": {"id": "00000000-0000-0000-0000-000000000000", "favorite": True}
+    }).encode("utf-8")
+    return urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"}, method="POST")
+
+
+def make_tls_context(server):
+    """Wrap the server socket with a self-signed certificate; return a client context."""
+    with tempfile.TemporaryDirectory() as tmp:
+        cert = os.path.join(tmp, "cert.pem")
+        key = os.path.join(tmp, "key.pem")
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+             "-subj", "/CN=127.0.0.1", "-keyout", key, "-out", cert],
+            check=True, capture_output=True,
+        )
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(cert, key)
+    server.socket = server_context.wrap_socket(server.socket, server_side=True)
+
+    client_context = ssl.create_default_context()
+    client_context.check_hostname = False
+    client_context.verify_mode = ssl.CERT_NONE
+    return client_context
+
+
+def run(opener, url, requests, threads, context=None):
+    def one(_):
+        with opener(make_request(url), timeout=30, context=context) as response:
+            response.read()
+
+    start = time.perf_counter()
+    if threads == 1:
+        for n in range(requests):
+            one(n)
+    else:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(one, range(requests)))
+    return requests / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare urllib and pooled transport throughput")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--tls", action="store_true", help="serve https with a self-signed certificate")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    context = make_tls_context(server) if args.tls else None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    scheme = "https" if args.tls else "http"
+    url = f"{scheme}://127.0.0.1:{server.server_address[1]}/graphql"
+
+    # Warm up both paths
+    run(urllib.request.urlopen, url, 50, 1, context)
+    run(http_transport.urlopen, url, 50, 1, context)
+
+    before = run(urllib.request.urlopen, url, args.requests, args.threads, context)
+    after = run(http_transport.urlopen, url, args.requests, args.threads, context)
+
+    print(f"{args.requests} {scheme} requests, {args.threads} thread(s)")
+    print(f"urllib.request.urlopen   {before:8.0f} req/s")
+    print(f"http_transport.urlopen   {after:8.0f} req/s  ({after / before:.1f}x)")
+
+    http_transport.close_all()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
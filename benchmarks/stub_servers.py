@@ -0,0 +1,393 @@
+#
+# Local stand-ins for the services the Python plugins talk to: the Stash
+# GraphQL API, a stash-box GraphQL API and the Whisparr v3 REST API.
+#
+# Each stub serves a synthetic library held in memory, answers only the
+# operations the plugins send, and runs in a background thread of the
+# calling process. Every stub counts the requests it answered per operation,
+# can add a fixed latency to each answer and can fail a share of requests
+# with 502 (stash-box, Whisparr) to exercise the retry paths.
+#
+# Used by bench_plugins.py; see there for usage.
+#
+
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+OPERATION_NAME = re.compile(r"^\s*(?:query|mutation)\s+(\w+)")
+STASHBOX_ALIAS = re.compile(r"(f\d+): (\w+)\(id: \$(id\d+)(?:, favorite: (true|false))?\)")
+STASH_ALIAS = re.compile(r"(e\d+): (\w+)\(id: \$(id\d+)\)")
+
+
+def stash_id(kind, n):
+    """Deterministic UUID-shaped stash-box id of the n-th performer ("p") or studio ("s")."""
+    return f"{n:08x}-0000-4000-8{'0' if kind == 'p' else '1'}00-000000000000"
+
+
+class Library:
+    """Synthetic performers, studios and scenes shared by the stubs.
+
+    Every third performer and studio is a local favorite. Every fifth is a
+    favorite on stash-box, so a first sync has favorites to add and to
+    remove, and every 500th stash-box favorite is listed twice (a duplicate
+    to fix). One in 1000 stash_ids is unknown to stash-box, so a full sync
+    has rejected favorites to tag. Every fourth scene has no stash_id.
+    """
+
+    def __init__(self, size, stashbox_url):
+        self.size = size
+        self.stashbox_url = stashbox_url
+        # Well before any sync, so incremental syncs only see touched entities
+        created = (datetime.now().astimezone() - timedelta(days=1)).isoformat(timespec="seconds")
+        self.entities = {}
+        self.stashbox_favorites = {}
+        self.stashbox_duplicates = {}
+        for kind, entity_type in (("p", "performers"), ("s", "studios")):
+            self.entities[entity_type] = [{
+                "id": str(n),
+                "name": f"{entity_type[:-1].capitalize()} {n}",
+                "favorite": n % 3 == 0,
+                "updated_at": created,
+                "tags": [{"id": str(n % 50)}],
+                "stash_ids": [{"endpoint": stashbox_url, "stash_id": stash_id(kind, n)}],
+            } for n in range(size)]
+            self.stashbox_favorites[entity_type] = {stash_id(kind, n) for n in range(size) if n % 5 == 0}
+            self.stashbox_duplicates[entity_type] = {stash_id(kind, n) for n in range(0, size, 2500)}
+        self.scenes = [{
+            "id": str(n),
+            "title": f"Scene {n}",
+            "stash_ids": [{"endpoint": "https://stashdb.org/graphql", "stash_id": f"scene-{n:08x}"}] if n % 4 else [],
+        } for n in range(size)]
+        self.lock = threading.Lock()
+
+    def touch(self, entity_type, share):
+        """Flip the local favorite of a share of entities and mark them updated now.
+
+        Returns:
+            Local ids of the changed entities
+        """
+        updated = datetime.now().astimezone().isoformat(timespec="seconds")
+        changed = []
+        for entity in self.entities[entity_type][::max(1, int(1 / share))]:
+            entity["favorite"] = not entity["favorite"]
+            entity["updated_at"] = updated
+            changed.append(entity["id"])
+        return changed
+
+
+def unknown_to_stashbox(sid):
+    """Whether stash-box rejects a stash_id (one local favorite in 1000)."""
+    return int(sid[:8], 16) % 1000 == 3
+
+
+def page(items, find_filter):
+    find_filter = find_filter or {}
+    per_page = find_filter.get("per_page", 25)
+    if per_page == -1:
+        return items
+    start = (find_filter.get("page", 1) - 1) * per_page
+    return items[start:start + per_page]
+
+
+class StubServer:
+    """A stub HTTP service on an ephemeral localhost port.
+
+    Args:
+        latency: Seconds to wait before answering each request
+        error_rate: Share of requests answered with 502 instead
+        seed: Seed of the error injection, so runs are repeatable
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.counts = {}
+        self.count_lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Go and .NET servers set TCP_NODELAY; without it small
+            # keep-alive responses stall on delayed ACKs
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                stub.handle(self, "GET", None)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                stub.handle(self, "POST", json.loads(body or b"{}"))
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_counts(self):
+        with self.count_lock:
+            counts, self.counts = self.counts, {}
+        return counts
+
+    def count(self, operation):
+        with self.count_lock:
+            self.counts[operation] = self.counts.get(operation, 0) + 1
+
+    def fails(self):
+        if not self.error_rate:
+            return False
+        with self.count_lock:
+            return self.random.random() < self.error_rate
+
+    def handle(self, handler, method, body):
+        if self.latency:
+            time.sleep(self.latency)
+        parts = urllib.parse.urlsplit(handler.path)
+        if self.fails():
+            self.count("502")
+            return self.reply(handler, 502, {"message": "injected failure"})
+        try:
+            operation, status, result = self.answer(method, parts, body)
+        except Exception as e:
+            operation, status, result = "invalid", 400, {"errors": [{"message": str(e)}]}
+        self.count(operation)
+        self.reply(handler, status, result)
+
+    def reply(self, handler, status, result):
+        out = json.dumps(result).encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(out)))
+        handler.end_headers()
+        handler.wfile.write(out)
+
+    def answer(self, method, parts, body):
+        """Return (operation name, HTTP status, JSON response)."""
+        raise NotImplementedError
+
+
+class GraphQLStub(StubServer):
+    """Dispatches GraphQL requests to op_<OperationName> methods."""
+
+    def answer(self, method, parts, body):
+        query = body.get("query", "")
+        match = OPERATION_NAME.match(query)
+        operation = match.group(1) if match else "anonymous"
+        if operation.startswith("Batch"):
+            handler = self.batch
+        else:
+            handler = getattr(self, f"op_{operation}", None)
+        if handler is None:
+            return operation, 200, {"data": None, "errors": [{"message": f"unknown operation {operation}"}]}
+        data, errors = handler(query, body.get("variables") or {})
+        result = {"data": data}
+        if errors:
+            result["errors"] = errors
+        return operation, 200, result
+
+    def batch(self, query, variables):
+        raise NotImplementedError
+
+
+class StashStub(GraphQLStub):
+    """Stash GraphQL API serving a Library and the plugins' configuration."""
+
+    def __init__(self, library, config_file, plugin_settings, log_level="Info", **kwargs):
+        self.library = library
+        self.config_file = config_file
+        self.plugin_settings = plugin_settings
+        self.log_level = log_level
+        self.tags = {}
+        super().__init__(**kwargs)
+
+    def op_Configuration(self, query, variables):
+        return {"configuration": {
+            "general": {
+                "configFilePath": self.config_file,
+                "logLevel": self.log_level,
+                "stashBoxes": [{"endpoint": self.library.stashbox_url, "api_key": "benchmark"}],
+            },
+            "plugins": self.plugin_settings,
+        }}, None
+
+    def entity_list(self, entity_type, variables, rows):
+        query_field = f"find{entity_type.capitalize()}"
+        return {query_field: {"count": len(rows), entity_type: page(rows, variables.get("filter"))}}, None
+
+    def favorites(self, entity_type, variables):
+        return self.entity_list(entity_type, variables, [e for e in self.library.entities[entity_type] if e["favorite"]])
+
+    def updated(self, entity_type, variables):
+        entity_filter = variables.get(f"{entity_type[:-1]}_filter") or {}
+        since = datetime.fromisoformat(entity_filter["updated_at"]["value"])
+        rows = [e for e in self.library.entities[entity_type] if datetime.fromisoformat(e["updated_at"]) > since]
+        return self.entity_list(entity_type, variables, rows)
+
+    def op_FindFavoritePerformers(self, query, variables):
+        return self.favorites("performers", variables)
+
+    def op_FindFavoriteStudios(self, query, variables):
+        return self.favorites("studios", variables)
+
+    def op_FindUpdatedPerformers(self, query, variables):
+        return self.updated("performers", variables)
+
+    def op_FindUpdatedStudios(self, query, variables):
+        return self.updated("studios", variables)
+
+    def op_FindPerformers(self, query, variables):
+        return self.entity_list("performers", variables, self.library.entities["performers"])
+
+    def op_FindStudios(self, query, variables):
+        return self.entity_list("studios", variables, self.library.entities["studios"])
+
+    def op_SamplePerformers(self, query, variables):
+        return self.op_FindPerformers(query, variables)
+
+    def op_SampleStudios(self, query, variables):
+        return self.op_FindStudios(query, variables)
+
+    def op_FindTag(self, query, variables):
+        tag = self.tags.get(variables["name"])
+        return {"findTags": {"tags": [tag] if tag else []}}, None
+
+    def op_TagCreate(self, query, variables):
+        tag = {"id": str(1000 + len(self.tags)), "name": variables["input"]["name"]}
+        self.tags[tag["name"]] = tag
+        return {"tagCreate": tag}, None
+
+    def op_PerformerUpdate(self, query, variables):
+        return {"performerUpdate": {"id": variables["input"]["id"]}}, None
+
+    def op_StudioUpdate(self, query, variables):
+        return {"studioUpdate": {"id": variables["input"]["id"]}}, None
+
+    def bulk_update(self, entity_type, variables):
+        update = variables["input"]
+        rows = self.library.entities[entity_type]
+        for entity_id in update["ids"]:
+            tags = rows[int(entity_id)]["tags"]
+            tags.extend({"id": tag_id} for tag_id in update["tag_ids"]["ids"] if {"id": tag_id} not in tags)
+        return [{"id": entity_id} for entity_id in update["ids"]]
+
+    def op_BulkPerformerUpdate(self, query, variables):
+        return {"bulkPerformerUpdate": self.bulk_update("performers", variables)}, None
+
+    def op_BulkStudioUpdate(self, query, variables):
+        return {"bulkStudioUpdate": self.bulk_update("studios", variables)}, None
+
+    def op_FindScene(self, query, variables):
+        n = int(variables["id"])
+        scenes = self.library.scenes
+        return {"findScene": scenes[n] if 0 <= n < len(scenes) else None}, None
+
+    def batch(self, query, variables):
+        data = {}
+        for alias, field, var in STASH_ALIAS.findall(query):
+            rows = self.library.entities["performers" if field == "findPerformer" else "studios"]
+            n = int(variables[var])
+            data[alias] = rows[n] if 0 <= n < len(rows) else None
+        return data, None
+
+
+class StashBoxStub(GraphQLStub):
+    """stash-box GraphQL API holding the favorites of a Library."""
+
+    def __init__(self, library, **kwargs):
+        self.library = library
+        super().__init__(**kwargs)
+
+    def favorite_page(self, entity_type, variables):
+        with self.library.lock:
+            ids = sorted(self.library.stashbox_favorites[entity_type])
+            ids += sorted(self.library.stashbox_duplicates[entity_type] & self.library.stashbox_favorites[entity_type])
+        rows = [{"id": i, "is_favorite": True} for i in ids]
+        query_field = f"query{entity_type.capitalize()}"
+        return {query_field: {"count": len(rows), entity_type: page(rows, variables.get("input"))}}, None
+
+    def op_Performers(self, query, variables):
+        return self.favorite_page("performers", variables)
+
+    def op_Studios(self, query, variables):
+        return self.favorite_page("studios", variables)
+
+    def batch(self, query, variables):
+        data = {}
+        errors = []
+        with self.library.lock:
+            for alias, field, var, favorite in STASHBOX_ALIAS.findall(query):
+                entity_type = "performers" if "Performer" in field else "studios"
+                favorites = self.library.stashbox_favorites[entity_type]
+                sid = variables[var]
+                if unknown_to_stashbox(sid):
+                    data[alias] = None
+                    if favorite:
+                        errors.append({"message": f"{sid} not found", "path": [alias]})
+                    continue
+                if not favorite:
+                    data[alias] = {"id": sid, "is_favorite": sid in favorites}
+                    continue
+                if favorite == "true":
+                    favorites.add(sid)
+                else:
+                    favorites.discard(sid)
+                    self.library.stashbox_duplicates[entity_type].discard(sid)
+                data[alias] = True
+        # favoriteX is non-null, so an error nulls the whole document
+        return (None if errors else data), errors
+
+
+class WhisparrStub(StubServer):
+    """Whisparr v3 REST API with a movie library of its own.
+
+    The movies it starts with are not in the Library's scenes, so every
+    scene hook adds a new movie.
+    """
+
+    def __init__(self, size, **kwargs):
+        self.movies = {f"movie-{n:08x}": {"id": n + 1, "foreignId": f"movie-{n:08x}", "title": f"Movie {n}"} for n in range(size)}
+        self.next_id = size + 1
+        self.movie_lock = threading.Lock()
+        super().__init__(**kwargs)
+
+    def answer(self, method, parts, body):
+        path = parts.path
+        operation = f"{method} {path}"
+        if method == "GET" and path == "/api/v3/qualityprofile":
+            return operation, 200, [{"id": 1, "name": "Any"}]
+        if method == "GET" and path == "/api/v3/rootfolder":
+            return operation, 200, [{"id": 1, "path": "/data"}]
+        if method == "GET" and path == "/api/v3/movie":
+            wanted = urllib.parse.parse_qs(parts.query).get("stashId")
+            with self.movie_lock:
+                if wanted:
+                    return operation, 200, [self.movies[wanted[0]]] if wanted[0] in self.movies else []
+                return operation, 200, list(self.movies.values())
+        if method == "POST" and path == "/api/v3/movie":
+            with self.movie_lock:
+                if body["foreignId"] in self.movies:
+                    return operation, 400, [{"propertyName": "ForeignId", "errorMessage": "This movie has already been added", "errorCode": "MovieExistsValidator"}]
+                movie = {"id": self.next_id, "foreignId": body["foreignId"], "title": body.get("title")}
+                self.next_id += 1
+                self.movies[body["foreignId"]] = movie
+            return operation, 201, movie
+        if method == "POST" and path == "/api/v3/command":
+            return operation, 201, {"id": 1, "name": body.get("name")}
+        return operation, 404, {"message": "not found"}
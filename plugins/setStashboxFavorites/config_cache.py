@@ -0,0 +1,104 @@
+# Shared Stash configuration cache for the Python plugins
+#
+# Each plugin directory is packaged on its own, so this file is copied into
+# every plugin that uses it. Keep the copies identical.
+#
+# Stash starts a new plugin process for every hook, and each one used to
+# query the Stash configuration before doing any work. The last answer is
+# kept in the plugin directory and reused until it is CACHE_TTL_SECONDS old
+# or Stash's config file has been written since (saving plugin settings in
+# the UI rewrites it). Only the standard library is used.
+#
+
+import json
+import os
+import time
+
+CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config_cache.json")
+CACHE_TTL_SECONDS = 300
+
+# Lookups answered from the cache file / from Stash in this process
+stats = {"hits": 0, "misses": 0}
+
+
+def _server_key(server_connection):
+    return "{}://{}:{}".format(
+        server_connection.get("Scheme", "http"),
+        server_connection.get("Host", "localhost"),
+        server_connection.get("Port", 9999),
+    )
+
+
+def _config_mtime(configuration):
+    """Modification time of the config file named in general.configFilePath, if readable."""
+    path = ((configuration or {}).get("general") or {}).get("configFilePath")
+    if not path:
+        return None
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def _load():
+    try:
+        with open(CACHE_FILE, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def _save(cache):
+    # The configuration holds API keys, so keep the file private to the user
+    tmp = f"{CACHE_FILE}.{os.getpid()}.tmp"
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(cache, f, separators=(",", ":"))
+        os.replace(tmp, CACHE_FILE)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def get_configuration(server_connection, fetch, ttl=CACHE_TTL_SECONDS):
+    """Return the Stash configuration, from the cache file when it is still valid.
+
+    Args:
+        server_connection: Stash server connection info from plugin input
+        fetch: Callable querying Stash for the configuration. Include
+            general { configFilePath } so the entry is dropped as soon as
+            Stash saves its settings. Empty results are not cached.
+        ttl: Maximum age of a cached configuration in seconds
+
+    Returns:
+        The configuration dict as returned by fetch
+    """
+    key = _server_key(server_connection)
+    entry = _load().get(key)
+    if (
+        isinstance(entry, dict)
+        and 0 <= time.time() - entry.get("stored_at", 0) < ttl
+        and entry.get("config_mtime") == _config_mtime(entry.get("configuration"))
+    ):
+        stats["hits"] += 1
+        return entry["configuration"]
+
+    stats["misses"] += 1
+    configuration = fetch()
+    if configuration:
+        cache = _load()
+        cache[key] = {
+            "stored_at": time.time(),
+            "config_mtime": _config_mtime(configuration),
+            "configuration": configuration,
+        }
+        _save(cache)
+    return configuration
+
+
+def summary():
+    return f"Config cache: {stats['hits']} hits, {stats['misses']} misses"
@@ -1,18 +1,161 @@
 import math
+import random
 import sys
 import json
 import ssl
+import threading
+import time
 import urllib.request
 import urllib.error
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.utils import parsedate_to_datetime
+from functools import partial
+import graphql_stream
+import http_metrics
+import http_transport
 import log
+import sync_plan
+import sync_state
 
 # Create SSL context that doesn't verify certificates (for self-signed certs)
 SSL_CONTEXT = ssl.create_default_context()
 SSL_CONTEXT.check_hostname = False
 SSL_CONTEXT.verify_mode = ssl.CERT_NONE
 
-def stashbox_call_graphql(endpoint, boxapi_key, query, variables=None):
-    """Make a GraphQL request to a stash-box endpoint using standard library."""
+# Upper bound for the concurrency plugin setting
+MAX_CONCURRENCY = 16
+
+# Default and upper bound for the number of favorite mutations per request
+DEFAULT_BATCH_SIZE = 25
+MAX_BATCH_SIZE = 500
+
+# Local entities tagged per bulk update request, so one request never holds
+# Stash's database write lock for long
+TAG_BULK_UPDATE_SIZE = 250
+
+# Number of full scans of stash-box favorites to try when the favorite
+# count changes between pages
+STASHBOX_PAGE_SCAN_ATTEMPTS = 3
+
+# HTTP statuses worth retrying: rate limiting and transient server errors.
+# Other errors (bad request, unauthorised, ...) fail straight away.
+STASHBOX_RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# Number of times a request is retried after a retryable failure
+STASHBOX_MAX_RETRIES = 5
+
+# A retry without a Retry-After header waits a random time of up to
+# STASHBOX_RETRY_BASE_DELAY * 2^attempt seconds (at most STASHBOX_RETRY_MAX_DELAY)
+STASHBOX_RETRY_BASE_DELAY = 1.0
+STASHBOX_RETRY_MAX_DELAY = 60.0
+
+# Adaptive request rate: every 429 doubles the minimum time between two
+# stash-box requests (starting at STASHBOX_MIN_INTERVAL), and every request
+# that succeeds shortens it by STASHBOX_INTERVAL_RECOVERY, so the rate
+# settles just under what stash-box accepts
+STASHBOX_MIN_INTERVAL = 0.05
+STASHBOX_MAX_INTERVAL = 10.0
+STASHBOX_INTERVAL_RECOVERY = 0.98
+
+# Time before which no stash-box request may be sent, and the earliest time
+# the next one may start. Shared by all worker threads so one 429 slows down
+# the whole pool, not just the thread that got it.
+_stashbox_lock = threading.Lock()
+_stashbox_resume_at = 0.0
+_stashbox_next_at = 0.0
+_stashbox_interval = 0.0
+_stashbox_slowed_at = 0.0
+
+# Largest batch stash-box has not rejected as too large during this run
+_favorite_batch_limit = MAX_BATCH_SIZE
+
+# Stash-box requests answered during this run and the time they took, used
+# to estimate how long applying a planned sync will take
+_stashbox_timing = {"requests": 0, "seconds": 0.0}
+
+
+def parse_retry_after(value, default):
+    """Parse a Retry-After header (delta-seconds or HTTP-date) into seconds."""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+def pause_stashbox_requests(seconds):
+    """Hold back every stash-box request for the given number of seconds."""
+    global _stashbox_resume_at
+    with _stashbox_lock:
+        _stashbox_resume_at = max(_stashbox_resume_at, time.monotonic() + seconds)
+
+
+def slow_down_stashbox_requests(sent_at):
+    """Halve the stash-box request rate after a 429.
+    
+    Requests already in flight when the rate was last lowered were sent at
+    the old rate, so their 429s don't lower it again.
+    
+    Args:
+        sent_at: time.monotonic() when the rejected request was sent
+    
+    Returns:
+        Minimum number of seconds between two requests
+    """
+    global _stashbox_interval, _stashbox_slowed_at
+    with _stashbox_lock:
+        if sent_at >= _stashbox_slowed_at:
+            _stashbox_interval = min(max(_stashbox_interval * 2, STASHBOX_MIN_INTERVAL), STASHBOX_MAX_INTERVAL)
+            _stashbox_slowed_at = time.monotonic()
+        return _stashbox_interval
+
+
+def speed_up_stashbox_requests():
+    """Raise the stash-box request rate a little after a request succeeded."""
+    global _stashbox_interval
+    with _stashbox_lock:
+        _stashbox_interval *= STASHBOX_INTERVAL_RECOVERY
+        if _stashbox_interval < STASHBOX_MIN_INTERVAL / 2:
+            _stashbox_interval = 0.0
+
+
+def wait_for_stashbox():
+    """Sleep until any rate-limit pause has expired and the next request may start.
+    
+    Returns:
+        time.monotonic() when the wait ended
+    """
+    global _stashbox_next_at
+    while True:
+        with _stashbox_lock:
+            now = time.monotonic()
+            start = max(_stashbox_resume_at, _stashbox_next_at)
+            if start <= now:
+                _stashbox_next_at = now + _stashbox_interval
+                return now
+        time.sleep(start - now)
+
+
+def stashbox_retry_delay(attempt):
+    """Random backoff delay before retry number `attempt` (counting from 1)."""
+    return random.uniform(0, min(STASHBOX_RETRY_BASE_DELAY * 2 ** attempt, STASHBOX_RETRY_MAX_DELAY))
+
+
+def stashbox_request(endpoint, boxapi_key, query, variables=None):
+    """Send a GraphQL request to a stash-box endpoint and return the decoded response.
+    
+    Rate limiting (429), transient server errors (500, 502, 503, 504),
+    timeouts and connection errors are retried, after the server's
+    Retry-After delay if it sent one. A 429 also lowers the request rate of
+    every worker thread (see slow_down_stashbox_requests).
+    Other HTTP errors, and failures left after STASHBOX_MAX_RETRIES retries,
+    are raised to the caller.
+    """
     headers = {
         "Content-Type": "application/json",
         "Accept": "application/json",
@@ -25,119 +168,420 @@ def stashbox_call_graphql(endpoint, boxapi_key, query, variables=None):
     }).encode("utf-8")
     
     req = urllib.request.Request(endpoint, data=data, headers=headers, method="POST")
+    operation = http_metrics.graphql_operation(query)
     
-    try:
-        with urllib.request.urlopen(req, timeout=30, context=SSL_CONTEXT) as response:
-            result = json.loads(response.read().decode("utf-8"))
-            if result.get("errors"):
-                for error in result["errors"]:
-                    log.error("GraphQL error: {}".format(error.get("message", error)))
-            return result.get("data")
-    except urllib.error.HTTPError as e:
-        if e.code == 401:
+    for attempt in range(STASHBOX_MAX_RETRIES + 1):
+        sent_at = wait_for_stashbox()
+        raw = None
+        try:
+            with http_transport.urlopen(req, timeout=30, context=SSL_CONTEXT) as response:
+                raw = response.read()
+            result = json.loads(raw.decode("utf-8"))
+        except urllib.error.HTTPError as e:
+            if e.code not in STASHBOX_RETRYABLE_STATUSES or attempt == STASHBOX_MAX_RETRIES:
+                raise
+            delay = parse_retry_after(e.headers.get("Retry-After"), None)
+            if e.code == 429:
+                interval = slow_down_stashbox_requests(sent_at)
+                delay = 2 ** attempt if delay is None else delay
+                log.warning(f"Stash-box rate limit hit, retrying in {delay:.1f}s at up to {1 / interval:.1f} requests/s")
+                pause_stashbox_requests(delay)
+                continue
+            delay = stashbox_retry_delay(attempt + 1) if delay is None else delay
+            log.debug(f"Stash-box returned {e.code}, retry {attempt + 1}/{STASHBOX_MAX_RETRIES} in {delay:.1f}s")
+        except (urllib.error.URLError, OSError) as e:
+            if attempt == STASHBOX_MAX_RETRIES:
+                raise
+            delay = stashbox_retry_delay(attempt + 1)
+            log.debug(f"Stash-box request failed ({getattr(e, 'reason', e)}), retry {attempt + 1}/{STASHBOX_MAX_RETRIES} in {delay:.1f}s")
+        else:
+            speed_up_stashbox_requests()
+            with _stashbox_lock:
+                _stashbox_timing["requests"] += 1
+                _stashbox_timing["seconds"] += time.monotonic() - sent_at
+            return result
+        finally:
+            http_metrics.record("stash-box", operation, time.monotonic() - sent_at, len(data),
+                                len(raw or b""), error=raw is None, retry=attempt > 0)
+        time.sleep(delay)
+
+
+def log_stashbox_error(err):
+    """Log a failed stash-box request."""
+    if isinstance(err, urllib.error.HTTPError):
+        if err.code == 401:
             log.error("[ERROR][GraphQL] HTTP Error 401, Unauthorised. You need to add a Stash box instance and API Key in your Stash config")
         else:
-            log.error(f"GraphQL query failed: {e.code} - {e.reason}")
-        return None
-    except urllib.error.URLError as e:
-        log.error(f"Connection error: {e.reason}")
-        return None
-    except Exception as err:
+            log.error(f"GraphQL query failed: {err.code} - {err.reason}")
+    elif isinstance(err, urllib.error.URLError):
+        log.error(f"Connection error: {err.reason}")
+    else:
         log.error(str(err))
+
+
+def stashbox_call_graphql(endpoint, boxapi_key, query, variables=None):
+    """Make a GraphQL request to a stash-box endpoint using standard library."""
+    try:
+        result = stashbox_request(endpoint, boxapi_key, query, variables)
+    except Exception as err:
+        log_stashbox_error(err)
         return None
+    if result.get("errors"):
+        for error in result["errors"]:
+            log.error("GraphQL error: {}".format(error.get("message", error)))
+    return result.get("data")
 
-def get_stashbox_performer_favorite(endpoint, boxapi_key, stash_id):
-    query = """
-query FullPerformer($id: ID!) {
-  findPerformer(id: $id) {
-    id
-    is_favorite
-  }
-}
+
+def chunked(items, size):
+    """Split a list into consecutive chunks of at most `size` items."""
+    items = list(items)
+    size = max(1, int(size))
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def build_favorite_batch(field, ops):
+    """Build one mutation document with an aliased favorite field per operation.
+    
+    Args:
+        field: Mutation field name, favoritePerformer or favoriteStudio
+        ops: List of (stash_id, favorite) pairs
+        
+    Returns:
+        Tuple of (query, variables); operation n is aliased as fN
     """
+    params = ", ".join(f"$id{n}: ID!" for n in range(len(ops)))
+    fields = "\n".join(
+        f"  f{n}: {field}(id: $id{n}, favorite: {'true' if favorite else 'false'})"
+        for n, (_, favorite) in enumerate(ops)
+    )
+    query = f"mutation Batch{field[0].upper()}{field[1:]}({params}) {{\n{fields}\n}}"
+    variables = {f"id{n}": stash_id for n, (stash_id, _) in enumerate(ops)}
+    return query, variables
 
-    variables = {
-        "id": stash_id
-    }
 
-    return stashbox_call_graphql(endpoint, boxapi_key, query, variables)
+def shrink_favorite_batch_limit(size):
+    """Lower the batch size limit after stash-box rejected a payload as too large."""
+    global _favorite_batch_limit
+    with _stashbox_lock:
+        _favorite_batch_limit = max(1, min(_favorite_batch_limit, size))
 
-def update_stashbox_performer_favorite(endpoint: str, boxapi_key: str, stash_id: str, favorite: bool):
-    query = """
-mutation FavoritePerformer($id: ID!, $favorite: Boolean!) {
-  favoritePerformer(id: $id, favorite: $favorite)
-}
-"""
 
-    variables = {
-        "id": stash_id,
-        "favorite": favorite
-    }
+def send_favorite_batch(field, endpoint, boxapi_key, ops):
+    """Apply favorite changes with as few aliased mutation requests as possible.
+    
+    Batches rejected with 413 are halved (and later batches kept at that size).
+    A batch whose data is nulled by an error is split in two until the failing
+    stash_ids are isolated.
+    
+    Args:
+        field: Mutation field name, favoritePerformer or favoriteStudio
+        endpoint: Stash-box endpoint URL
+        boxapi_key: Stash-box API key
+        ops: List of (stash_id, favorite) pairs
+        
+    Returns:
+        Dict mapping each stash_id to True if the change was applied, False
+        if stash-box answered with an error or a null result for it, and
+        None if the request failed after its retries
+    """
+    if not ops:
+        return {}
+    
+    limit = _favorite_batch_limit
+    if len(ops) > limit:
+        results = {}
+        for batch in chunked(ops, limit):
+            results.update(send_favorite_batch(field, endpoint, boxapi_key, batch))
+        return results
+    
+    query, variables = build_favorite_batch(field, ops)
+    try:
+        result = stashbox_request(endpoint, boxapi_key, query, variables)
+    except urllib.error.HTTPError as e:
+        if e.code == 413 and len(ops) > 1:
+            log.debug(f'Stash-box rejected a batch of {len(ops)} as too large, retrying with {len(ops) // 2}')
+            shrink_favorite_batch_limit(len(ops) // 2)
+            return send_favorite_batch(field, endpoint, boxapi_key, ops)
+        log_stashbox_error(e)
+        return {stash_id: None for stash_id, _ in ops}
+    except Exception as err:
+        log_stashbox_error(err)
+        return {stash_id: None for stash_id, _ in ops}
+    
+    data = result.get("data")
+    if data is None and result.get("errors") and len(ops) > 1:
+        # An error on a non-null field nulls the whole document, so find which
+        # operations failed by splitting the batch
+        half = len(ops) // 2
+        results = send_favorite_batch(field, endpoint, boxapi_key, ops[:half])
+        results.update(send_favorite_batch(field, endpoint, boxapi_key, ops[half:]))
+        return results
+    
+    for error in result.get("errors") or []:
+        path = error.get("path") or []
+        alias = path[0] if path else None
+        if isinstance(alias, str) and alias[1:].isdigit() and int(alias[1:]) < len(ops):
+            log.error(f'GraphQL error for {ops[int(alias[1:])][0]}: {error.get("message", error)}')
+        else:
+            log.error("GraphQL error: {}".format(error.get("message", error)))
+    
+    if data is None and not result.get("errors"):
+        # Nothing says what happened to the change, so it is not a rejection
+        return {stash_id: None for stash_id, _ in ops}
+    return {stash_id: bool((data or {}).get(f"f{n}")) for n, (stash_id, _) in enumerate(ops)}
 
-    return stashbox_call_graphql(endpoint, boxapi_key, query, variables)
 
-def get_favorite_performers_from_stashbox(endpoint: str, boxapi_key: str):
-    query = """
-query Performers($input: PerformerQueryInput!) {
-  queryPerformers(input: $input) {
-    count
-    performers {
-      id
-      is_favorite
-    }
-  }
-}
-"""
+def refavorite_batch(field, endpoint, boxapi_key, stash_ids):
+    """Clear duplicated stash-box favorites by unfavoriting and refavoriting them."""
+    send_favorite_batch(field, endpoint, boxapi_key, [(stash_id, False) for stash_id in stash_ids])
+    return send_favorite_batch(field, endpoint, boxapi_key, [(stash_id, True) for stash_id in stash_ids])
+
+
+def find_favorite_batch(field, endpoint, boxapi_key, stash_ids):
+    """Look up the stash-box favorite state of several entities in one aliased query.
+    
+    Args:
+        field: Query field name, findPerformer or findStudio
+        endpoint: Stash-box endpoint URL
+        boxapi_key: Stash-box API key
+        stash_ids: List of stash_ids
+        
+    Returns:
+        Dict mapping stash_id to is_favorite, or None if stash-box does not know
+        the id. Ids whose lookup failed are left out.
+    """
+    params = ", ".join(f"$id{n}: ID!" for n in range(len(stash_ids)))
+    fields = "\n".join(f"  f{n}: {field}(id: $id{n}) {{ id is_favorite }}" for n in range(len(stash_ids)))
+    query = f"query Batch{field[0].upper()}{field[1:]}({params}) {{\n{fields}\n}}"
+    data = stashbox_call_graphql(endpoint, boxapi_key, query, {f"id{n}": stash_id for n, stash_id in enumerate(stash_ids)})
+    if data is None:
+        return {}
+    states = {}
+    for n, stash_id in enumerate(stash_ids):
+        if f"f{n}" in data:
+            states[stash_id] = (data[f"f{n}"] or {}).get("is_favorite")
+    return states
+
+
+def get_stashbox_favorite_states(field, endpoint, boxapi_key, stash_ids, batch_size, concurrency=1):
+    """Look up the stash-box favorite state of specific entities in batches.
+    
+    Returns:
+        Dict as returned by find_favorite_batch
+    """
+    states = {}
+    jobs = [(batch, partial(find_favorite_batch, field, endpoint, boxapi_key, batch)) for batch in chunked(stash_ids, batch_size)]
+    for batch, result in run_stashbox_jobs(jobs, concurrency):
+        states.update(result)
+    return states
+
+
+def run_stashbox_jobs(jobs, concurrency=1):
+    """Run stash-box requests with at most `concurrency` in flight.
+    
+    Args:
+        jobs: List of (key, callable) pairs
+        concurrency: Maximum number of concurrent requests (1 runs them in order)
+        
+    Yields:
+        (key, result) pairs in the calling thread as each job finishes
+    """
+    concurrency = max(1, min(int(concurrency or 1), MAX_CONCURRENCY))
+    if concurrency == 1:
+        for key, job in jobs:
+            yield key, job()
+        return
+    
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(job): key for key, job in jobs}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
 
-    per_page = 100
 
+def get_stashbox_favorite_page(endpoint, boxapi_key, query, query_field, list_field, page, per_page):
+    """Fetch one page of stash-box favorites.
+    
+    Returns:
+        Tuple of (count, list of ids), or None if the request failed
+    """
     variables = {
         "input": {
             "names": "",
             "is_favorite": True,
-            "page": 1,
+            "page": page,
             "per_page": per_page,
             "sort": "NAME",
             "direction": "ASC"
         }
     }
+    result = stashbox_call_graphql(endpoint, boxapi_key, query, variables)
+    if not result or not result.get(query_field):
+        return None
+    page_result = result[query_field]
+    return page_result.get("count"), [entity["id"] for entity in page_result.get(list_field) or []]
 
-    performers = set()
 
-    total_count = None
-    request_count = 0
-    max_request_count = 1
+def get_stashbox_favorite_pages(endpoint, boxapi_key, query, query_field, list_field, concurrency=1):
+    """Fetch every page of stash-box favorites.
+    
+    Page 1 gives the total count; the remaining pages are fetched up to
+    `concurrency` at a time. If the count changes while pages are being
+    fetched, items may have shifted between pages, so the scan is repeated.
+    
+    Args:
+        query: queryPerformers/queryStudios GraphQL query
+        query_field: Name of the query field in the response
+        list_field: Name of the entity list in the query result
+        
+    Returns:
+        Tuple of (set of ids, dict of id -> number of times it was returned),
+        or None if a page could not be fetched (after the request retries),
+        since a sync based on the other pages would re-add and keep the
+        favorites on the missing one
+    """
+    per_page = 100
+    
+    for attempt in range(STASHBOX_PAGE_SCAN_ATTEMPTS):
+        first_page = get_stashbox_favorite_page(endpoint, boxapi_key, query, query_field, list_field, 1, per_page)
+        if not first_page:
+            log.error('Failed to fetch page 1 of stashbox favorites')
+            return None
+        total_count, ids = first_page
+        max_request_count = max(1, math.ceil((total_count or 0) / per_page))
+        
+        entitycounts = {}
+        for entity_id in ids:
+            entitycounts[entity_id] = entitycounts.get(entity_id, 0) + 1
+        log.info(f'Received page 1 of {max_request_count}')
+        log.progress((1 / max_request_count) * 0.5)
+        
+        count_changed = False
+        received = 1
+        jobs = [(page, partial(get_stashbox_favorite_page, endpoint, boxapi_key, query, query_field, list_field, page, per_page)) for page in range(2, max_request_count + 1)]
+        for page, result in run_stashbox_jobs(jobs, concurrency):
+            received += 1
+            if not result:
+                log.error(f'Failed to fetch page {page} of {max_request_count} of stashbox favorites')
+                return None
+            page_count, ids = result
+            if page_count != total_count:
+                count_changed = True
+            for entity_id in ids:
+                entitycounts[entity_id] = entitycounts.get(entity_id, 0) + 1
+            log.info(f'Received page {page} of {max_request_count}')
+            log.progress((received / max_request_count) * 0.5)
+        
+        if not count_changed:
+            break
+        if attempt + 1 < STASHBOX_PAGE_SCAN_ATTEMPTS:
+            log.info('Stashbox favorites changed while fetching, fetching all pages again')
+        else:
+            log.warning('Stashbox favorites kept changing while fetching, using the last scan')
+    
+    return set(entitycounts), entitycounts
+
+
+# ============ ENTITY TYPES ============
+
+# What the sync pipeline needs to know about each kind of entity. Anything
+# type-specific lives here, so the fetch, diff, apply and tag stages below
+# are shared by all of them.
+ENTITY_TYPES = {
+    'performers': {
+        'name': 'performer',
+        'local_list_query': 'findPerformers',
+        'local_find_query': 'findPerformer',
+        'local_filter_arg': 'performer_filter',
+        'local_filter_type': 'PerformerFilterType',
+        'local_favorite_filter': '{ filter_favorites: true }',
+        'local_update_mutation': 'bulkPerformerUpdate',
+        'local_update_input': 'BulkPerformerUpdateInput',
+        'stashbox_list_query': 'queryPerformers',
+        'stashbox_query_input': 'PerformerQueryInput',
+        'stashbox_find_query': 'findPerformer',
+        'stashbox_favorite_mutation': 'favoritePerformer',
+    },
+    'studios': {
+        'name': 'studio',
+        'local_list_query': 'findStudios',
+        'local_find_query': 'findStudio',
+        'local_filter_arg': 'studio_filter',
+        'local_filter_type': 'StudioFilterType',
+        'local_favorite_filter': '{ favorite: true }',
+        'local_update_mutation': 'bulkStudioUpdate',
+        'local_update_input': 'BulkStudioUpdateInput',
+        'stashbox_list_query': 'queryStudios',
+        'stashbox_query_input': 'StudioQueryInput',
+        'stashbox_find_query': 'findStudio',
+        'stashbox_favorite_mutation': 'favoriteStudio',
+    },
+}
 
-    performercounts = {}
 
-    while request_count < max_request_count:
-        result = stashbox_call_graphql(endpoint, boxapi_key, query, variables)
-        request_count += 1
-        variables["input"]["page"] += 1
-        if not result:
-            break
-        query_performers = result.get("queryPerformers")
-        if not query_performers:
-            break
-        if total_count is None:
-            total_count = query_performers.get("count")
-            max_request_count = math.ceil(total_count / per_page)
-
-        log.info(f'Received page {variables["input"]["page"] - 1} of {max_request_count}')
-        log.progress(((variables["input"]["page"] - 1) / max_request_count) * 0.5)
-        for performer in query_performers.get("performers"):
-            performer_id = performer['id']
-            if performer_id not in performercounts:
-                performercounts[performer_id] = 1
-            else:
-                performercounts[performer_id] += 1
-        performers.update([performer["id"] for performer in query_performers.get("performers")])
-    return performers, performercounts
+def get_favorites_from_stashbox(entity_type: str, endpoint: str, boxapi_key: str, concurrency: int = 1):
+    """Fetch every stash-box favorite of an entity type.
+    
+    Returns:
+        Tuple as returned by get_stashbox_favorite_pages, or None
+    """
+    entity = ENTITY_TYPES[entity_type]
+    query = f"""
+query {entity_type.capitalize()}($input: {entity['stashbox_query_input']}!) {{
+  {entity['stashbox_list_query']}(input: $input) {{
+    count
+    {entity_type} {{
+      id
+      is_favorite
+    }}
+  }}
+}}
+"""
+    
+    return get_stashbox_favorite_pages(endpoint, boxapi_key, query, entity['stashbox_list_query'], entity_type, concurrency)
 
 
 # Global to store Stash connection for local GraphQL calls
 _stash_connection = None
 
+# Requests and bytes exchanged with local Stash during the current run
+_stash_transfer = {"requests": 0, "bytes_sent": 0, "bytes_received": 0}
+
+# Bytes received for the favorites query during the current run, and the
+# estimated bytes of the unfiltered query it replaced, per entity type
+_favorites_transfer = {}
+
+# Rows of the unfiltered entity list fetched to estimate its size; the sync
+# used to page through it 100 entities at a time
+UNFILTERED_SAMPLE_SIZE = 100
+
+# Page size for local Stash list queries. Stash does not cap per_page and
+# rows are decoded as they stream in, so this only trades round-trips
+# against how long each request keeps Stash busy.
+LOCAL_PAGE_SIZE = 1000
+
+# Per-run lookup of local entities by (endpoint, stash_id), per entity type.
+# Filled from the paged passes the sync already makes so failures can be
+# tagged without rescanning the library once per stash_id.
+_entity_indexes = {entity_type: {} for entity_type in ENTITY_TYPES}
+_entity_index_endpoints = {entity_type: set() for entity_type in ENTITY_TYPES}
+
+
+def index_stash_ids(index, entity):
+    """Add an entity's stash_ids to a (endpoint, stash_id) lookup index."""
+    entry = {
+        "id": entity["id"],
+        "name": entity.get("name"),
+        "tag_ids": [tag["id"] for tag in entity.get("tags") or []]
+    }
+    for sid in entity.get("stash_ids") or []:
+        index[(sid.get("endpoint"), sid.get("stash_id"))] = entry
+
+
+def reset_entity_index(entity_type: str):
+    """Clear the lookup index of an entity type at the start of a sync run."""
+    _entity_indexes[entity_type].clear()
+    _entity_index_endpoints[entity_type].clear()
+
 
 def init_stash_connection(server_connection):
     """Initialize the Stash connection from the plugin input."""
@@ -154,16 +598,12 @@ def init_stash_connection(server_connection):
                str(server_connection.get("Port", 9999)) + "/graphql",
         "session_cookie": server_connection.get("SessionCookie", {}).get("Value"),
     }
+    _stash_transfer.update(requests=0, bytes_sent=0, bytes_received=0)
+    _favorites_transfer.clear()
 
 
-def stash_graphql(query, variables=None):
-    """Make a GraphQL request to local Stash instance."""
-    global _stash_connection
-    
-    if not _stash_connection:
-        log.error("Stash connection not initialized")
-        return None
-    
+def build_stash_request(query, variables=None):
+    """Build the HTTP request for a GraphQL call to local Stash."""
     headers = {
         "Content-Type": "application/json",
         "Accept": "application/json",
@@ -178,708 +618,844 @@ def stash_graphql(query, variables=None):
         "variables": variables or {}
     }).encode("utf-8")
     
-    req = urllib.request.Request(_stash_connection["url"], data=data, headers=headers, method="POST")
+    return urllib.request.Request(_stash_connection["url"], data=data, headers=headers, method="POST")
+
+
+def stash_graphql(query, variables=None):
+    """Make a GraphQL request to local Stash instance."""
+    global _stash_connection
+    
+    if not _stash_connection:
+        log.error("Stash connection not initialized")
+        return None
+    
+    req = build_stash_request(query, variables)
     
+    raw = None
+    start = time.monotonic()
     try:
-        with urllib.request.urlopen(req, timeout=30, context=SSL_CONTEXT) as response:
-            result = json.loads(response.read().decode("utf-8"))
-            if result.get("errors"):
-                log.warning(f"Stash GraphQL errors: {result['errors']}")
-            return result.get("data")
+        with http_transport.urlopen(req, timeout=30, context=SSL_CONTEXT) as response:
+            raw = response.read()
+        _stash_transfer["requests"] += 1
+        _stash_transfer["bytes_sent"] += len(req.data)
+        _stash_transfer["bytes_received"] += len(raw)
+        result = json.loads(raw.decode("utf-8"))
+        if result.get("errors"):
+            log.warning(f"Stash GraphQL errors: {result['errors']}")
+        return result.get("data")
     except Exception as e:
         log.error(f"Stash request error: {e}")
         return None
+    finally:
+        http_metrics.record("stash", http_metrics.graphql_operation(query), time.monotonic() - start,
+                            len(req.data), len(raw or b""), error=raw is None)
+
+
+def stash_graphql_list(query, variables, list_field, result):
+    """Make a GraphQL request to local Stash and yield the rows of one list as they arrive.
+    
+    The response is decoded incrementally from the socket, so memory use does
+    not grow with the page size.
+    
+    Args:
+        query: GraphQL query
+        variables: Query variables
+        list_field: Name of the list to stream, e.g. "performers"
+        result: Dict filled after iteration with the response data, with the
+            streamed list left empty. Stays empty if the request failed.
+    """
+    if not _stash_connection:
+        log.error("Stash connection not initialized")
+        return
+    
+    req = build_stash_request(query, variables)
+    
+    rows = None
+    failed = True
+    start = time.monotonic()
+    try:
+        with http_transport.urlopen(req, timeout=30, context=SSL_CONTEXT, stream=True) as response:
+            rows = graphql_stream.StreamedList(response, list_field)
+            yield from rows
+        failed = False
+    except Exception as e:
+        log.error(f"Stash request error: {e}")
+        return
+    finally:
+        _stash_transfer["requests"] += 1
+        _stash_transfer["bytes_sent"] += len(req.data)
+        if rows is not None:
+            _stash_transfer["bytes_received"] += rows.bytes_read
+        # Includes the time spent handling the rows as they stream in
+        http_metrics.record("stash", http_metrics.graphql_operation(query), time.monotonic() - start,
+                            len(req.data), rows.bytes_read if rows is not None else 0, error=failed)
+    
+    document = rows.document
+    if document.get("errors"):
+        log.warning(f"Stash GraphQL errors: {document['errors']}")
+    result.update(document.get("data") or {})
+
+
+def log_stash_transfer():
+    """Log how much data was exchanged with local Stash during this run."""
+    log.info(f'Stash transfer: {_stash_transfer["requests"]} requests, '
+             f'{_stash_transfer["bytes_sent"] / 1024:.1f} KB sent, '
+             f'{_stash_transfer["bytes_received"] / 1024:.1f} KB received')
+    for entity_type, (received, unfiltered) in _favorites_transfer.items():
+        if unfiltered:
+            log.info(f'Favorite {entity_type} from Stash: ~{unfiltered / 1024:.1f} KB unfiltered -> '
+                     f'{received / 1024:.1f} KB filtered ({100 * (1 - received / unfiltered):.0f}% less)')
+        else:
+            log.info(f'Favorite {entity_type} from Stash: {received / 1024:.1f} KB filtered, unfiltered size not measured')
+
+
+
+def stash_graphql_pages(query, variables, query_field, list_field, outcome):
+    """Yield every row of a paged local Stash list query, LOCAL_PAGE_SIZE rows per request.
+    
+    Args:
+        query: GraphQL query taking a $filter: FindFilterType variable
+        variables: Other query variables
+        query_field: Name of the query field in the response, e.g. "findPerformers"
+        list_field: Name of the list to stream, e.g. "performers"
+        outcome: Dict filled with complete (True once every page was read,
+            False if a request failed) and count (total reported by Stash)
+    """
+    outcome.update(complete=False, count=0)
+    page = 1
+    per_page = LOCAL_PAGE_SIZE
+    
+    while True:
+        data = {}
+        received = 0
+        for row in stash_graphql_list(query, dict(variables, filter={"page": page, "per_page": per_page}), list_field, data):
+            received += 1
+            yield row
+        
+        if query_field not in data:
+            return
+        
+        # Check if we've fetched all items
+        outcome["count"] = data[query_field].get("count", 0)
+        if not received or page * per_page >= outcome["count"]:
+            outcome["complete"] = True
+            return
+        
+        page += 1
+
 
+# ============ FETCH ============
 
-def get_favorite_performers_stash_ids(endpoint: str):
-    """Get stash_ids for all favorite performers linked to a specific stash-box endpoint.
+def get_favorite_stash_ids(entity_type: str, endpoint: str, favorites: dict = None, with_tags: bool = False):
+    """Get stash_ids for all local favorites of an entity type linked to a specific stash-box endpoint.
     
-    Uses Stash GraphQL API instead of direct database access.
+    Favorites are filtered by Stash and only the fields the sync needs are
+    requested.
     
     Args:
+        entity_type: Key of ENTITY_TYPES
         endpoint: StashDB endpoint URL to match stash_ids against
+        favorites: Optional dict filled with {local id: [stash_ids]} for the snapshot
+        with_tags: Also fetch names and tags to fill the lookup index used
+            for error tagging
         
     Returns:
-        Set of StashDB IDs for favorites linked to that endpoint
+        Set of StashDB IDs for favorites linked to that endpoint, or None if
+        a page could not be fetched (a partial set would make the sync
+        remove the missing favorites from stash-box)
     """
-    query = """
-    query FindFavoritePerformers($filter: FindFilterType) {
-        findPerformers(
+    entity = ENTITY_TYPES[entity_type]
+    query = f"""
+    query FindFavorite{entity_type.capitalize()}($filter: FindFilterType, $with_tags: Boolean!) {{
+        {entity['local_list_query']}(
             filter: $filter
-            performer_filter: { filter_favorites: true }
-        ) {
+            {entity['local_filter_arg']}: {entity['local_favorite_filter']}
+        ) {{
             count
-            performers {
+            {entity_type} {{
                 id
-                name
-                stash_ids {
+                name @include(if: $with_tags)
+                tags @include(if: $with_tags) {{
+                    id
+                }}
+                stash_ids {{
                     endpoint
                     stash_id
-                }
-            }
-        }
-    }
+                }}
+            }}
+        }}
+    }}
     """
     
     stash_ids = set()
-    page = 1
-    per_page = 100
+    outcome = {}
+    bytes_before = _stash_transfer["bytes_received"]
     
-    while True:
-        data = stash_graphql(query, {
-            "filter": {
-                "page": page,
-                "per_page": per_page
-            }
-        })
-        
-        if not data or "findPerformers" not in data:
-            break
-        
-        result = data["findPerformers"]
-        performers = result.get("performers", [])
-        
-        if not performers:
-            break
-        
-        for performer in performers:
-            for sid in performer.get("stash_ids", []):
-                if sid.get("endpoint") == endpoint:
-                    stash_ids.add(sid.get("stash_id"))
-        
-        # Check if we've fetched all items
-        total = result.get("count", 0)
-        if page * per_page >= total:
-            break
-        
-        page += 1
+    for row in stash_graphql_pages(query, {"with_tags": with_tags}, entity['local_list_query'], entity_type, outcome):
+        if with_tags:
+            index_stash_ids(_entity_indexes[entity_type], row)
+        for sid in row.get("stash_ids", []):
+            if sid.get("endpoint") == endpoint:
+                stash_ids.add(sid.get("stash_id"))
+                if favorites is not None:
+                    favorites.setdefault(row["id"], []).append(sid.get("stash_id"))
     
-    log.info(f"Found {len(stash_ids)} favorite performers linked to {endpoint}")
+    if not outcome["complete"]:
+        return None
+    log.info(f"Found {len(stash_ids)} favorite {entity_type} linked to {endpoint}")
+    _favorites_transfer[entity_type] = (_stash_transfer["bytes_received"] - bytes_before,
+                                        estimate_unfiltered_favorites_bytes(entity_type))
     return stash_ids
 
 
-def find_performer_by_stash_id(stash_id: str, endpoint: str):
-    """Find a local performer by their stash_id.
+def estimate_unfiltered_favorites_bytes(entity_type: str):
+    """Estimate what fetching the favorites without Stash's favorite filter would receive.
+    
+    The sync used to page through every entity with its name, favorite flag
+    and stash_ids and drop the non-favorites itself. One page of that query
+    is fetched, and its size is scaled by the entity count Stash reports.
     
-    Args:
-        stash_id: The StashDB performer ID
-        endpoint: The StashDB endpoint URL
-        
     Returns:
-        Performer dict with id, name, and tag_ids, or None
+        Estimated bytes, or None if the sample page could not be fetched
     """
-    # Stash doesn't have a direct way to query by stash_id, so we need to 
-    # search performers that have stash_ids matching this endpoint
-    query = """
-    query FindPerformers($filter: FindFilterType) {
-        findPerformers(filter: $filter) {
+    entity = ENTITY_TYPES[entity_type]
+    query = f"""
+    query Sample{entity_type.capitalize()}($filter: FindFilterType) {{
+        {entity['local_list_query']}(filter: $filter) {{
             count
-            performers {
+            {entity_type} {{
                 id
                 name
-                tags {
-                    id
-                    name
-                }
-                stash_ids {
+                favorite
+                stash_ids {{
                     endpoint
                     stash_id
-                }
-            }
-        }
-    }
+                }}
+            }}
+        }}
+    }}
     """
     
-    page = 1
-    per_page = 100
-    
-    while True:
-        data = stash_graphql(query, {
-            "filter": {
-                "page": page,
-                "per_page": per_page
-            }
-        })
-        
-        if not data or "findPerformers" not in data:
-            break
-        
-        result = data["findPerformers"]
-        performers = result.get("performers", [])
-        
-        if not performers:
-            break
-        
-        for performer in performers:
-            for sid in performer.get("stash_ids", []):
-                if sid.get("endpoint") == endpoint and sid.get("stash_id") == stash_id:
-                    return {
-                        "id": performer["id"],
-                        "name": performer["name"],
-                        "tag_ids": [tag["id"] for tag in performer.get("tags", [])]
-                    }
-        
-        total = result.get("count", 0)
-        if page * per_page >= total:
-            break
-        
-        page += 1
-    
-    return None
+    data = {}
+    bytes_before = _stash_transfer["bytes_received"]
+    rows = sum(1 for _ in stash_graphql_list(query, {"filter": {"page": 1, "per_page": UNFILTERED_SAMPLE_SIZE}}, entity_type, data))
+    count = (data.get(entity['local_list_query']) or {}).get("count")
+    if not rows or not count:
+        return None
+    return (_stash_transfer["bytes_received"] - bytes_before) * max(count, rows) / rows
 
 
-def get_or_create_tag(tag_name: str):
-    """Get or create a tag by name.
+def get_updated_entities(entity_type: str, endpoint: str, since: str, favorites: dict):
+    """Apply local changes made since a timestamp to a favorites snapshot.
+    
+    Uses Stash's updated_at filter so only changed entities are fetched.
     
     Args:
-        tag_name: Name of the tag to find or create
+        entity_type: Key of ENTITY_TYPES
+        endpoint: StashDB endpoint URL to match stash_ids against
+        since: Timestamp for the updated_at filter
+        favorites: Snapshot of {local id: [stash_ids]} favorites, updated in place
         
     Returns:
-        Tag dict with id and name, or None
+        Set of stash_ids whose favorite status may have changed, or None if
+        Stash could not be queried
     """
-    # First try to find the tag
-    find_query = """
-    query FindTag($name: String!) {
-        findTags(tag_filter: { name: { value: $name, modifier: EQUALS } }) {
-            tags {
+    entity = ENTITY_TYPES[entity_type]
+    query = f"""
+    query FindUpdated{entity_type.capitalize()}($filter: FindFilterType, ${entity['local_filter_arg']}: {entity['local_filter_type']}) {{
+        {entity['local_list_query']}(filter: $filter, {entity['local_filter_arg']}: ${entity['local_filter_arg']}) {{
+            count
+            {entity_type} {{
                 id
                 name
-            }
-        }
-    }
+                favorite
+                tags {{
+                    id
+                }}
+                stash_ids {{
+                    endpoint
+                    stash_id
+                }}
+            }}
+        }}
+    }}
     """
     
-    data = stash_graphql(find_query, {"name": tag_name})
-    if data and "findTags" in data:
-        tags = data["findTags"].get("tags", [])
-        if tags:
-            return tags[0]
-    
-    # Create the tag if it doesn't exist
-    create_query = """
-    mutation TagCreate($input: TagCreateInput!) {
-        tagCreate(input: $input) {
-            id
-            name
+    changed = set()
+    outcome = {}
+    variables = {
+        entity['local_filter_arg']: {
+            "updated_at": {"value": since, "modifier": "GREATER_THAN"}
         }
     }
-    """
-    
-    log.info(f'Tag "{tag_name}" missing. Creating...')
-    data = stash_graphql(create_query, {
-        "input": {
-            "name": tag_name,
-            "description": "Tag created by Set Stashbox Favorite Performers plugin. Applied to performers found to have stash ids deleted from stashbox."
-        }
-    })
     
-    if data and "tagCreate" in data:
-        return data["tagCreate"]
+    for row in stash_graphql_pages(query, variables, entity['local_list_query'], entity_type, outcome):
+        index_stash_ids(_entity_indexes[entity_type], row)
+        old_ids = set(favorites.pop(row["id"], []))
+        new_ids = set()
+        if row.get("favorite"):
+            new_ids = {sid.get("stash_id") for sid in row.get("stash_ids", []) if sid.get("endpoint") == endpoint}
+        if new_ids:
+            favorites[row["id"]] = sorted(new_ids)
+        changed |= old_ids ^ new_ids
     
-    log.error(f"Failed to create tag: {tag_name}")
-    return None
+    if not outcome["complete"]:
+        return None
+    return changed
 
 
-def tag_performer_by_stash_id(stash_id: str, endpoint: str, tag_id: str):
-    """Tag a performer by their stash_id using GraphQL API.
+def build_entity_index(entity_type: str, endpoint: str):
+    """Index every local entity of a type by stash_id in a single paged pass.
+    
+    Only needed for stash_ids that were not seen while fetching favorites
+    (e.g. favorites to remove), and only once per run.
     
     Args:
-        stash_id: The StashDB performer ID
+        entity_type: Key of ENTITY_TYPES
         endpoint: The StashDB endpoint URL
-        tag_id: The ID of the tag to add
     """
-    performer = find_performer_by_stash_id(stash_id, endpoint)
-    if not performer:
-        log.debug(f'Could not find performer with stash_id {stash_id}')
-        return
-    
-    # Check if already tagged
-    if tag_id in performer["tag_ids"]:
-        log.debug(f'Performer already tagged {stash_id} {performer["id"]} {performer["name"]}')
-        return
-    
-    # Add the tag using performerUpdate mutation
-    update_query = """
-    mutation PerformerUpdate($input: PerformerUpdateInput!) {
-        performerUpdate(input: $input) {
-            id
-        }
-    }
+    # Stash doesn't have a direct way to query by stash_id, so we need to 
+    # page through the entities and index the stash_ids they carry
+    entity = ENTITY_TYPES[entity_type]
+    query = f"""
+    query Find{entity_type.capitalize()}($filter: FindFilterType) {{
+        {entity['local_list_query']}(filter: $filter) {{
+            count
+            {entity_type} {{
+                id
+                name
+                tags {{
+                    id
+                }}
+                stash_ids {{
+                    endpoint
+                    stash_id
+                }}
+            }}
+        }}
+    }}
     """
     
-    new_tag_ids = performer["tag_ids"] + [tag_id]
+    outcome = {}
+    for row in stash_graphql_pages(query, {}, entity['local_list_query'], entity_type, outcome):
+        index_stash_ids(_entity_indexes[entity_type], row)
     
-    data = stash_graphql(update_query, {
-        "input": {
-            "id": performer["id"],
-            "tag_ids": new_tag_ids
-        }
-    })
+    if outcome["complete"]:
+        _entity_index_endpoints[entity_type].add(endpoint)
+
+
+def find_entity_by_stash_id(entity_type: str, stash_id: str, endpoint: str):
+    """Find a local entity by its stash_id.
     
-    if data:
-        log.debug(f'Tagging performer {stash_id} {performer["id"]} {performer["name"]}')
-    else:
-        log.warning(f'Failed to tag performer {stash_id} {performer["id"]}')
+    Looks the entity up in the per-run index, building the full index
+    on the first miss.
+    
+    Args:
+        entity_type: Key of ENTITY_TYPES
+        stash_id: The StashDB ID
+        endpoint: The StashDB endpoint URL
+        
+    Returns:
+        Dict with id, name, and tag_ids, or None
+    """
+    key = (endpoint, stash_id)
+    index = _entity_indexes[entity_type]
+    if key not in index and endpoint not in _entity_index_endpoints[entity_type]:
+        log.debug(f'Indexing local {entity_type} for {endpoint}')
+        build_entity_index(entity_type, endpoint)
+    return index.get(key)
 
 
-def set_stashbox_favorite_performers(server_connection, endpoint: str, boxapi_key: str, tag_errors: bool, tag_name: str):
-    """Sync favorite performers between local Stash and StashDB.
+# ============ DIFF ============
+
+def plan_favorite_sync(entity_type: str, endpoint: str, boxapi_key: str, snapshot, with_tags: bool, concurrency: int = 1, batch_size: int = DEFAULT_BATCH_SIZE):
+    """Work out which stash-box favorites to add, remove and deduplicate.
     
-    Uses GraphQL API instead of direct database access.
+    With a snapshot from a previous run only the entities updated since are
+    looked up on stash-box. Otherwise every favorite is fetched from both
+    sides and compared.
     
     Args:
-        server_connection: Stash server connection info from plugin input
+        entity_type: Key of ENTITY_TYPES
         endpoint: StashDB endpoint URL
         boxapi_key: StashDB API key
-        tag_errors: Whether to tag performers with sync errors
-        tag_name: Name of the tag to use for errors
+        snapshot: Snapshot from sync_state.get_snapshot, or None for a full sync
+        with_tags: Fetch local names and tags for error tagging
+        concurrency: Maximum number of stash-box requests in flight
+        batch_size: Maximum number of entities per stash-box request
+        
+    Returns:
+        Dict with synced_at, favorites (the new snapshot), pending, add and
+        remove (stash_ids) and duplicates ({stash_id: times returned}), or
+        None if Stash or stash-box favorites could not be fetched completely
     """
-    # Initialize Stash connection for GraphQL calls
-    init_stash_connection(server_connection)
+    synced_at = sync_state.now()
+    pending = set()
+    if snapshot:
+        # Incremental sync: only entities changed since the last run, checked
+        # against their current stash-box state
+        log.info(f'Syncing {entity_type} updated since last sync at {snapshot["synced_at"]}')
+        favorites = snapshot["favorites"]
+        changed = get_updated_entities(entity_type, endpoint, sync_state.updated_since(snapshot["synced_at"]), favorites)
+        if changed is None:
+            log.error(f'Could not fetch updated {entity_type} from Stash')
+            return None
+        changed |= set(snapshot.get("pending") or [])
+        stash_ids = sync_state.favorite_stash_ids(favorites)
+        log.info(f'{len(changed)} {entity_type} to check')
+        
+        stashbox_states = get_stashbox_favorite_states(ENTITY_TYPES[entity_type]['stashbox_find_query'], endpoint, boxapi_key, changed, batch_size, concurrency)
+        pending = changed - stashbox_states.keys()
+        favorites_to_add = {stash_id for stash_id, is_favorite in stashbox_states.items() if stash_id in stash_ids and not is_favorite}
+        favorites_to_remove = {stash_id for stash_id, is_favorite in stashbox_states.items() if stash_id not in stash_ids and is_favorite}
+        counts = {}
+    else:
+        # Get local favorites from Stash via GraphQL
+        favorites = {}
+        stash_ids = get_favorite_stash_ids(entity_type, endpoint, favorites, with_tags=with_tags)
+        if stash_ids is None:
+            log.error(f'Could not fetch favorite {entity_type} from Stash')
+            return None
+        log.info(f'Stash {len(stash_ids)} favorite {entity_type}')
+        
+        log.info(f'Fetching Stashbox favorite {entity_type}...')
+        stashbox_favorites = get_favorites_from_stashbox(entity_type, endpoint, boxapi_key, concurrency)
+        if stashbox_favorites is None:
+            log.error(f'Could not fetch stashbox favorite {entity_type}, nothing changed')
+            return None
+        stashbox_stash_ids, counts = stashbox_favorites
+        log.info(f'Stashbox {len(stashbox_stash_ids)} favorite {entity_type}')
+        
+        favorites_to_add = stash_ids - stashbox_stash_ids
+        favorites_to_remove = stashbox_stash_ids - stash_ids
     
-    # Get favorite performers from local Stash via GraphQL
-    stash_ids = get_favorite_performers_stash_ids(endpoint)
+    return {
+        "synced_at": synced_at,
+        "favorites": favorites,
+        "pending": sorted(pending),
+        "add": sorted(favorites_to_add),
+        "remove": sorted(favorites_to_remove),
+        "duplicates": {stash_id: count for stash_id, count in counts.items() if count > 1},
+    }
+
+
+def estimate_favorite_sync(plan: dict, concurrency: int = 1, batch_size: int = DEFAULT_BATCH_SIZE):
+    """Estimate the stash-box requests and time needed to apply a plan.
     
-    log.info(f'Stashbox endpoint {endpoint}')
-    log.info(f'Stash {len(stash_ids)} favorite performers')
+    The time is based on the latency of the stash-box requests made so far
+    in this run and the current adaptive request rate. Batched mutations
+    take a little longer to answer than the queries that were timed, and
+    tagging rejected stash_ids adds Stash requests, so treat it as a lower
+    bound.
     
-    tag = None
-    if tag_errors and tag_name:
-        log.info(f'Tagging errors with performer tag: {tag_name}')
-        tag = get_or_create_tag(tag_name)
-    else:
-        log.info(f'Not tagging errors')
+    Returns:
+        Dict with requests, latency (seconds per request, or None if no
+        stash-box request was timed) and seconds (or None)
+    """
+    requests = (math.ceil(len(plan["add"]) / batch_size)
+                + math.ceil(len(plan["remove"]) / batch_size)
+                + 2 * math.ceil(len(plan["duplicates"]) / batch_size))
+    with _stashbox_lock:
+        timed = _stashbox_timing["requests"]
+        latency = _stashbox_timing["seconds"] / timed if timed else None
+        interval = _stashbox_interval
+    seconds = None
+    if latency is not None:
+        seconds = max(math.ceil(requests / concurrency) * latency, requests * interval)
+    return {"requests": requests, "latency": latency, "seconds": seconds}
+
+
+def save_favorite_plan(entity_type: str, endpoint: str, plan: dict, snapshot, concurrency: int = 1, batch_size: int = DEFAULT_BATCH_SIZE):
+    """Save the plan of a dry run and log what applying it would cost.
     
-    log.info(f'Fetching Stashbox favorite performers...')
-    stashbox_stash_ids, performercounts = get_favorite_performers_from_stashbox(endpoint, boxapi_key)
-    log.info(f'Stashbox {len(stashbox_stash_ids)} favorite performers')
-
-    favorites_to_add = stash_ids - stashbox_stash_ids
-    favorites_to_remove = stashbox_stash_ids - stash_ids
-    dupes_to_remove = [[performer_id, count] for [performer_id, count] in performercounts.items() if count > 1]
-    log.info(f'{len(favorites_to_add)} favorites to add')
-    log.info(f'{len(favorites_to_remove)} favorites to remove')
-    log.info(f'{len(dupes_to_remove)} duplicates to remove')
-    total_work = len(favorites_to_add) + len(favorites_to_remove) + len(dupes_to_remove)
+    Args:
+        entity_type: Key of ENTITY_TYPES
+        endpoint: StashDB endpoint URL
+        plan: Plan returned by plan_favorite_sync
+        snapshot: Snapshot the plan replaces, or None
+        concurrency: Maximum number of stash-box requests in flight
+        batch_size: Maximum number of favorite changes sent per request
+    """
+    estimate = estimate_favorite_sync(plan, concurrency, batch_size)
+    log.info(f'Plan: {len(plan["add"])} favorites to add, {len(plan["remove"])} to remove, {len(plan["duplicates"])} duplicates to remove')
+    log.info(f'Dry run made {_stashbox_timing["requests"]} stashbox and {_stash_transfer["requests"]} Stash requests')
+    if estimate["seconds"] is None:
+        log.info(f'Applying the plan takes {estimate["requests"]} stashbox requests')
+    else:
+        log.info(f'Applying the plan takes {estimate["requests"]} stashbox requests, about {estimate["seconds"]:.1f}s '
+                 f'at {estimate["latency"] * 1000:.0f} ms per request and {concurrency} at a time')
     
-    if total_work == 0:
-        log.info('Already in sync!')
-        log.progress(1)
-        return
-
-    i = 0
-    for stash_id in favorites_to_add:
-        log.trace(f'Adding stashbox favorite {endpoint} {stash_id}')
-        if not (update_stashbox_performer_favorite(endpoint, boxapi_key, stash_id, True) or {}).get('favoritePerformer'):
-            log.warning(f'Failed adding stashbox favorite {stash_id}')
-            if tag:
-                tag_performer_by_stash_id(stash_id, endpoint, tag["id"])
-        i += 1
-        log.progress((i / total_work) * 0.5 + 0.5)
-    log.info('Add done.')
-
-    i = 0
-    for stash_id in favorites_to_remove:
-        log.trace(f'Removing stashbox favorite {endpoint} {stash_id}')
-        if not (update_stashbox_performer_favorite(endpoint, boxapi_key, stash_id, False) or {}).get('favoritePerformer'):
-            log.warning(f'Failed removing stashbox favorite {stash_id}')
-            if tag:
-                tag_performer_by_stash_id(stash_id, endpoint, tag["id"])
-        i += 1
-        log.progress((i / total_work) * 0.5 + 0.5)
-    log.info('Remove done.')
-
-    i = 0
-    for performer_id, count in dupes_to_remove:
-        log.trace(f'Fixing duplicate stashbox favorite {endpoint} {performer_id} count={count}')
-        update_stashbox_performer_favorite(endpoint, boxapi_key, performer_id, False)
-        update_stashbox_performer_favorite(endpoint, boxapi_key, performer_id, True)
-        i += 1
-        log.progress((i / total_work) * 0.5 + 0.5)
-    log.info('Fixed duplicates.')
+    path = sync_plan.save(entity_type, dict(
+        plan,
+        endpoint=endpoint,
+        based_on=(snapshot or {}).get("synced_at"),
+        estimate=dict(estimate, concurrency=concurrency, batch_size=batch_size),
+    ))
+    if path:
+        log.info(f'Saved plan to {path}')
+    log_stash_transfer()
     log.progress(1)
 
-def set_stashbox_favorite_performer(endpoint, boxapi_key, stash_id, favorite):
-    if not stash_id:
-        log.warning(f'Empty stash_id provided, skipping performer sync')
-        return
-    result = get_stashbox_performer_favorite(endpoint, boxapi_key, stash_id)
-    if not result:
-        return
-    if not result.get("findPerformer"):
-        log.warning(f'Performer not found on stashbox: {stash_id}')
-        return
-    if favorite != result["findPerformer"]["is_favorite"]:
-        update_stashbox_performer_favorite(endpoint, boxapi_key, stash_id, favorite)
-        log.info(f'Updated Stashbox performer {stash_id} favorite={favorite}')
-    else:
-        log.info(f'Stashbox performer {stash_id} already in sync favorite={favorite}')
-
 
-# ============ STUDIO SYNC FUNCTIONS ============
-
-def get_stashbox_studio_favorite(endpoint, boxapi_key, stash_id):
-    query = """
-query FullStudio($id: ID!) {
-  findStudio(id: $id) {
-    id
-    is_favorite
-  }
-}
+def load_favorite_plan(entity_type: str, endpoint: str, snapshot):
+    """Load the plan saved by a dry run, if it can still be applied.
+    
+    A plan is only applied to the endpoint it was made for and on top of
+    the snapshot it was made from. Once another sync has run, the plan
+    may undo its changes, so it has to be made again.
+    
+    Args:
+        entity_type: Key of ENTITY_TYPES
+        endpoint: StashDB endpoint URL
+        snapshot: Current snapshot, or None
+        
+    Returns:
+        The plan, or None
     """
+    plan = sync_plan.load(entity_type)
+    if plan is None:
+        return None
+    if plan.get("endpoint") != endpoint:
+        log.error(f'Sync plan was made for {plan.get("endpoint")}, not {endpoint}')
+        return None
+    if plan.get("based_on") != (snapshot or {}).get("synced_at"):
+        log.error(f'{entity_type.capitalize()} were synced after the plan was made, run the plan task again')
+        return None
+    log.info(f'Applying plan made at {plan["synced_at"]}')
+    return plan
 
-    variables = {
-        "id": stash_id
-    }
-
-    return stashbox_call_graphql(endpoint, boxapi_key, query, variables)
-
-
-def update_stashbox_studio_favorite(endpoint: str, boxapi_key: str, stash_id: str, favorite: bool):
-    query = """
-mutation FavoriteStudio($id: ID!, $favorite: Boolean!) {
-  favoriteStudio(id: $id, favorite: $favorite)
-}
-"""
-
-    variables = {
-        "id": stash_id,
-        "favorite": favorite
-    }
-
-    return stashbox_call_graphql(endpoint, boxapi_key, query, variables)
-
-
-def get_favorite_studios_from_stashbox(endpoint: str, boxapi_key: str):
-    query = """
-query Studios($input: StudioQueryInput!) {
-  queryStudios(input: $input) {
-    count
-    studios {
-      id
-      is_favorite
-    }
-  }
-}
-"""
-
-    per_page = 100
-
-    variables = {
-        "input": {
-            "names": "",
-            "is_favorite": True,
-            "page": 1,
-            "per_page": per_page,
-            "sort": "NAME",
-            "direction": "ASC"
-        }
-    }
-
-    studios = set()
-
-    total_count = None
-    request_count = 0
-    max_request_count = 1
-
-    studiocounts = {}
-
-    while request_count < max_request_count:
-        result = stashbox_call_graphql(endpoint, boxapi_key, query, variables)
-        request_count += 1
-        variables["input"]["page"] += 1
-        if not result:
-            break
-        query_studios = result.get("queryStudios")
-        if not query_studios:
-            break
-        if total_count is None:
-            total_count = query_studios.get("count")
-            max_request_count = math.ceil(total_count / per_page)
-
-        log.info(f'Received page {variables["input"]["page"] - 1} of {max_request_count}')
-        log.progress(((variables["input"]["page"] - 1) / max_request_count) * 0.5)
-        for studio in query_studios.get("studios"):
-            studio_id = studio['id']
-            if studio_id not in studiocounts:
-                studiocounts[studio_id] = 1
-            else:
-                studiocounts[studio_id] += 1
-        studios.update([studio["id"] for studio in query_studios.get("studios")])
-    return studios, studiocounts
 
+# ============ APPLY ============
 
-def get_favorite_studios_stash_ids(endpoint: str):
-    """Get stash_ids for all favorite studios linked to a specific stash-box endpoint.
-    
-    Uses Stash GraphQL API instead of direct database access.
+def get_or_create_tag(tag_name: str):
+    """Get or create a tag by name.
     
     Args:
-        endpoint: StashDB endpoint URL to match stash_ids against
+        tag_name: Name of the tag to find or create
         
     Returns:
-        Set of StashDB IDs for favorites linked to that endpoint
+        Tag dict with id and name, or None
     """
-    query = """
-    query FindFavoriteStudios($filter: FindFilterType) {
-        findStudios(
-            filter: $filter
-            studio_filter: { is_missing: null }
-        ) {
-            count
-            studios {
+    # First try to find the tag
+    find_query = """
+    query FindTag($name: String!) {
+        findTags(tag_filter: { name: { value: $name, modifier: EQUALS } }) {
+            tags {
                 id
                 name
-                favorite
-                stash_ids {
-                    endpoint
-                    stash_id
-                }
             }
         }
     }
     """
     
-    stash_ids = set()
-    page = 1
-    per_page = 100
-    
-    while True:
-        data = stash_graphql(query, {
-            "filter": {
-                "page": page,
-                "per_page": per_page
-            }
-        })
-        
-        if not data or "findStudios" not in data:
-            break
-        
-        result = data["findStudios"]
-        studios = result.get("studios", [])
-        
-        if not studios:
-            break
-        
-        for studio in studios:
-            # Only include favorite studios
-            if not studio.get("favorite"):
-                continue
-            for sid in studio.get("stash_ids", []):
-                if sid.get("endpoint") == endpoint:
-                    stash_ids.add(sid.get("stash_id"))
-        
-        # Check if we've fetched all items
-        total = result.get("count", 0)
-        if page * per_page >= total:
-            break
-        
-        page += 1
-    
-    log.info(f"Found {len(stash_ids)} favorite studios linked to {endpoint}")
-    return stash_ids
-
-
-def find_studio_by_stash_id(stash_id: str, endpoint: str):
-    """Find a local studio by their stash_id.
+    data = stash_graphql(find_query, {"name": tag_name})
+    if data and "findTags" in data:
+        tags = data["findTags"].get("tags", [])
+        if tags:
+            return tags[0]
     
-    Args:
-        stash_id: The StashDB studio ID
-        endpoint: The StashDB endpoint URL
-        
-    Returns:
-        Studio dict with id, name, and tag_ids, or None
-    """
-    query = """
-    query FindStudios($filter: FindFilterType) {
-        findStudios(filter: $filter) {
-            count
-            studios {
-                id
-                name
-                tags {
-                    id
-                    name
-                }
-                stash_ids {
-                    endpoint
-                    stash_id
-                }
-            }
+    # Create the tag if it doesn't exist
+    create_query = """
+    mutation TagCreate($input: TagCreateInput!) {
+        tagCreate(input: $input) {
+            id
+            name
         }
     }
     """
     
-    page = 1
-    per_page = 100
+    log.info(f'Tag "{tag_name}" missing. Creating...')
+    data = stash_graphql(create_query, {
+        "input": {
+            "name": tag_name,
+            "description": "Tag created by Set Stashbox Favorite Performers plugin. Applied to performers found to have stash ids deleted from stashbox."
+        }
+    })
     
-    while True:
-        data = stash_graphql(query, {
-            "filter": {
-                "page": page,
-                "per_page": per_page
-            }
-        })
-        
-        if not data or "findStudios" not in data:
-            break
-        
-        result = data["findStudios"]
-        studios = result.get("studios", [])
-        
-        if not studios:
-            break
-        
-        for studio in studios:
-            for sid in studio.get("stash_ids", []):
-                if sid.get("endpoint") == endpoint and sid.get("stash_id") == stash_id:
-                    return {
-                        "id": studio["id"],
-                        "name": studio["name"],
-                        "tag_ids": [tag["id"] for tag in studio.get("tags", [])]
-                    }
-        
-        total = result.get("count", 0)
-        if page * per_page >= total:
-            break
-        
-        page += 1
+    if data and "tagCreate" in data:
+        return data["tagCreate"]
     
+    log.error(f"Failed to create tag: {tag_name}")
     return None
 
 
-def tag_studio_by_stash_id(stash_id: str, endpoint: str, tag_id: str):
-    """Tag a studio by their stash_id using GraphQL API.
+def tag_entities_by_stash_id(entity_type: str, stash_ids, endpoint: str, tag_id: str):
+    """Tag the local entities of several stash_ids using bulk update mutations.
+    
+    The tag is added in ADD mode, so Stash merges it into each entity's
+    current tags instead of the plugin overwriting them with a list it read
+    earlier.
     
     Args:
-        stash_id: The StashDB studio ID
+        entity_type: Key of ENTITY_TYPES
+        stash_ids: StashDB IDs of the entities to tag
         endpoint: The StashDB endpoint URL
         tag_id: The ID of the tag to add
     """
-    studio = find_studio_by_stash_id(stash_id, endpoint)
-    if not studio:
-        log.debug(f'Could not find studio with stash_id {stash_id}')
-        return
-    
-    # Check if already tagged
-    if tag_id in studio["tag_ids"]:
-        log.debug(f'Studio already tagged {stash_id} {studio["id"]} {studio["name"]}')
+    entity_type_info = ENTITY_TYPES[entity_type]
+    name = entity_type_info['name']
+    entities = {}
+    for stash_id in stash_ids:
+        entity = find_entity_by_stash_id(entity_type, stash_id, endpoint)
+        if not entity:
+            log.debug('Could not find %s with stash_id %s', name, stash_id)
+        elif tag_id in entity["tag_ids"]:
+            log.debug('%s already tagged %s %s %s', name.capitalize(), stash_id, entity["id"], entity["name"])
+        else:
+            entities[entity["id"]] = entity
+    if not entities:
         return
     
-    # Add the tag using studioUpdate mutation
-    update_query = """
-    mutation StudioUpdate($input: StudioUpdateInput!) {
-        studioUpdate(input: $input) {
+    mutation = entity_type_info['local_update_mutation']
+    update_query = f"""
+    mutation {mutation[0].upper()}{mutation[1:]}($input: {entity_type_info['local_update_input']}!) {{
+        {mutation}(input: $input) {{
             id
-        }
-    }
+        }}
+    }}
     """
     
-    new_tag_ids = studio["tag_ids"] + [tag_id]
+    failed = 0
+    for batch in chunked(sorted(entities), TAG_BULK_UPDATE_SIZE):
+        data = stash_graphql(update_query, {
+            "input": {
+                "ids": batch,
+                "tag_ids": {"ids": [tag_id], "mode": "ADD"}
+            }
+        })
+        if data and data.get(mutation) is not None:
+            for entity_id in batch:
+                entity = entities[entity_id]
+                entity["tag_ids"].append(tag_id)
+                log.debug('Tagging %s %s %s', name, entity_id, entity["name"])
+        else:
+            failed += len(batch)
+            log.warning(f'Failed to tag {len(batch)} {entity_type}: {", ".join(batch)}')
+    log.info(f'Tagged {len(entities) - failed} {entity_type} with stash_ids rejected by stashbox')
+
+
+def apply_favorite_sync(entity_type: str, endpoint: str, boxapi_key: str, plan: dict, tag, concurrency: int = 1, batch_size: int = DEFAULT_BATCH_SIZE):
+    """Send the favorite changes of a plan to stash-box and save the new snapshot.
     
-    data = stash_graphql(update_query, {
-        "input": {
-            "id": studio["id"],
-            "tag_ids": new_tag_ids
-        }
-    })
+    Args:
+        entity_type: Key of ENTITY_TYPES
+        endpoint: StashDB endpoint URL
+        boxapi_key: StashDB API key
+        plan: Plan returned by plan_favorite_sync
+        tag: Tag dict for stash_ids stash-box rejects, or None to not tag
+        concurrency: Maximum number of stash-box requests in flight
+        batch_size: Maximum number of favorite changes sent per request
+    """
+    name = ENTITY_TYPES[entity_type]['name']
+    favorite_mutation = ENTITY_TYPES[entity_type]['stashbox_favorite_mutation']
+    pending = set(plan["pending"])
+    rejected = []
+    duplicates = plan["duplicates"]
+    log.info(f'{len(plan["add"])} favorites to add')
+    log.info(f'{len(plan["remove"])} favorites to remove')
+    log.info(f'{len(duplicates)} duplicates to remove')
+    total_work = len(plan["add"]) + len(plan["remove"]) + len(duplicates)
     
-    if data:
-        log.debug(f'Tagging studio {stash_id} {studio["id"]} {studio["name"]}')
+    if total_work:
+        if concurrency > 1:
+            log.info(f'Sending up to {concurrency} stashbox requests at a time')
+        if batch_size > 1:
+            log.info(f'Sending up to {batch_size} favorite changes per request')
     else:
-        log.warning(f'Failed to tag studio {stash_id} {studio["id"]}')
+        log.info('Already in sync!')
+    
+    i = 0
+    for favorite, stash_ids, verb in ((True, plan["add"], 'adding'), (False, plan["remove"], 'removing')):
+        jobs = [(batch, partial(send_favorite_batch, favorite_mutation, endpoint, boxapi_key, [(stash_id, favorite) for stash_id in batch])) for batch in chunked(stash_ids, batch_size)]
+        for batch, results in run_stashbox_jobs(jobs, concurrency):
+            for stash_id in batch:
+                if results.get(stash_id):
+                    log.trace('%s stashbox favorite %s %s', 'Added' if favorite else 'Removed', endpoint, stash_id)
+                else:
+                    pending.add(stash_id)
+                    log.warning(f'Failed {verb} stashbox favorite {name} {stash_id}')
+                    # Only a rejection points at the stash_id; a failed request is retried next run
+                    if results.get(stash_id) is False:
+                        rejected.append(stash_id)
+            i += len(batch)
+            log.progress((i / total_work) * 0.5 + 0.5)
+        if total_work:
+            log.info('Add done.' if favorite else 'Remove done.')
+    
+    jobs = [(batch, partial(refavorite_batch, favorite_mutation, endpoint, boxapi_key, batch)) for batch in chunked(sorted(duplicates), batch_size)]
+    for batch, results in run_stashbox_jobs(jobs, concurrency):
+        for stash_id in batch:
+            if results.get(stash_id):
+                log.trace('Fixed duplicate stashbox favorite %s %s count=%s', endpoint, stash_id, duplicates[stash_id])
+            else:
+                log.warning(f'Failed fixing duplicate stashbox favorite {name} {stash_id}')
+        i += len(batch)
+        log.progress((i / total_work) * 0.5 + 0.5)
+    if total_work:
+        log.info('Fixed duplicates.')
+    
+    if tag and rejected:
+        tag_entities_by_stash_id(entity_type, rejected, endpoint, tag["id"])
+    
+    state = sync_state.load()
+    sync_state.set_snapshot(state, entity_type, endpoint, plan["synced_at"], plan["favorites"], pending)
+    sync_state.save(state)
+    log_stash_transfer()
+    log.progress(1)
 
 
-def set_stashbox_favorite_studios(server_connection, endpoint: str, boxapi_key: str, tag_errors: bool, tag_name: str):
-    """Sync favorite studios between local Stash and StashDB.
+def sync_favorites(entity_type: str, server_connection, endpoint: str, boxapi_key: str, tag_errors: bool, tag_name: str, concurrency: int = 1, batch_size: int = DEFAULT_BATCH_SIZE, full_reconcile: bool = False, dry_run: bool = False, apply_plan: bool = False):
+    """Sync favorites of an entity type between local Stash and StashDB.
     
-    Uses GraphQL API instead of direct database access.
+    Uses GraphQL API instead of direct database access. After the first
+    run only entities updated since the previous run are compared, unless
+    full_reconcile is set.
     
     Args:
+        entity_type: Key of ENTITY_TYPES
         server_connection: Stash server connection info from plugin input
         endpoint: StashDB endpoint URL
         boxapi_key: StashDB API key
-        tag_errors: Whether to tag studios with sync errors
+        tag_errors: Whether to tag entities with sync errors
         tag_name: Name of the tag to use for errors
+        concurrency: Maximum number of stash-box requests in flight
+        batch_size: Maximum number of favorite changes sent per request
+        full_reconcile: Compare every favorite on both sides even when a
+            snapshot from a previous run allows an incremental sync
+        dry_run: Only fetch and compare, saving the plan (see sync_plan)
+            instead of changing anything
+        apply_plan: Apply the plan saved by a dry run instead of fetching
     """
+    concurrency = max(1, min(int(concurrency or 1), MAX_CONCURRENCY))
+    batch_size = max(1, min(int(batch_size or DEFAULT_BATCH_SIZE), MAX_BATCH_SIZE))
+    
     # Initialize Stash connection for GraphQL calls
     init_stash_connection(server_connection)
+    reset_entity_index(entity_type)
     
-    # Get favorite studios from local Stash via GraphQL
-    stash_ids = get_favorite_studios_stash_ids(endpoint)
+    state = sync_state.load()
+    snapshot = sync_state.get_snapshot(state, entity_type, endpoint)
     
     log.info(f'Stashbox endpoint {endpoint}')
-    log.info(f'Stash {len(stash_ids)} favorite studios')
+    
+    if apply_plan:
+        plan = load_favorite_plan(entity_type, endpoint, snapshot)
+        if plan is None:
+            return
     
     tag = None
-    if tag_errors and tag_name:
-        log.info(f'Tagging errors with tag: {tag_name}')
+    if dry_run:
+        log.info('Dry run, nothing will be changed')
+    elif tag_errors and tag_name:
+        log.info(f'Tagging errors with {ENTITY_TYPES[entity_type]["name"]} tag: {tag_name}')
         tag = get_or_create_tag(tag_name)
     else:
         log.info(f'Not tagging errors')
     
-    log.info(f'Fetching Stashbox favorite studios...')
-    stashbox_stash_ids, studiocounts = get_favorite_studios_from_stashbox(endpoint, boxapi_key)
-    log.info(f'Stashbox {len(stashbox_stash_ids)} favorite studios')
-
-    favorites_to_add = stash_ids - stashbox_stash_ids
-    favorites_to_remove = stashbox_stash_ids - stash_ids
-    dupes_to_remove = [[studio_id, count] for [studio_id, count] in studiocounts.items() if count > 1]
-    log.info(f'{len(favorites_to_add)} favorites to add')
-    log.info(f'{len(favorites_to_remove)} favorites to remove')
-    log.info(f'{len(dupes_to_remove)} duplicates to remove')
-    total_work = len(favorites_to_add) + len(favorites_to_remove) + len(dupes_to_remove)
+    if not apply_plan:
+        plan = plan_favorite_sync(entity_type, endpoint, boxapi_key, None if full_reconcile else snapshot, bool(tag), concurrency, batch_size)
+        if plan is None:
+            return
     
-    if total_work == 0:
-        log.info('Already in sync!')
-        log.progress(1)
+    if dry_run:
+        save_favorite_plan(entity_type, endpoint, plan, snapshot, concurrency, batch_size)
         return
+    
+    apply_favorite_sync(entity_type, endpoint, boxapi_key, plan, tag, concurrency, batch_size)
+    if apply_plan:
+        sync_plan.remove(entity_type)
 
-    i = 0
-    for stash_id in favorites_to_add:
-        log.trace(f'Adding stashbox favorite {endpoint} {stash_id}')
-        if not (update_stashbox_studio_favorite(endpoint, boxapi_key, stash_id, True) or {}).get('favoriteStudio'):
-            log.warning(f'Failed adding stashbox favorite studio {stash_id}')
-            if tag:
-                tag_studio_by_stash_id(stash_id, endpoint, tag["id"])
-        i += 1
-        log.progress((i / total_work) * 0.5 + 0.5)
-    log.info('Add done.')
 
-    i = 0
-    for stash_id in favorites_to_remove:
-        log.trace(f'Removing stashbox favorite {endpoint} {stash_id}')
-        if not (update_stashbox_studio_favorite(endpoint, boxapi_key, stash_id, False) or {}).get('favoriteStudio'):
-            log.warning(f'Failed removing stashbox favorite studio {stash_id}')
-            if tag:
-                tag_studio_by_stash_id(stash_id, endpoint, tag["id"])
-        i += 1
-        log.progress((i / total_work) * 0.5 + 0.5)
-    log.info('Remove done.')
+def set_stashbox_favorite_performers(server_connection, endpoint: str, boxapi_key: str, tag_errors: bool, tag_name: str, concurrency: int = 1, batch_size: int = DEFAULT_BATCH_SIZE, full_reconcile: bool = False, dry_run: bool = False, apply_plan: bool = False):
+    """Sync favorite performers between local Stash and StashDB (see sync_favorites)."""
+    sync_favorites('performers', server_connection, endpoint, boxapi_key, tag_errors, tag_name, concurrency, batch_size, full_reconcile, dry_run, apply_plan)
 
-    i = 0
-    for studio_id, count in dupes_to_remove:
-        log.trace(f'Fixing duplicate stashbox favorite {endpoint} {studio_id} count={count}')
-        update_stashbox_studio_favorite(endpoint, boxapi_key, studio_id, False)
-        update_stashbox_studio_favorite(endpoint, boxapi_key, studio_id, True)
-        i += 1
-        log.progress((i / total_work) * 0.5 + 0.5)
-    log.info('Fixed duplicates.')
-    log.progress(1)
 
+def set_stashbox_favorite_studios(server_connection, endpoint: str, boxapi_key: str, tag_errors: bool, tag_name: str, concurrency: int = 1, batch_size: int = DEFAULT_BATCH_SIZE, full_reconcile: bool = False, dry_run: bool = False, apply_plan: bool = False):
+    """Sync favorite studios between local Stash and StashDB (see sync_favorites)."""
+    sync_favorites('studios', server_connection, endpoint, boxapi_key, tag_errors, tag_name, concurrency, batch_size, full_reconcile, dry_run, apply_plan)
 
-def set_stashbox_favorite_studio(endpoint, boxapi_key, stash_id, favorite):
-    if not stash_id:
-        log.warning(f'Empty stash_id provided, skipping studio sync')
-        return
-    result = get_stashbox_studio_favorite(endpoint, boxapi_key, stash_id)
-    if not result:
-        return
-    if not result.get("findStudio"):
-        log.warning(f'Studio not found on stashbox: {stash_id}')
+
+# ============ QUEUED HOOK SYNC ============
+
+def get_local_entities(field: str, entity_ids):
+    """Fetch several local entities by id in one aliased query.
+    
+    Args:
+        field: Query field name, e.g. findPerformer or findStudio
+        entity_ids: List of local ids
+        
+    Returns:
+        List of entities with id, name, favorite and stash_ids (ids that no
+        longer exist are left out), or None if Stash could not be queried
+    """
+    params = ", ".join(f"$id{n}: ID!" for n in range(len(entity_ids)))
+    fields = "\n".join(
+        f"  e{n}: {field}(id: $id{n}) {{ id name favorite stash_ids {{ endpoint stash_id }} }}"
+        for n in range(len(entity_ids))
+    )
+    query = f"query Batch{field[0].upper()}{field[1:]}({params}) {{\n{fields}\n}}"
+    data = stash_graphql(query, {f"id{n}": entity_id for n, entity_id in enumerate(entity_ids)})
+    if data is None:
+        return None
+    return [entity for entity in data.values() if entity]
+
+
+def set_stashbox_favorites_by_id(server_connection, entity_type: str, endpoint: str, boxapi_key: str, entity_ids, concurrency: int = 1, batch_size: int = DEFAULT_BATCH_SIZE):
+    """Sync the favorite status of specific local entities to stash-box.
+    
+    Used for queued update hooks: the entities are fetched from Stash, their
+    stash-box state looked up and the differing ones changed, each step in
+    batched requests.
+    
+    Args:
+        server_connection: Stash server connection info from plugin input
+        entity_type: Key of ENTITY_TYPES
+        endpoint: StashDB endpoint URL
+        boxapi_key: StashDB API key
+        entity_ids: Local ids of the updated entities
+        concurrency: Maximum number of stash-box requests in flight
+        batch_size: Maximum number of entities per stash-box request
+    """
+    concurrency = max(1, min(int(concurrency or 1), MAX_CONCURRENCY))
+    batch_size = max(1, min(int(batch_size or DEFAULT_BATCH_SIZE), MAX_BATCH_SIZE))
+    entity = ENTITY_TYPES[entity_type]
+    init_stash_connection(server_connection)
+    
+    # Favorite status wanted on stash-box per stash_id; a stash_id shared by
+    # several local entities stays a favorite if any of them is one
+    wanted = {}
+    for batch in chunked(sorted(entity_ids), LOCAL_PAGE_SIZE):
+        rows = get_local_entities(entity['local_find_query'], batch)
+        if rows is None:
+            log.error(f'Could not fetch updated {entity_type} from Stash')
+            return
+        for row in rows:
+            for sid in row.get("stash_ids") or []:
+                if sid.get("endpoint") == endpoint and sid.get("stash_id"):
+                    wanted[sid["stash_id"]] = wanted.get(sid["stash_id"], False) or bool(row.get("favorite"))
+    log.info(f'{len(entity_ids)} updated {entity_type}, {len(wanted)} linked to {endpoint}')
+    if not wanted:
         return
-    if favorite != result["findStudio"]["is_favorite"]:
-        update_stashbox_studio_favorite(endpoint, boxapi_key, stash_id, favorite)
-        log.info(f'Updated Stashbox studio {stash_id} favorite={favorite}')
-    else:
-        log.info(f'Stashbox studio {stash_id} already in sync favorite={favorite}')
+    
+    states = get_stashbox_favorite_states(entity['stashbox_find_query'], endpoint, boxapi_key, list(wanted), batch_size, concurrency)
+    changes = []
+    for stash_id, favorite in wanted.items():
+        if stash_id not in states:
+            log.warning(f'Could not look up stashbox favorite {stash_id}')
+        elif states[stash_id] is None:
+            log.warning(f'{entity["name"].capitalize()} not found on stashbox: {stash_id}')
+        elif states[stash_id] != favorite:
+            changes.append((stash_id, favorite))
+    
+    failed = 0
+    jobs = [(batch, partial(send_favorite_batch, entity['stashbox_favorite_mutation'], endpoint, boxapi_key, batch)) for batch in chunked(changes, batch_size)]
+    for batch, results in run_stashbox_jobs(jobs, concurrency):
+        for stash_id, favorite in batch:
+            if results.get(stash_id):
+                log.trace('Updated Stashbox %s %s favorite=%s', entity["name"], stash_id, favorite)
+            else:
+                failed += 1
+                log.warning(f'Failed updating stashbox favorite {stash_id}')
+    log.info(f'Updated {len(changes) - failed} stashbox favorites, {len(wanted) - len(changes)} already in sync')
+    log_stash_transfer()
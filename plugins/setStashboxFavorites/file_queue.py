@@ -0,0 +1,277 @@
+# File-backed queues and locks shared by plugin processes
+#
+# Shared by the Python plugins. Each plugin directory is packaged on its own,
+# so this file is copied into every plugin that uses it. Keep the copies
+# identical.
+#
+# Stash starts one process per hook, so work that should be batched across
+# hooks is appended to a queue file (one JSON entry per line). The first
+# process that finds nobody draining the queue takes its lock and becomes the
+# drainer: it waits until entries stop arriving, moves the queue aside and
+# hands the entries to a callback, until the queue stays empty.
+#
+# A batch whose callback raises stays in place for the next drainer, which
+# tries it again. After MAX_BATCH_ATTEMPTS failures it is moved to a .failed
+# file next to the queue, so one bad entry can't stop the queue for good.
+#
+# Locks are files created with O_EXCL. Their holder refreshes them while it
+# works; a lock not refreshed for LOCK_STALE_SECONDS belongs to a crashed
+# process and is taken over.
+#
+
+import json
+import os
+import threading
+import time
+import log
+
+# A lock not refreshed for this long belongs to a crashed process
+LOCK_STALE_SECONDS = 600.0
+
+# How often a lock is refreshed while its holder works on a batch; a
+# rate-limited sync of a large batch can outlast LOCK_STALE_SECONDS
+LOCK_REFRESH_SECONDS = 30.0
+
+# Time given to processes that opened the queue just before it was taken to
+# finish their write
+HANDOFF_SECONDS = 0.1
+
+# Times a batch is handed to the callback before it is set aside
+MAX_BATCH_ATTEMPTS = 3
+
+
+def acquire_lock(path, name):
+    """Try to create a lock file. Returns True if this process holds the lock.
+
+    Args:
+        path: Lock file
+        name: What the lock protects, for the log
+    """
+    for _ in range(2):
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            try:
+                age = time.time() - os.path.getmtime(path)
+            except OSError:
+                continue
+            if age < LOCK_STALE_SECONDS:
+                return False
+            log.warning(f"Removing stale {name} lock ({age:.0f}s old)")
+            try:
+                os.remove(path)
+            except OSError:
+                return False
+            continue
+        os.write(fd, str(os.getpid()).encode("utf-8"))
+        os.close(fd)
+        return True
+    return False
+
+
+def refresh_lock(path):
+    """Mark a lock as held by a live process."""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def release_lock(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def call_holding_lock(path, function, *args):
+    """Call function(*args), refreshing a held lock from a thread meanwhile."""
+    done = threading.Event()
+
+    def heartbeat():
+        while not done.wait(LOCK_REFRESH_SECONDS):
+            refresh_lock(path)
+
+    thread = threading.Thread(target=heartbeat, name="lock-heartbeat", daemon=True)
+    thread.start()
+    try:
+        return function(*args)
+    finally:
+        done.set()
+        thread.join()
+
+
+class FileQueue:
+    """A queue file drained in batches by one process at a time.
+
+    Args:
+        path: Queue file; the batch being drained is kept next to it with a
+            .draining suffix (its failed attempts in .draining.attempts), and
+            batches that failed MAX_BATCH_ATTEMPTS times are added to .failed
+        lock_path: Drainer lock file
+        name: What is queued, for the log
+        debounce_seconds: Time without new entries before a batch is taken
+        max_debounce_seconds: Longest a drainer waits for the queue to go
+            quiet while entries keep arriving
+    """
+
+    def __init__(self, path, lock_path, name, debounce_seconds, max_debounce_seconds):
+        self.path = path
+        self.draining_path = path + ".draining"
+        self.attempts_path = self.draining_path + ".attempts"
+        self.failed_path = path + ".failed"
+        self.lock_path = lock_path
+        self.name = name
+        self.debounce_seconds = debounce_seconds
+        self.max_debounce_seconds = max_debounce_seconds
+
+    def enqueue(self, entry):
+        """Append an entry (a JSON-serialisable value) to the queue."""
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, line.encode("utf-8"))
+        finally:
+            os.close(fd)
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def pending(self):
+        """Return True if entries are queued, or left behind by a drainer that failed."""
+        return bool(self.size()) or os.path.exists(self.draining_path)
+
+    def acquire_drainer(self):
+        """Try to become the drainer. Returns True if this process holds the lock."""
+        return acquire_lock(self.lock_path, self.name)
+
+    def wait_for_quiet(self):
+        """Wait until nothing has been queued for debounce_seconds (or max_debounce_seconds passed)."""
+        start = time.monotonic()
+        size = self.size()
+        quiet_since = start
+        while True:
+            now = time.monotonic()
+            if now - quiet_since >= self.debounce_seconds or now - start >= self.max_debounce_seconds:
+                return
+            time.sleep(min(0.25, self.debounce_seconds))
+            refresh_lock(self.lock_path)
+            new_size = self.size()
+            if new_size != size:
+                size = new_size
+                quiet_since = time.monotonic()
+
+    def take_batch(self):
+        """Take the queued entries.
+
+        The queue is moved aside first, so hooks keep appending to a new
+        queue while the batch is handled. A batch left behind by a drainer
+        that crashed is taken again before anything newer.
+
+        Returns:
+            List of queued entries, empty if nothing is queued
+        """
+        while True:
+            if not os.path.exists(self.draining_path):
+                try:
+                    os.replace(self.path, self.draining_path)
+                except FileNotFoundError:
+                    return []
+                except OSError as e:
+                    # Windows refuses while a hook process has the file open
+                    log.debug(f"Could not take the {self.name} yet: {e}")
+                    return []
+                time.sleep(HANDOFF_SECONDS)
+
+            entries = []
+            with open(self.draining_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # Partial line from a hook process killed mid-write
+                        continue
+            if entries:
+                return entries
+            self.finish_batch()
+
+    def finish_batch(self):
+        """Drop the batch returned by take_batch once it has been handled."""
+        for path in (self.draining_path, self.attempts_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def fail_batch(self, error):
+        """Count a failed attempt at the batch returned by take_batch.
+
+        Returns:
+            True if the batch was set aside in the .failed file, False if it
+            stays in place for the next drainer
+        """
+        try:
+            with open(self.attempts_path, "r", encoding="utf-8") as f:
+                attempts = int(f.read().strip() or 0) + 1
+        except (OSError, ValueError):
+            attempts = 1
+        if attempts < MAX_BATCH_ATTEMPTS:
+            log.error(f"Handling the {self.name} failed ({attempts}/{MAX_BATCH_ATTEMPTS} attempts), "
+                      f"the next drainer tries again: {error}")
+            try:
+                with open(self.attempts_path, "w", encoding="utf-8") as f:
+                    f.write(str(attempts))
+            except OSError:
+                pass
+            return False
+        log.error(f"Handling the {self.name} failed {attempts} times, batch moved to {self.failed_path}: {error}")
+        try:
+            with open(self.draining_path, "rb") as src, open(self.failed_path, "ab") as dst:
+                dst.write(src.read())
+        except OSError as e:
+            log.warning(f"Could not keep the failed {self.name} batch: {e}")
+        self.finish_batch()
+        return True
+
+    def drain(self, apply, retry_on=()):
+        """Hand queued entries to apply until the queue stays empty.
+
+        Must be called with the drainer lock held; releases it on return.
+        The lock is refreshed while apply runs. An exception raised by apply
+        is logged and counted against the batch (see fail_batch), and
+        draining stops until the next drainer.
+
+        Args:
+            apply: Callable taking a list of queued entries
+            retry_on: Exception types that leave the batch for the next
+                drainer without counting an attempt; they are re-raised
+        """
+        try:
+            while True:
+                while True:
+                    self.wait_for_quiet()
+                    entries = self.take_batch()
+                    if not entries:
+                        break
+                    try:
+                        call_holding_lock(self.lock_path, apply, entries)
+                    except retry_on:
+                        raise
+                    except Exception as e:
+                        if not self.fail_batch(e):
+                            release_lock(self.lock_path)
+                            return
+                        continue
+                    self.finish_batch()
+                    refresh_lock(self.lock_path)
+                release_lock(self.lock_path)
+                # An entry queued after the last check found this process
+                # still holding the lock, so nobody else will drain it
+                if not (self.size() and self.acquire_drainer()):
+                    return
+        except BaseException:
+            release_lock(self.lock_path)
+            raise
@@ -0,0 +1,134 @@
+import codecs
+import json
+
+# Bytes read from the response per socket read
+CHUNK_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+_SEPARATORS = _WHITESPACE + ","
+
+
+class StreamedList:
+    """Iterate over one list in a JSON response without decoding it all at once.
+
+    Only the text up to the list, the element being decoded and the text
+    after the list are held in memory, so a page of 100k performers costs
+    about as much as a page of one. Everything outside the list is decoded
+    after iteration and available as `document`, with the list left empty.
+
+    The list is the first array value of an object key named `list_field`,
+    e.g. "performers" in {"data": {"findPerformers": {"count": 1, "performers": [...]}}}.
+    """
+
+    def __init__(self, stream, list_field):
+        self._stream = stream
+        self._key = list_field
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._eof = False
+        self.document = None
+        self.bytes_read = 0
+
+    def _read(self):
+        """Read and decode the next chunk; returns "" at end of stream."""
+        while not self._eof:
+            chunk = self._stream.read(CHUNK_SIZE)
+            self.bytes_read += len(chunk)
+            if not chunk:
+                self._eof = True
+                return self._text_decoder.decode(b"", final=True)
+            text = self._text_decoder.decode(chunk)
+            # A chunk can end inside a multi-byte character and decode to ""
+            if text:
+                return text
+        return ""
+
+    def _find_list(self):
+        """Scan up to the opening bracket of the list.
+
+        Returns:
+            Tuple of (text up to and including "[", text after it), or
+            (whole document, None) if the list is not present
+        """
+        prefix = []
+        buf = ""
+        pos = 0
+        in_string = False
+        escaped = False
+        string_parts = []
+        string_start = 0
+        last_string = None
+        awaiting_value = False
+        while True:
+            if pos >= len(buf):
+                if in_string:
+                    string_parts.append(buf[string_start:])
+                    string_start = 0
+                prefix.append(buf)
+                buf = self._read()
+                pos = 0
+                if not buf:
+                    return "".join(prefix), None
+            ch = buf[pos]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == "\\":
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+                    string_parts.append(buf[string_start:pos])
+                    last_string = "".join(string_parts)
+            elif ch == '"':
+                in_string = True
+                string_parts = []
+                string_start = pos + 1
+                awaiting_value = False
+            elif ch == ":":
+                awaiting_value = last_string == self._key
+            elif ch == "[" and awaiting_value:
+                prefix.append(buf[:pos + 1])
+                return "".join(prefix), buf[pos + 1:]
+            elif ch not in _WHITESPACE:
+                awaiting_value = False
+                last_string = None
+            pos += 1
+
+    def __iter__(self):
+        prefix, buf = self._find_list()
+        if buf is None:
+            self.document = json.loads(prefix)
+            return
+
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in _SEPARATORS:
+                pos += 1
+            if pos >= len(buf):
+                buf = self._read()
+                pos = 0
+                if not buf:
+                    raise ValueError("Response ended inside the list")
+                continue
+            if buf[pos] == "]":
+                break
+            try:
+                item, end = _decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # Element continues in the next chunk
+                more = self._read()
+                if not more:
+                    raise
+                buf = buf[pos:] + more
+                pos = 0
+                continue
+            yield item
+            pos = end
+
+        rest = [buf[pos:]]
+        while True:
+            more = self._read()
+            if not more:
+                break
+            rest.append(more)
+        self.document = json.loads(prefix + "".join(rest))
@@ -0,0 +1,53 @@
+import os
+import file_queue
+import log
+
+# Performer/studio update hooks only append the entity to this queue. The
+# first hook process that finds no drainer running becomes the drainer: it
+# waits until the updates stop arriving, collapses repeated updates of the
+# same entity and syncs them all in one batched run (see file_queue).
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+QUEUE_FILE = os.path.join(PLUGIN_DIR, "hook_queue.jsonl")
+LOCK_FILE = os.path.join(PLUGIN_DIR, "hook_queue.lock")
+
+# Seconds without new queue entries before the drainer starts syncing
+DEBOUNCE_SECONDS = 2.0
+
+# Longest a drainer waits for the queue to go quiet during a long bulk edit
+MAX_DEBOUNCE_SECONDS = 30.0
+
+_queue = file_queue.FileQueue(QUEUE_FILE, LOCK_FILE, "hook queue", DEBOUNCE_SECONDS, MAX_DEBOUNCE_SECONDS)
+
+
+def enqueue(entity_type, entity_id):
+    """Append an updated entity to the queue.
+
+    Args:
+        entity_type: "performers" or "studios"
+        entity_id: Local Stash id of the updated entity
+    """
+    _queue.enqueue({"type": entity_type, "id": str(entity_id)})
+
+
+def acquire_drainer():
+    """Try to become the drainer. Returns True if this process holds the lock."""
+    return _queue.acquire_drainer()
+
+
+def drain(apply):
+    """Sync queued updates until the queue stays empty.
+
+    Must be called with the drainer lock held; releases it on return.
+
+    Args:
+        apply: Callable taking a {entity type: set of entity ids} batch, in
+            which repeated updates of an entity are collapsed
+    """
+    def apply_entries(entries):
+        batch = {}
+        for entry in entries:
+            batch.setdefault(entry["type"], set()).add(entry["id"])
+        log.info(f"Hook queue: {len(entries)} updates for {sum(len(ids) for ids in batch.values())} entities")
+        apply(batch)
+
+    _queue.drain(apply_entries)
@@ -0,0 +1,152 @@
+# Per-operation HTTP metrics for the Python plugins
+#
+# Shared by the Python plugins. Each plugin directory is packaged on its own,
+# so this file is copied into every plugin that uses it. Keep the copies
+# identical.
+#
+# Every HTTP request a plugin sends to Stash, stash-box or Whisparr is
+# recorded under "<service> <operation>", the operation being the GraphQL
+# operation name (or the method and path of a REST call). Per operation the
+# number of requests sent, the retries among them, the requests that failed
+# (HTTP error statuses and connection errors), a latency histogram and the
+# bytes sent and received are kept. summary_lines() turns them into a table
+# that the plugins log at the end of each task or hook, and write() appends
+# them to METRICS_FILE so runs can be compared over time.
+#
+
+import json
+import os
+import re
+import threading
+import time
+import log
+
+METRICS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "http_metrics.jsonl")
+
+# Upper bounds (ms) of the latency histogram buckets; slower requests land
+# in one more, open-ended bucket
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_OPERATION_NAME = re.compile(r"^\s*(?:query|mutation)\s+(\w+)")
+_ID_SEGMENT = re.compile(r"/\d+(?=/|$)")
+
+_lock = threading.Lock()
+_operations = {}
+_started = time.monotonic()
+
+
+def graphql_operation(query):
+    """Name of the operation in a GraphQL document ("anonymous" if it has none)."""
+    match = _OPERATION_NAME.match(query)
+    return match.group(1) if match else "anonymous"
+
+
+def rest_operation(method, url):
+    """Method and path of a REST call, with numeric ids replaced by {id}."""
+    import urllib.parse
+    path = urllib.parse.urlsplit(url).path or "/"
+    return f"{method} {_ID_SEGMENT.sub('/{id}', path)}"
+
+
+def record(service, operation, seconds, bytes_sent=0, bytes_received=0, error=False, retry=False):
+    """Record one HTTP request.
+
+    Args:
+        service: "stash", "stash-box" or "whisparr"
+        operation: Operation name (see graphql_operation, rest_operation)
+        seconds: Time from sending the request to reading the whole answer
+        bytes_sent: Request body size
+        bytes_received: Response body size
+        error: The request failed (HTTP error status or connection error)
+        retry: The request repeated an earlier failed one
+    """
+    bucket = len(LATENCY_BUCKETS_MS)
+    for n, bound in enumerate(LATENCY_BUCKETS_MS):
+        if seconds * 1000 <= bound:
+            bucket = n
+            break
+    key = f"{service} {operation}"
+    with _lock:
+        stats = _operations.get(key)
+        if stats is None:
+            stats = _operations[key] = {
+                "calls": 0, "retries": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0,
+                "bytes_sent": 0, "bytes_received": 0, "histogram": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+            }
+        stats["calls"] += 1
+        stats["retries"] += bool(retry)
+        stats["errors"] += bool(error)
+        stats["seconds"] += seconds
+        stats["max_seconds"] = max(stats["max_seconds"], seconds)
+        stats["bytes_sent"] += bytes_sent
+        stats["bytes_received"] += bytes_received
+        stats["histogram"][bucket] += 1
+
+
+def _percentile_ms(histogram, fraction):
+    """Upper bound of the histogram bucket holding the given fraction of requests."""
+    wanted = sum(histogram) * fraction
+    seen = 0
+    for n, count in enumerate(histogram):
+        seen += count
+        if count and seen >= wanted:
+            return f"{LATENCY_BUCKETS_MS[n]}" if n < len(LATENCY_BUCKETS_MS) else f">{LATENCY_BUCKETS_MS[-1]}"
+    return "-"
+
+
+def summary_lines():
+    """The metrics recorded so far as table rows, or [] if no request was made."""
+    with _lock:
+        operations = {key: dict(stats) for key, stats in _operations.items()}
+    if not operations:
+        return []
+    width = max(len("operation"), *(len(key) for key in operations))
+    lines = [f"{'operation':<{width}} {'calls':>6} {'retry':>5} {'err':>4} {'avg ms':>8} {'p50 ms':>7} {'p95 ms':>7} {'max ms':>8} {'sent KB':>8} {'recv KB':>9}"]
+    services = {}
+    for key, stats in sorted(operations.items(), key=lambda item: -item[1]["seconds"]):
+        lines.append(
+            f"{key:<{width}} {stats['calls']:>6} {stats['retries']:>5} {stats['errors']:>4} "
+            f"{stats['seconds'] / stats['calls'] * 1000:>8.1f} {_percentile_ms(stats['histogram'], 0.5):>7} "
+            f"{_percentile_ms(stats['histogram'], 0.95):>7} {stats['max_seconds'] * 1000:>8.1f} "
+            f"{stats['bytes_sent'] / 1024:>8.1f} {stats['bytes_received'] / 1024:>9.1f}"
+        )
+        service = key.split(" ", 1)[0]
+        services[service] = services.get(service, 0.0) + stats["seconds"]
+    lines.append(
+        f"Run took {time.monotonic() - _started:.1f}s, waiting on "
+        + ", ".join(f"{service} {seconds:.1f}s" for service, seconds in sorted(services.items()))
+        + " (concurrent requests overlap)"
+    )
+    return lines
+
+
+def log_summary(level="info"):
+    """Log the metrics table, if any request was made."""
+    lines = summary_lines()
+    if lines:
+        getattr(log, level)("HTTP requests:\n" + "\n".join(lines))
+
+
+def write(run):
+    """Append the metrics of this run to METRICS_FILE as one JSON line.
+
+    Args:
+        run: Name of the task or hook, stored with the metrics
+    """
+    with _lock:
+        operations = {key: dict(stats) for key, stats in _operations.items()}
+    if not operations:
+        return
+    from datetime import datetime
+    entry = {
+        "at": datetime.now().astimezone().isoformat(timespec="seconds"),
+        "run": run,
+        "seconds": round(time.monotonic() - _started, 3),
+        "latency_buckets_ms": list(LATENCY_BUCKETS_MS),
+        "operations": operations,
+    }
+    try:
+        with open(METRICS_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+    except OSError as e:
+        log.warning(f"Could not write HTTP metrics to {METRICS_FILE}: {e}")
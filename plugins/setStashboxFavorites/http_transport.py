@@ -0,0 +1,207 @@
+# Shared HTTP transport for the Python plugins
+#
+# Each plugin directory is packaged on its own, so this file is copied into
+# every plugin that uses it. Keep the copies identical.
+#
+# Keeps a small pool of persistent http.client connections per host so that
+# repeated GraphQL/REST calls reuse one TCP (and TLS) connection instead of
+# handshaking on every request. Only the standard library is used.
+#
+
+import http.client
+import io
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# Idle connections kept per (scheme, host, port)
+MAX_IDLE_PER_HOST = 4
+
+# Errors raised when a pooled connection was closed by the server while idle
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    BrokenPipeError,
+    ConnectionResetError,
+    ConnectionAbortedError,
+)
+
+_pool_lock = threading.Lock()
+_idle = {}
+
+
+class Response:
+    """Fully read HTTP response, usable like the object urllib.request.urlopen returns."""
+
+    def __init__(self, url, status, reason, headers, body):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self._body = io.BytesIO(body)
+
+    def read(self, amt=-1):
+        return self._body.read(amt)
+
+    def getcode(self):
+        return self.status
+
+    def close(self):
+        self._body.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class StreamingResponse:
+    """HTTP response read straight from the pooled connection.
+
+    The connection goes back to the pool on close() if the body was read to
+    the end, otherwise it is closed.
+    """
+
+    def __init__(self, url, response, key, conn):
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self._response = response
+        self._key = key
+        self._conn = conn
+
+    def read(self, amt=None):
+        return self._response.read(amt)
+
+    def getcode(self):
+        return self.status
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        if self._response.isclosed() and not self._response.will_close:
+            _checkin(self._key, conn)
+        else:
+            self._response.close()
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _pool_key(parts):
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    return parts.scheme, parts.hostname, port
+
+
+def _checkout(key, timeout, context):
+    """Take an idle connection for the host, or open a new one.
+
+    Returns a tuple of (connection, reused).
+    """
+    with _pool_lock:
+        idle = _idle.get(key)
+        if idle:
+            conn = idle.pop()
+            conn.timeout = timeout
+            if conn.sock:
+                conn.sock.settimeout(timeout)
+            return conn, True
+    scheme, host, port = key
+    if scheme == "https":
+        return http.client.HTTPSConnection(host, port, timeout=timeout, context=context), False
+    return http.client.HTTPConnection(host, port, timeout=timeout), False
+
+
+def _checkin(key, conn):
+    """Return a connection to the pool, closing it if the pool is full."""
+    with _pool_lock:
+        idle = _idle.setdefault(key, [])
+        if len(idle) < MAX_IDLE_PER_HOST:
+            idle.append(conn)
+            return
+    conn.close()
+
+
+def close_all():
+    """Close every idle pooled connection."""
+    with _pool_lock:
+        connections = [conn for idle in _idle.values() for conn in idle]
+        _idle.clear()
+    for conn in connections:
+        conn.close()
+
+
+def _uses_proxy(parts):
+    proxies = urllib.request.getproxies()
+    return parts.scheme in proxies and not urllib.request.proxy_bypass(parts.hostname or "")
+
+
+def urlopen(req, timeout=30, context=None, stream=False):
+    """Send a urllib.request.Request over a pooled keep-alive connection.
+
+    Behaves like urllib.request.urlopen for the callers in these plugins:
+    HTTP error statuses raise urllib.error.HTTPError and connection failures
+    raise urllib.error.URLError. A request that fails on a reused connection
+    the server has since closed is retried once on a fresh connection.
+    Requests that need a proxy, and redirects, are handed to urllib.
+
+    Args:
+        req: urllib.request.Request (or URL string)
+        timeout: Socket timeout in seconds
+        context: ssl.SSLContext for https URLs
+        stream: Return a StreamingResponse that reads the body from the
+            socket as it is consumed, instead of reading it all up front
+
+    Returns:
+        Response (or StreamingResponse) with status, headers and read()
+    """
+    if isinstance(req, str):
+        req = urllib.request.Request(req)
+    url = req.full_url
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ("http", "https") or _uses_proxy(parts):
+        return urllib.request.urlopen(req, timeout=timeout, context=context)
+
+    key = _pool_key(parts)
+    path = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+    headers = dict(req.header_items())
+    body = req.data
+    method = req.get_method()
+
+    while True:
+        conn, reused = _checkout(key, timeout, context)
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            if stream and response.status < 300:
+                return StreamingResponse(url, response, key, conn)
+            data = response.read()
+        except STALE_CONNECTION_ERRORS as e:
+            conn.close()
+            if reused:
+                continue
+            raise urllib.error.URLError(e)
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            raise urllib.error.URLError(e)
+        break
+
+    if response.will_close:
+        conn.close()
+    else:
+        _checkin(key, conn)
+
+    if 300 <= response.status < 400 and response.getheader("Location"):
+        # Leave redirect handling to urllib
+        return urllib.request.urlopen(req, timeout=timeout, context=context)
+    if response.status >= 400:
+        raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(data))
+    return Response(url, response.status, response.reason, response.headers, data)
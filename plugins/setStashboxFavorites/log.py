@@ -1,5 +1,14 @@
-import sys
+# Stash plugin log protocol
+#
+# Shared by the Python plugins. Each plugin directory is packaged on its own,
+# so this file is copied into every plugin that uses it. Keep the copies
+# identical.
+#
+import atexit
 import re
+import sys
+import threading
+import time
 # Log messages sent from a script scraper instance are transmitted via stderr and are
 # encoded with a prefix consisting of special character SOH, then the log
 # level (one of t, d, i, w or e - corresponding to trace, debug, info,
@@ -10,35 +19,121 @@ import re
 # formatted methods are intended for use by script scraper instances to transmit log
 # messages.
 #
+# Messages below the minimum level (see set_level) are dropped before they
+# are formatted. Extra arguments are only formatted into the message
+# (msg % args) when it is logged, so hot loops should pass them instead of
+# building an f-string. Trace, debug and progress lines are buffered and
+# written at most every FLUSH_INTERVAL seconds; info and above flush the
+# buffer straight away, as does exiting.
+#
+
+LEVELS = {"trace": 0, "debug": 1, "info": 2, "warning": 3, "error": 4}
+
+# Longest time a buffered line waits before it is written
+FLUSH_INTERVAL = 0.5
+
+# Buffered bytes that trigger a write regardless of FLUSH_INTERVAL
+FLUSH_SIZE = 64 * 1024
+
+# Smallest change of the progress value worth reporting
+PROGRESS_STEP = 0.01
+
+# Scrubs inline images from messages; compiled on first use, as most runs
+# never log one
+_data_image = None
+
+_lock = threading.Lock()
+_buffer = []
+_buffered = 0
+_flush_at = 0.0
+_min_level = 0
+_last_progress = None
+
 
-def __log(level_char: bytes, s):
-    if level_char:
-        lvl_char = "\x01{}\x02".format(level_char.decode())
-        s = re.sub(r"data:image.+?;base64(.+?')","[...]",str(s))
-        for x in s.split("\n"):
-            print(lvl_char, x, file=sys.stderr, flush=True)
+def set_level(level):
+    """Drop messages below a level ("trace", "debug", "info", "warning" or "error", any case).
 
+    Unknown or empty levels are ignored, so Stash's configured log level can
+    be passed as is.
+    """
+    global _min_level
+    if level and level.lower() in LEVELS:
+        _min_level = LEVELS[level.lower()]
 
-def trace(s):
-    __log(b't', s)
 
+def is_enabled(level):
+    """Whether messages of a level ("trace", "debug", ...) are logged."""
+    return LEVELS[level] >= _min_level
 
-def debug(s):
-    __log(b'd', s)
 
+def flush():
+    """Write the buffered lines to stderr."""
+    global _buffered
+    with _lock:
+        if _buffer:
+            sys.stderr.write("".join(_buffer))
+            _buffer.clear()
+            _buffered = 0
+        sys.stderr.flush()
 
-def info(s):
-    __log(b'i', s)
 
+def __scrub(s):
+    global _data_image
+    if _data_image is None:
+        _data_image = re.compile(r"data:image.+?;base64(.+?')")
+    return _data_image.sub("[...]", s)
 
-def warning(s):
-    __log(b'w', s)
 
+def __log(level_char: str, s, args=(), urgent=True):
+    global _buffered, _flush_at
+    s = str(s) % args if args else str(s)
+    if "data:image" in s:
+        s = __scrub(s)
+    prefix = f"\x01{level_char}\x02 "
+    lines = "".join(f"{prefix}{x}\n" for x in s.split("\n"))
+    with _lock:
+        now = time.monotonic()
+        if not _buffer:
+            _flush_at = now + FLUSH_INTERVAL
+        _buffer.append(lines)
+        _buffered += len(lines)
+        urgent = urgent or _buffered >= FLUSH_SIZE or now >= _flush_at
+    if urgent:
+        flush()
 
-def error(s):
-    __log(b'e', s)
+
+def trace(s, *args):
+    if _min_level <= LEVELS["trace"]:
+        __log('t', s, args, urgent=False)
+
+
+def debug(s, *args):
+    if _min_level <= LEVELS["debug"]:
+        __log('d', s, args, urgent=False)
+
+
+def info(s, *args):
+    if _min_level <= LEVELS["info"]:
+        __log('i', s, args)
+
+
+def warning(s, *args):
+    if _min_level <= LEVELS["warning"]:
+        __log('w', s, args)
+
+
+def error(s, *args):
+    __log('e', s, args)
 
 
 def progress(p):
+    """Report task progress (0 to 1), skipping changes smaller than PROGRESS_STEP."""
+    global _last_progress
     progress = min(max(0, p), 1)
-    __log(b'p', str(progress))
+    if _last_progress is not None and abs(progress - _last_progress) < PROGRESS_STEP and progress not in (0, 1):
+        return
+    _last_progress = progress
+    __log('p', str(progress), urgent=False)
+
+
+atexit.register(flush)
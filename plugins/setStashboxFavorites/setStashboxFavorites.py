@@ -5,23 +5,23 @@
 #
 
 import json
+import config_cache
+import hook_queue
+import http_metrics
 import log
+import profiling
 import sys
-import ssl
-import urllib.request
-import urllib.error
-from favorite_performers_sync import (
-    set_stashbox_favorite_performers, set_stashbox_favorite_performer,
-    set_stashbox_favorite_studios, set_stashbox_favorite_studio
-)
-
-# Create SSL context that doesn't verify certificates (for self-signed certs)
-SSL_CONTEXT = ssl.create_default_context()
-SSL_CONTEXT.check_hostname = False
-SSL_CONTEXT.verify_mode = ssl.CERT_NONE
+
+# Most hook runs only append to the hook queue. The sync module and the HTTP
+# stack are imported once a run has to talk to Stash (the drainer and the
+# tasks), so those runs start quickly.
 
 STASHDB_ENDPOINT = 'https://stashdb.org/graphql'
 
+# Profiling requested through STASH_PLUGIN_PROFILE covers the whole run; the
+# profile setting is only known once the configuration has been read
+profiling.start()
+
 json_input = json.loads(sys.stdin.read())
 args = json_input.get('args', {})
 name = args.get('name')
@@ -39,6 +39,9 @@ def get_stash_url():
 
 def stash_graphql(query, variables=None):
     """Make a GraphQL request to local Stash instance."""
+    import time
+    import urllib.request
+    import http_transport
     url = get_stash_url()
     
     headers = {
@@ -58,22 +61,44 @@ def stash_graphql(query, variables=None):
     
     req = urllib.request.Request(url, data=data, headers=headers, method="POST")
     
+    context = None
+    if url.startswith("https:"):
+        # Stash is usually served with a self-signed certificate
+        import ssl
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    
+    raw = None
+    start = time.monotonic()
     try:
-        with urllib.request.urlopen(req, timeout=30, context=SSL_CONTEXT) as response:
-            result = json.loads(response.read().decode("utf-8"))
-            if result.get("errors"):
-                log.warning(f"Stash GraphQL errors: {result['errors']}")
-            return result.get("data")
+        with http_transport.urlopen(req, timeout=30, context=context) as response:
+            raw = response.read()
+        result = json.loads(raw.decode("utf-8"))
+        if result.get("errors"):
+            log.warning(f"Stash GraphQL errors: {result['errors']}")
+        return result.get("data")
     except Exception as e:
         log.error(f"Stash request error: {e}")
         return None
+    finally:
+        http_metrics.record("stash", http_metrics.graphql_operation(query), time.monotonic() - start,
+                            len(data), len(raw or b""), error=raw is None)
+
+def get_configuration():
+    """Get the Stash configuration used by this plugin, cached across hook runs"""
+    def fetch():
+        result = stash_graphql("""query Configuration { configuration { general { configFilePath logLevel stashBoxes { endpoint api_key } } plugins } }""")
+        return (result or {}).get("configuration")
+    configuration = config_cache.get_configuration(server_connection, fetch)
+    # Drop messages Stash would not show before they are formatted
+    log.set_level((configuration or {}).get("general", {}).get("logLevel"))
+    log.debug(config_cache.summary())
+    return configuration or {}
 
 def get_stashboxes():
     """Get configured stashboxes from Stash"""
-    result = stash_graphql("""query Configuration { configuration { general { stashBoxes { endpoint api_key } } } }""")
-    if not result:
-        return []
-    return result.get("configuration", {}).get("general", {}).get("stashBoxes", [])
+    return get_configuration().get("general", {}).get("stashBoxes", [])
 
 
 def get_stashdb_credentials(endpoint, api_key):
@@ -97,119 +122,80 @@ def get_stashdb_credentials(endpoint, api_key):
     log.error(f"No stashdb.org endpoint configured in Stash. Please configure a stash-box with endpoint {STASHDB_ENDPOINT}")
     return None, None
 
-def get_performer(performer_id):
-    """Get performer details including stash_ids and favorite status"""
-    result = stash_graphql("""
-        query FindPerformer($id: ID!) {
-            findPerformer(id: $id) {
-                id
-                name
-                favorite
-                stash_ids {
-                    endpoint
-                    stash_id
-                }
-            }
-        }
-    """, {"id": performer_id})
-    if not result:
-        return None
-    return result.get("findPerformer")
-
-def get_studio(studio_id):
-    """Get studio details including stash_ids and favorite status"""
-    result = stash_graphql("""
-        query FindStudio($id: ID!) {
-            findStudio(id: $id) {
-                id
-                name
-                favorite
-                stash_ids {
-                    endpoint
-                    stash_id
-                }
-            }
-        }
-    """, {"id": studio_id})
-    if not result:
-        return None
-    return result.get("findStudio")
-
 def get_plugin_settings():
     """Get plugin settings from Stash configuration"""
-    result = stash_graphql("""query Configuration { configuration { plugins } }""")
-    if not result:
-        return {}
-    return result.get('configuration', {}).get('plugins', {}).get('setStashboxFavorites', {})
-
-plugin_settings = get_plugin_settings()
-tag_errors = plugin_settings.get('tagErrors', False)
-tag_name = plugin_settings.get('tagName')
-
-# Handle hook context (triggered by Performer.Update.Post or Studio.Update.Post)
-if hook_context:
-    hook_type = hook_context.get('type')
-    entity_id = hook_context.get('id')
+    return get_configuration().get('plugins', {}).get('setStashboxFavorites', {})
+
+def log_http_metrics(run, level):
+    """Log the HTTP requests made by this run, appending them to http_metrics.jsonl if enabled."""
+    http_metrics.log_summary(level)
+    if get_plugin_settings().get('writeMetrics'):
+        http_metrics.write(run)
+
+HOOK_ENTITY_TYPES = {
+    'Performer.Update.Post': 'performers',
+    'Studio.Update.Post': 'studios',
+}
+
+
+def apply_hook_queue(batch):
+    """Sync a batch of queued performer/studio updates to stashdb.org.
     
-    if hook_type == 'Studio.Update.Post' and entity_id:
-        log.debug(f"Hook triggered for studio ID: {entity_id}")
-        studio = get_studio(entity_id)
-        if studio and studio.get('stash_ids'):
-            stashboxes = get_stashboxes()
-            stashbox_map = {sb.get('endpoint'): sb.get('api_key') for sb in stashboxes if sb.get('endpoint') and sb.get('api_key')}
-            
-            for stash_id_entry in studio['stash_ids']:
-                endpoint = stash_id_entry.get('endpoint')
-                stash_id = stash_id_entry.get('stash_id')
-                
-                # Only sync with stashdb.org
-                if endpoint != STASHDB_ENDPOINT:
-                    continue
-                
-                api_key = stashbox_map.get(endpoint)
-                if not api_key:
-                    log.warning(f"No API key found for endpoint: {endpoint}")
-                    continue
-                
-                favorite = studio.get('favorite', False)
-                log.info(f"Syncing studio {studio.get('name')} (stash_id={stash_id}) favorite={favorite} to {endpoint}")
-                set_stashbox_favorite_studio(endpoint, api_key, stash_id, favorite)
-        else:
-            log.debug(f"Studio {entity_id} has no stash_ids, skipping")
-    elif hook_type == 'Performer.Update.Post' and entity_id:
-        log.debug(f"Hook triggered for performer ID: {entity_id}")
-        performer = get_performer(entity_id)
-        if performer and performer.get('stash_ids'):
-            stashboxes = get_stashboxes()
-            stashbox_map = {sb.get('endpoint'): sb.get('api_key') for sb in stashboxes if sb.get('endpoint') and sb.get('api_key')}
-            
-            for stash_id_entry in performer['stash_ids']:
-                endpoint = stash_id_entry.get('endpoint')
-                stash_id = stash_id_entry.get('stash_id')
-                
-                # Only sync with stashdb.org
-                if endpoint != STASHDB_ENDPOINT:
-                    continue
-                
-                api_key = stashbox_map.get(endpoint)
-                if not api_key:
-                    log.warning(f"No API key found for endpoint: {endpoint}")
-                    continue
-                
-                favorite = performer.get('favorite', False)
-                log.info(f"Syncing performer {performer.get('name')} (stash_id={stash_id}) favorite={favorite} to {endpoint}")
-                set_stashbox_favorite_performer(endpoint, api_key, stash_id, favorite)
+    Args:
+        batch: Dict of {entity type: set of local ids} from the hook queue
+    """
+    from favorite_performers_sync import set_stashbox_favorites_by_id, DEFAULT_BATCH_SIZE
+    plugin_settings = get_plugin_settings()
+    profiling.start(plugin_settings.get('profile'))
+    endpoint, api_key = get_stashdb_credentials(None, None)
+    if not (endpoint and api_key):
+        return
+    for entity_type in ('performers', 'studios'):
+        if batch.get(entity_type):
+            set_stashbox_favorites_by_id(
+                server_connection, entity_type, endpoint, api_key, batch[entity_type],
+                plugin_settings.get('concurrency') or 1, plugin_settings.get('batchSize') or DEFAULT_BATCH_SIZE
+            )
+
+# The profile is written even when the run fails
+try:
+    # Handle hook context (triggered by Performer.Update.Post or Studio.Update.Post)
+    if hook_context:
+        hook_type = hook_context.get('type')
+        entity_id = hook_context.get('id')
+        entity_type = HOOK_ENTITY_TYPES.get(hook_type)
+        
+        if entity_type and entity_id:
+            # Only queue the update; one drainer process syncs everything queued
+            # once updates stop arriving, so bulk edits become one batched sync
+            log.debug(f"Hook triggered for {entity_type[:-1]} ID: {entity_id}, queued")
+            hook_queue.enqueue(entity_type, entity_id)
+            if hook_queue.acquire_drainer():
+                hook_queue.drain(apply_hook_queue)
+                log_http_metrics(hook_type, 'debug')
         else:
-            log.debug(f"Performer {entity_id} has no stash_ids, skipping")
-    else:
-        log.debug(f"Unhandled hook type or no entity ID: type={hook_type}, id={entity_id}")
-
-# Handle task execution (triggered manually)
-elif name == 'favorite_performers_sync':
-    endpoint, api_key = get_stashdb_credentials(args.get('endpoint'), args.get('api_key'))
-    if endpoint and api_key:
-        set_stashbox_favorite_performers(server_connection, endpoint, api_key, tag_errors, tag_name)
-elif name == 'favorite_studios_sync':
-    endpoint, api_key = get_stashdb_credentials(args.get('endpoint'), args.get('api_key'))
-    if endpoint and api_key:
-        set_stashbox_favorite_studios(server_connection, endpoint, api_key, tag_errors, tag_name)
+            log.debug(f"Unhandled hook type or no entity ID: type={hook_type}, id={entity_id}")
+
+    # Handle task execution (triggered manually)
+    elif name in ('favorite_performers_sync', 'favorite_studios_sync'):
+        from favorite_performers_sync import (
+            set_stashbox_favorite_performers, set_stashbox_favorite_studios, DEFAULT_BATCH_SIZE
+        )
+        plugin_settings = get_plugin_settings()
+        profiling.start(plugin_settings.get('profile'))
+        tag_errors = plugin_settings.get('tagErrors', False)
+        tag_name = plugin_settings.get('tagName')
+        concurrency = plugin_settings.get('concurrency') or 1
+        batch_size = plugin_settings.get('batchSize') or DEFAULT_BATCH_SIZE
+        full_reconcile = bool(args.get('full_reconcile'))
+        dry_run = bool(args.get('dry_run'))
+        apply_plan = bool(args.get('apply_plan'))
+        endpoint, api_key = get_stashdb_credentials(args.get('endpoint'), args.get('api_key'))
+        if endpoint and api_key:
+            if name == 'favorite_performers_sync':
+                set_stashbox_favorite_performers(server_connection, endpoint, api_key, tag_errors, tag_name, concurrency, batch_size, full_reconcile, dry_run, apply_plan)
+            else:
+                set_stashbox_favorite_studios(server_connection, endpoint, api_key, tag_errors, tag_name, concurrency, batch_size, full_reconcile, dry_run, apply_plan)
+        log_http_metrics(name, 'info')
+finally:
+    profiling.stop(name or (hook_context or {}).get('type'))
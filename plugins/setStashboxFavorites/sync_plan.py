@@ -0,0 +1,58 @@
+import json
+import os
+import log
+
+# Plans written by the dry-run tasks, one file per entity type, kept next to
+# the plugin so a later run can apply exactly the planned changes without
+# fetching both sides again
+PLAN_DIR = os.path.dirname(os.path.abspath(__file__))
+PLAN_VERSION = 1
+
+
+def plan_file(entity_type):
+    """Path of the plan file for an entity type ("performers"/"studios")."""
+    return os.path.join(PLAN_DIR, f"favorites_plan_{entity_type}.json")
+
+
+def save(entity_type, plan):
+    """Atomically write a plan.
+
+    Returns:
+        Path of the plan file, or None if it could not be written
+    """
+    path = plan_file(entity_type)
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(dict(plan, version=PLAN_VERSION, entity_type=entity_type), f, indent=1)
+        os.replace(tmp, path)
+    except OSError as e:
+        log.error(f"Could not save sync plan {path}: {e}")
+        return None
+    return path
+
+
+def load(entity_type):
+    """Load the plan for an entity type, or None if there is no usable plan."""
+    path = plan_file(entity_type)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            plan = json.load(f)
+    except FileNotFoundError:
+        log.error(f"No sync plan found at {path}, run the plan task first")
+        return None
+    except (OSError, ValueError) as e:
+        log.error(f"Could not read sync plan {path}: {e}")
+        return None
+    if plan.get("version") != PLAN_VERSION or plan.get("entity_type") != entity_type:
+        log.error(f"Sync plan {path} is from another plugin version, run the plan task again")
+        return None
+    return plan
+
+
+def remove(entity_type):
+    """Delete the plan for an entity type once it has been applied."""
+    try:
+        os.remove(plan_file(entity_type))
+    except OSError:
+        pass
@@ -0,0 +1,74 @@
+import json
+import os
+from datetime import datetime, timedelta
+import log
+
+# Snapshot of the last synced favorites, kept next to the plugin so the bulk
+# sync tasks can only look at what changed since their previous run
+STATE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "favorites_state.json")
+STATE_VERSION = 1
+
+# Entities updated shortly before a run started are looked at again on the
+# next run, in case their update had not been committed when it was read
+UPDATED_SINCE_OVERLAP = timedelta(minutes=5)
+
+
+def now():
+    """Current local time as an RFC 3339 timestamp."""
+    return datetime.now().astimezone().isoformat(timespec="seconds")
+
+
+def updated_since(synced_at):
+    """Timestamp to pass to Stash's updated_at filter for a snapshot taken at `synced_at`."""
+    return (datetime.fromisoformat(synced_at) - UPDATED_SINCE_OVERLAP).isoformat(timespec="seconds")
+
+
+def load():
+    """Load the state file, returning an empty state if it is missing or unreadable."""
+    try:
+        with open(STATE_FILE, "r", encoding="utf-8") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return {"version": STATE_VERSION}
+    except (OSError, ValueError) as e:
+        log.warning(f"Ignoring unreadable sync state {STATE_FILE}: {e}")
+        return {"version": STATE_VERSION}
+    if state.get("version") != STATE_VERSION:
+        log.info("Sync state is from another plugin version, running a full sync")
+        return {"version": STATE_VERSION}
+    return state
+
+
+def save(state):
+    """Atomically write the state file."""
+    tmp = STATE_FILE + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f, separators=(",", ":"))
+        os.replace(tmp, STATE_FILE)
+    except OSError as e:
+        log.warning(f"Could not save sync state {STATE_FILE}: {e}")
+
+
+def get_snapshot(state, entity_type, endpoint):
+    """Get the snapshot for an entity type ("performers"/"studios") and endpoint.
+
+    Returns:
+        Dict with synced_at, favorites ({local id: [stash_ids]}) and pending
+        (stash_ids whose last change failed), or None
+    """
+    return (state.get(entity_type) or {}).get(endpoint)
+
+
+def set_snapshot(state, entity_type, endpoint, synced_at, favorites, pending):
+    """Record the favorites synced for an entity type and endpoint."""
+    state.setdefault(entity_type, {})[endpoint] = {
+        "synced_at": synced_at,
+        "favorites": favorites,
+        "pending": sorted(pending),
+    }
+
+
+def favorite_stash_ids(favorites):
+    """All stash_ids in a {local id: [stash_ids]} favorites map."""
+    return {stash_id for stash_ids in favorites.values() for stash_id in stash_ids}
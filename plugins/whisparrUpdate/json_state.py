@@ -0,0 +1,46 @@
+#
+# JSON state files in the plugin directory
+#
+# The movie index, scene fingerprints, add defaults, circuit breaker and
+# bulk push checkpoint are each kept in a small JSON file that several hook
+# processes read and write. Files are replaced atomically, so a reader never
+# sees a half-written file, and a missing or damaged file reads as empty.
+#
+
+import json
+import os
+import threading
+import log
+
+
+def load(path):
+    """Return the dict stored in a state file, or {} if it is missing or unreadable."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def save(path, data):
+    """Atomically replace a state file with a dict.
+
+    Returns:
+        True if the file was written
+    """
+    # Temporary file per process and thread, so concurrent writers don't mix
+    # their output
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp, path)
+        return True
+    except OSError as e:
+        log.debug(f"Could not write {path}: {e}")
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return False
@@ -0,0 +1,94 @@
+#
+# Persistent Whisparr foreignId -> movie id index
+#
+# Finding the movie of a StashDB id falls back to downloading every movie in
+# Whisparr when the stashId filter is not supported. The ids seen in add
+# responses, lookups and those full downloads are kept in the plugin
+# directory, so later lookups are answered without asking Whisparr.
+#
+
+import os
+import json_state
+
+INDEX_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "movie_index.json")
+
+# Indexes loaded in this process, by Whisparr URL
+_indexes = {}
+
+# Entries this process changed since its last save, by Whisparr URL; None
+# marks a removed entry. Only these are written over the file's current
+# contents, so hooks running at the same time don't drop each other's ids.
+_changes = {}
+
+# Whisparr URLs whose index this process rebuilt from a full movie listing,
+# which replaces the saved index instead of being merged into it
+_rebuilt = set()
+
+
+def _index(whisparr_url):
+    if whisparr_url not in _indexes:
+        movies = json_state.load(INDEX_FILE).get(whisparr_url)
+        _indexes[whisparr_url] = movies if isinstance(movies, dict) else {}
+    return _indexes[whisparr_url]
+
+
+def _save(whisparr_url):
+    data = json_state.load(INDEX_FILE)
+    movies = data.get(whisparr_url)
+    if whisparr_url in _rebuilt or not isinstance(movies, dict):
+        movies = dict(_indexes[whisparr_url])
+    else:
+        for foreign_id, movie_id in _changes.get(whisparr_url, {}).items():
+            if movie_id is None:
+                movies.pop(foreign_id, None)
+            else:
+                movies[foreign_id] = movie_id
+    data[whisparr_url] = movies
+    if not json_state.save(INDEX_FILE, data):
+        return
+    _changes.pop(whisparr_url, None)
+    _rebuilt.discard(whisparr_url)
+
+
+def get(whisparr_url, foreign_id):
+    """Return the indexed Whisparr movie id for a foreignId, or None."""
+    return _index(whisparr_url).get(foreign_id)
+
+
+def record_many(whisparr_url, movies):
+    """Remember {foreignId: movie id} pairs, saving once."""
+    index = _index(whisparr_url)
+    changes = _changes.setdefault(whisparr_url, {})
+    for foreign_id, movie_id in movies.items():
+        if foreign_id and movie_id and index.get(foreign_id) != movie_id:
+            index[foreign_id] = changes[foreign_id] = movie_id
+    if changes:
+        _save(whisparr_url)
+
+
+def record(whisparr_url, foreign_id, movie_id):
+    """Remember the movie id of a foreignId."""
+    record_many(whisparr_url, {foreign_id: movie_id})
+
+
+def forget(whisparr_url, foreign_id):
+    """Drop an entry that turned out to be stale."""
+    if _index(whisparr_url).pop(foreign_id, None) is not None:
+        _changes.setdefault(whisparr_url, {})[foreign_id] = None
+        _save(whisparr_url)
+
+
+def rebuild(whisparr_url, movies):
+    """Replace the index with a full /api/v3/movie listing.
+
+    The returned dict must not be changed; use record_many().
+    """
+    _indexes[whisparr_url] = {
+        movie["foreignId"]: movie["id"]
+        for movie in movies
+        if isinstance(movie, dict) and movie.get("foreignId") and movie.get("id")
+    }
+    _changes.pop(whisparr_url, None)
+    _rebuilt.add(whisparr_url)
+    _save(whisparr_url)
+    return _indexes[whisparr_url]
@@ -0,0 +1,112 @@
+# Opt-in CPU and memory profiling of plugin runs
+#
+# Shared by the Python plugins. Each plugin directory is packaged on its own,
+# so this file is copied into every plugin that uses it. Keep the copies
+# identical.
+#
+# Stash starts the plugin scripts itself, so a slow run can't simply be
+# started again under a profiler. Instead the plugins call start() with the
+# modes named in their profile setting, or in the STASH_PLUGIN_PROFILE
+# environment variable, and stop() once the run is done:
+#   cpu     cProfile of the main thread, saved as a .prof file (open it with
+#           pstats, snakeviz, ...). Worker threads are not profiled.
+#   memory  tracemalloc, saved as a report of the lines that allocated the
+#           most memory still held at the end, plus the peak
+# Several modes are separated by commas. Files are written to the plugin
+# directory, named profile-<timestamp>-<task or hook>.prof and
+# memory-<timestamp>-<task or hook>.txt.
+#
+
+import os
+import re
+import time
+import log
+
+PROFILE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROFILE_ENV = "STASH_PLUGIN_PROFILE"
+
+# Allocation sites listed in the memory report
+TOP_ALLOCATIONS = 25
+
+_profiler = None
+_tracing = False
+_reported = set()
+
+
+def _modes(value):
+    return {mode.strip().lower() for mode in (value or "").split(",") if mode.strip()}
+
+
+def start(setting=None):
+    """Start the profilers named in a setting value and in STASH_PLUGIN_PROFILE.
+
+    Profilers already running are left alone, so this can be called at
+    startup and again once the plugin settings are known.
+    """
+    global _profiler, _tracing
+    modes = _modes(setting) | _modes(os.environ.get(PROFILE_ENV))
+    unknown = modes - {"cpu", "memory"} - _reported
+    if unknown:
+        _reported.update(unknown)
+        log.warning(f"Unknown profile mode {', '.join(sorted(unknown))}; use cpu and/or memory")
+    if "memory" in modes and not _tracing:
+        import tracemalloc
+        tracemalloc.start()
+        _tracing = True
+    if "cpu" in modes and _profiler is None:
+        import cProfile
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+
+def _path(kind, run, extension):
+    name = re.sub(r"[^\w.-]+", "_", run or "run")
+    return os.path.join(PROFILE_DIR, f"{kind}-{time.strftime('%Y%m%d-%H%M%S')}-{name}.{extension}")
+
+
+def _write_memory_report(path):
+    import tracemalloc
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    ))
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = snapshot.statistics("lineno")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"Traced memory: {current / 1024:.1f} KB at the end, {peak / 1024:.1f} KB peak\n")
+        f.write(f"Top {TOP_ALLOCATIONS} allocation sites still held at the end:\n")
+        for stat in stats[:TOP_ALLOCATIONS]:
+            frame = stat.traceback[0]
+            f.write(f"{stat.size / 1024:10.1f} KB {stat.count:8d} blocks  {frame.filename}:{frame.lineno}\n")
+    return peak
+
+
+def stop(run):
+    """Stop the running profilers and write their output files.
+
+    Args:
+        run: Task or hook name, used in the file names
+    """
+    global _profiler, _tracing
+    if _profiler is not None:
+        _profiler.disable()
+    # The memory snapshot is taken before the CPU profile is turned into
+    # stats, so the report doesn't list the profiler's own allocations
+    if _tracing:
+        _tracing = False
+        path = _path("memory", run, "txt")
+        try:
+            peak = _write_memory_report(path)
+            log.info(f"Memory report written to {path} (peak {peak / 1024:.1f} KB)")
+        except OSError as e:
+            log.warning(f"Could not write memory report {path}: {e}")
+    if _profiler is not None:
+        profiler, _profiler = _profiler, None
+        path = _path("profile", run, "prof")
+        try:
+            profiler.dump_stats(path)
+            log.info(f"CPU profile written to {path}")
+        except OSError as e:
+            log.warning(f"Could not write CPU profile {path}: {e}")
@@ -0,0 +1,55 @@
+#
+# Queue of RefreshMovie targets shared by scene hook processes
+#
+# A scrape job that updates hundreds of scenes used to queue one
+# RefreshMovie command per scene in Whisparr. Hooks now append the movie to
+# this queue instead. The first hook that finds nobody draining it waits
+# until the updates stop arriving, then sends every queued movie in
+# RefreshMovie commands of up to REFRESH_BATCH_SIZE ids (see file_queue).
+#
+
+import os
+import file_queue
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+QUEUE_FILE = os.path.join(PLUGIN_DIR, "refresh_queue.jsonl")
+LOCK_FILE = os.path.join(PLUGIN_DIR, "refresh_queue.lock")
+
+# Movie ids sent per RefreshMovie command
+REFRESH_BATCH_SIZE = 100
+
+# Seconds without new entries before the drainer sends the refreshes
+DEBOUNCE_SECONDS = 3.0
+
+# Longest a drainer waits for the queue to go quiet during a long scrape
+MAX_DEBOUNCE_SECONDS = 30.0
+
+_queue = file_queue.FileQueue(QUEUE_FILE, LOCK_FILE, "refresh queue", DEBOUNCE_SECONDS, MAX_DEBOUNCE_SECONDS)
+
+
+def enqueue(entry):
+    """Append a refresh target (a JSON-serialisable dict) to the queue."""
+    _queue.enqueue(entry)
+
+
+def pending():
+    """Return True if refreshes are queued, or left behind by a drainer that failed to send them."""
+    return _queue.pending()
+
+
+def acquire_drainer():
+    """Try to become the drainer. Returns True if this process holds the lock."""
+    return _queue.acquire_drainer()
+
+
+def drain(apply, retry_on=()):
+    """Send queued refreshes until the queue stays empty.
+
+    Must be called with the drainer lock held; releases it on return.
+
+    Args:
+        apply: Callable taking the list of queued entries
+        retry_on: Exception types that leave the batch queued for the next
+            drainer without counting it as failed; they are re-raised
+    """
+    _queue.drain(apply, retry_on)
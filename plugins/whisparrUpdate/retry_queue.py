@@ -0,0 +1,68 @@
+#
+# Scenes whose sync failed because Whisparr was unavailable
+#
+# A hook that finds the circuit breaker open (see whisparr_circuit), or whose
+# requests to Whisparr keep failing, queues its scene here and exits. The
+# next run that reaches Whisparr syncs the queued scenes again.
+#
+
+import os
+import file_queue
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+QUEUE_FILE = os.path.join(PLUGIN_DIR, "retry_queue.txt")
+DRAINING_FILE = QUEUE_FILE + ".draining"
+LOCK_FILE = os.path.join(PLUGIN_DIR, "retry_queue.lock")
+
+
+def enqueue(scene_ids):
+    """Append scene ids to the queue."""
+    lines = "".join(f"{scene_id}\n" for scene_id in scene_ids)
+    if not lines:
+        return
+    fd = os.open(QUEUE_FILE, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, lines.encode("utf-8"))
+    finally:
+        os.close(fd)
+
+
+def take():
+    """Take the queued scene ids.
+
+    Scenes left behind by a process that crashed while retrying them are
+    taken before anything queued since.
+
+    Returns:
+        List of scene ids (possibly empty), or None if another process is
+        retrying them. Unless None is returned, finish() must be called.
+    """
+    if not os.path.exists(QUEUE_FILE) and not os.path.exists(DRAINING_FILE):
+        return []
+    if not file_queue.acquire_lock(LOCK_FILE, "retry queue"):
+        return None
+    if not os.path.exists(DRAINING_FILE):
+        try:
+            os.replace(QUEUE_FILE, DRAINING_FILE)
+        except OSError:
+            return []
+    try:
+        with open(DRAINING_FILE, "r", encoding="utf-8") as f:
+            return list(dict.fromkeys(line.strip() for line in f if line.strip()))
+    except OSError:
+        return []
+
+
+def refresh():
+    """Keep the lock taken by take() fresh while the scenes are retried."""
+    file_queue.refresh_lock(LOCK_FILE)
+
+
+def finish(unsynced=()):
+    """Drop the scenes returned by take(), queueing the ones still unsynced again."""
+    enqueue(unsynced)
+    try:
+        os.remove(DRAINING_FILE)
+    except OSError:
+        pass
+    file_queue.release_lock(LOCK_FILE)
@@ -0,0 +1,70 @@
+#
+# Fingerprints of the scene fields Whisparr uses, per synced scene
+#
+# Most scene updates (ratings, o-counter, play counts) change nothing that
+# is sent to Whisparr. The fingerprint of what was last added or refreshed
+# is kept in the plugin directory, so those updates can be skipped instead
+# of re-adding the scene and making Whisparr refresh its metadata.
+#
+
+import hashlib
+import json
+import os
+import json_state
+
+FINGERPRINT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scene_fingerprints.json")
+
+# Hook input fields that can change the fingerprint
+RELEVANT_SCENE_FIELDS = {"title", "stash_ids"}
+
+# Fingerprints loaded in this process, by Whisparr URL
+_fingerprints = {}
+
+# Fingerprints this process recorded since its last save, by Whisparr URL.
+# Only these are written over the file's current contents, so hooks running
+# at the same time don't drop each other's scenes.
+_changes = {}
+
+
+def fingerprint(title, stashdb_id):
+    """Fingerprint of the scene fields sent to Whisparr."""
+    return hashlib.sha1(json.dumps([title, stashdb_id]).encode("utf-8")).hexdigest()[:16]
+
+
+def _scenes(whisparr_url):
+    if whisparr_url not in _fingerprints:
+        scenes = json_state.load(FINGERPRINT_FILE).get(whisparr_url)
+        _fingerprints[whisparr_url] = scenes if isinstance(scenes, dict) else {}
+    return _fingerprints[whisparr_url]
+
+
+def _save(whisparr_url):
+    data = json_state.load(FINGERPRINT_FILE)
+    scenes = data.get(whisparr_url)
+    if not isinstance(scenes, dict):
+        scenes = data[whisparr_url] = {}
+    scenes.update(_changes.get(whisparr_url, {}))
+    if not json_state.save(FINGERPRINT_FILE, data):
+        return
+    _changes.pop(whisparr_url, None)
+
+
+def get(whisparr_url, scene_id):
+    """Return the fingerprint recorded when the scene was last synced, or None."""
+    return _scenes(whisparr_url).get(str(scene_id))
+
+
+def record_many(whisparr_url, fingerprints):
+    """Record {scene id: fingerprint} for synced scenes, saving once."""
+    scenes = _scenes(whisparr_url)
+    changes = _changes.setdefault(whisparr_url, {})
+    for scene_id, value in fingerprints.items():
+        if scenes.get(str(scene_id)) != value:
+            scenes[str(scene_id)] = changes[str(scene_id)] = value
+    if changes:
+        _save(whisparr_url)
+
+
+def record(whisparr_url, scene_id, value):
+    """Record the fingerprint of a synced scene."""
+    record_many(whisparr_url, {scene_id: value})
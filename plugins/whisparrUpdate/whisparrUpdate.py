@@ -6,9 +6,23 @@
 # Original: https://github.com/lowgrade12/hotornottest/tree/main/plugins/whisparr-bridge
 #
 
-import json, sys, urllib.request, urllib.error
-from stashapi.stashapp import StashInterface
-from stashapi import log
+import json, os, sys
+import config_cache
+import http_metrics
+import json_state
+import log
+import movie_index
+import profiling
+import refresh_queue
+import retry_queue
+import scene_fingerprints
+import whisparr_circuit
+import whisparr_defaults
+
+# Most hook runs end before any request is made (no scene id, or an update
+# that changed nothing sent to Whisparr). The HTTP stack, the thread pool and
+# stashapi (only needed by the bulk push task) are therefore imported where
+# they are used, not here, to keep hook startup short.
 
 SCENE_FRAGMENT = """
 id
@@ -17,20 +31,89 @@ stash_ids { endpoint stash_id }
 """
 
 # ---------- HTTP helpers ----------
+DEFAULT_REQUEST_TIMEOUT = 30
+
+# Retries after the first attempt, for 5xx responses and connection errors
+MAX_RETRIES = 3
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 15.0
+RETRYABLE_STATUSES = {500, 502, 503, 504}
+
+# Seconds to wait for Whisparr to answer a request (REQUEST_TIMEOUT setting)
+request_timeout = DEFAULT_REQUEST_TIMEOUT
+
+# Append each run's HTTP metrics to http_metrics.jsonl (WRITE_METRICS setting),
+# recorded under the task mode or the hook name
+write_metrics = False
+run_name = "Scene.Update.Post"
+
+class WhisparrUnavailable(Exception):
+    """Whisparr could not be reached, or is known to be down (see whisparr_circuit)."""
+
+def parse_json_body(raw):
+    text = raw.decode("utf-8", "ignore")
+    try:
+        return json.loads(text)
+    except Exception:
+        return text
+
+def whisparr_request(req):
+    """Send a request to Whisparr, retrying 5xx responses and connection errors.
+    
+    Retries wait a random time of up to RETRY_BASE_DELAY * 2^attempt seconds
+    (at most RETRY_MAX_DELAY). When every attempt fails the circuit breaker
+    is opened, and requests made while it is open fail without being sent.
+    
+    Returns tuple: (status, parsed JSON body or text)
+    Raises WhisparrUnavailable if no answer was received.
+    """
+    import random
+    import time
+    import urllib.error
+    import http_transport
+    url = req.full_url
+    wait = whisparr_circuit.open_for(url)
+    if wait:
+        raise WhisparrUnavailable(f"Whisparr marked unavailable, not retrying for another {wait:.0f}s")
+    operation = http_metrics.rest_operation(req.get_method(), url)
+
+    for attempt in range(MAX_RETRIES + 1):
+        if attempt:
+            delay = random.uniform(0, min(RETRY_BASE_DELAY * 2 ** attempt, RETRY_MAX_DELAY))
+            log.debug(f"Whisparr {problem}; retry {attempt}/{MAX_RETRIES} in {delay:.1f}s")
+            time.sleep(delay)
+        start = time.monotonic()
+        try:
+            with http_transport.urlopen(req, timeout=request_timeout) as r:
+                status, raw = r.status, r.read()
+        except urllib.error.HTTPError as e:
+            status, raw = e.code, e.read() or b""
+        except (urllib.error.URLError, OSError) as e:
+            problem = f"request failed: {getattr(e, 'reason', e)}"
+            http_metrics.record("whisparr", operation, time.monotonic() - start, len(req.data or b""), error=True, retry=attempt > 0)
+            continue
+        http_metrics.record("whisparr", operation, time.monotonic() - start, len(req.data or b""), len(raw),
+                            error=status >= 400, retry=attempt > 0)
+        if status in RETRYABLE_STATUSES:
+            problem = f"returned {status}"
+            continue
+        whisparr_circuit.record_success(url)
+        return status, parse_json_body(raw)
+
+    seconds = whisparr_circuit.record_failure(url)
+    raise WhisparrUnavailable(f"Whisparr {problem} ({MAX_RETRIES + 1} attempts); pausing requests for {seconds:.0f}s")
+
 def http_get_json(url, api_key):
+    import urllib.request
     req = urllib.request.Request(
         url,
         headers={"Accept": "application/json", "X-Api-Key": api_key},
         method="GET",
     )
-    with urllib.request.urlopen(req) as r:
-        raw = r.read().decode("utf-8", "ignore")
-        try:
-            return r.status, json.loads(raw)
-        except Exception:
-            return r.status, raw
+    return whisparr_request(req)
 
 def http_post_json(url, body, api_key):
+    import urllib.request
     data = json.dumps(body).encode("utf-8")
     req = urllib.request.Request(
         url,
@@ -38,19 +121,51 @@ def http_post_json(url, body, api_key):
         headers={"Content-Type": "application/json", "X-Api-Key": api_key},
         method="POST",
     )
+    return whisparr_request(req)
+
+def stash_graphql(server_connection, query, variables=None):
+    """Make a GraphQL request to local Stash and return its data.
+    
+    Raises an exception if the request fails or Stash reports errors.
+    """
+    import time
+    import urllib.request
+    import http_transport
+    host = server_connection.get("Host", "localhost")
+    if host == "0.0.0.0":
+        host = "localhost"
+    scheme = server_connection.get("Scheme", "http")
+    url = f"{scheme}://{host}:{server_connection.get('Port', 9999)}/graphql"
+    headers = {"Content-Type": "application/json", "Accept": "application/json"}
+    session_cookie = (server_connection.get("SessionCookie") or {}).get("Value")
+    if session_cookie:
+        headers["Cookie"] = f"session={session_cookie}"
+    data = json.dumps({"query": query, "variables": variables or {}}).encode("utf-8")
+    req = urllib.request.Request(url, data=data, headers=headers, method="POST")
+    context = None
+    if scheme == "https":
+        # Stash is usually served with a self-signed certificate
+        import ssl
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    raw = None
+    start = time.monotonic()
     try:
-        with urllib.request.urlopen(req) as r:
-            raw = r.read().decode("utf-8", "ignore")
-            try:
-                return r.status, json.loads(raw)
-            except Exception:
-                return r.status, raw
-    except urllib.error.HTTPError as e:
-        raw = (e.read() or b"").decode("utf-8", "ignore")
-        try:
-            return e.code, json.loads(raw)
-        except Exception:
-            return e.code, raw
+        with http_transport.urlopen(req, timeout=30, context=context) as r:
+            raw = r.read()
+    finally:
+        http_metrics.record("stash", http_metrics.graphql_operation(query), time.monotonic() - start,
+                            len(data), len(raw or b""), error=raw is None)
+    result = json.loads(raw.decode("utf-8"))
+    if result.get("errors"):
+        raise RuntimeError(f"Stash GraphQL errors: {result['errors']}")
+    return result.get("data") or {}
+
+def find_scene(server_connection, scene_id):
+    """Fetch a scene's id, title and stash_ids from Stash, or None if it doesn't exist."""
+    query = f"query FindScene($id: ID!) {{ findScene(id: $id) {{ {SCENE_FRAGMENT} }} }}"
+    return stash_graphql(server_connection, query, {"id": scene_id}).get("findScene")
 
 def is_already_exists_error(status, resp):
     """Check if the response indicates the item already exists.
@@ -77,15 +192,75 @@ def is_already_exists_error(status, resp):
     
     return False, None
 
+# Validation errors meaning the quality profile or root folder sent with an
+# add no longer exists in Whisparr
+STALE_DEFAULTS_ERROR_CODES = {
+    "QualityProfileExistsValidator",
+    "RootFolderValidator",
+    "RootFolderExistsValidator",
+    "PathExistsValidator",
+    "FolderWritableValidator",
+}
+STALE_DEFAULTS_PROPERTIES = {"QualityProfileId", "RootFolderPath"}
+
+def is_stale_defaults_error(status, resp):
+    """Check if Whisparr rejected an add because of its quality profile or root folder."""
+    if status != 400:
+        return False
+    errors = resp if isinstance(resp, list) else [resp] if isinstance(resp, dict) else []
+    for error in errors:
+        if isinstance(error, dict) and (
+            error.get("errorCode") in STALE_DEFAULTS_ERROR_CODES
+            or error.get("propertyName") in STALE_DEFAULTS_PROPERTIES
+        ):
+            return True
+    return False
+
+def get_add_defaults(whisparr_url, api_key):
+    """Return the quality profile id and root folder path to add movies with.
+    
+    Uses Whisparr's first quality profile and root folder, cached on disk
+    (see whisparr_defaults) so most hooks don't have to ask Whisparr.
+    
+    Returns tuple: (quality_profile_id, root_folder_path, from_cache), or
+    None if Whisparr could not be queried.
+    """
+    cached = whisparr_defaults.load(whisparr_url)
+    if cached:
+        log.debug(f"Whisparr defaults from cache: qualityProfileId={cached[0]} rootFolderPath={cached[1]}")
+        return cached[0], cached[1], True
+
+    s_qp, qps = http_get_json(f"{whisparr_url}/api/v3/qualityprofile", api_key)
+    if s_qp != 200 or not isinstance(qps, list) or not qps:
+        log.error(f"Whisparr: cannot load quality profiles: {s_qp} {qps}")
+        return None
+    quality_profile_id = int(qps[0]["id"])
+
+    s_rf, rfs = http_get_json(f"{whisparr_url}/api/v3/rootfolder", api_key)
+    if s_rf != 200 or not isinstance(rfs, list) or not rfs:
+        log.error(f"Whisparr: cannot load root folders: {s_rf} {rfs}")
+        return None
+    root_folder_path = rfs[0]["path"]
+
+    whisparr_defaults.save(whisparr_url, quality_profile_id, root_folder_path)
+    return quality_profile_id, root_folder_path, False
+
 def lookup_movie_by_stashid(whisparr_url, api_key, stashdb_id):
     """Lookup a movie in Whisparr by its StashDB ID.
     
-    First tries using the stashId query parameter. If that returns multiple
-    movies (indicating the API doesn't support filtering), falls back to
-    fetching all movies and filtering by foreignId.
+    Answers from the local movie index (see movie_index) when it knows the
+    StashDB ID. Otherwise tries the stashId query parameter. If that returns
+    multiple movies (indicating the API doesn't support filtering), the
+    full list is used to rebuild the index before filtering by foreignId.
     
-    Returns the movie dict if found, None otherwise.
+    Returns the movie dict if found (only id and foreignId for index hits),
+    None otherwise.
     """
+    movie_id = movie_index.get(whisparr_url, stashdb_id)
+    if movie_id:
+        log.debug(f"Whisparr movie index hit: id={movie_id}")
+        return {"id": movie_id, "foreignId": stashdb_id}
+
     # First, try the stashId query parameter
     url = f"{whisparr_url}/api/v3/movie?stashId={stashdb_id}"
     status, resp = http_get_json(url, api_key)
@@ -95,14 +270,15 @@ def lookup_movie_by_stashid(whisparr_url, api_key, stashdb_id):
             if len(resp) == 1:
                 # Perfect - API returned exactly one movie
                 log.debug(f"Whisparr lookup by stashId returned 1 movie: id={resp[0].get('id')}")
+                movie_index.record(whisparr_url, resp[0].get("foreignId"), resp[0].get("id"))
                 return resp[0]
             elif len(resp) > 1:
-                # When stashId parameter is unsupported, API returns all movies - filter by foreignId
-                log.debug(f"Whisparr lookup returned {len(resp)} movies, filtering by foreignId")
-                for movie in resp:
-                    if movie.get("foreignId") == stashdb_id:
-                        log.debug(f"Found matching movie by foreignId: id={movie.get('id')}")
-                        return movie
+                # When stashId parameter is unsupported, API returns all movies - index them all
+                log.debug(f"Whisparr lookup returned {len(resp)} movies, rebuilding movie index")
+                movie_id = movie_index.rebuild(whisparr_url, resp).get(stashdb_id)
+                if movie_id:
+                    log.debug(f"Found matching movie by foreignId: id={movie_id}")
+                    return next(movie for movie in resp if movie.get("id") == movie_id)
                 log.debug(f"No movie found with foreignId={stashdb_id}")
                 return None
             else:
@@ -110,29 +286,89 @@ def lookup_movie_by_stashid(whisparr_url, api_key, stashdb_id):
                 return None
         elif isinstance(resp, dict) and resp.get("id"):
             # Single movie dict response
+            movie_index.record(whisparr_url, resp.get("foreignId"), resp.get("id"))
             return resp
     
     return None
 
-def refresh_movie(whisparr_url, api_key, movie_id):
-    """Trigger a metadata refresh for a movie in Whisparr.
+def refresh_movies(whisparr_url, api_key, movie_ids):
+    """Trigger a metadata refresh for movies in Whisparr.
     
-    Uses the /api/v3/command endpoint with RefreshMovie command.
-    Returns True if successful, False otherwise.
+    Uses the /api/v3/command endpoint with one RefreshMovie command per
+    refresh_queue.REFRESH_BATCH_SIZE movie ids.
+    Returns the set of movie ids whose command failed.
+    Raises WhisparrUnavailable if Whisparr could not be reached.
     """
     url = f"{whisparr_url}/api/v3/command"
-    body = {
-        "name": "RefreshMovie",
-        "movieIds": [movie_id]
-    }
+    movie_ids = sorted(set(movie_ids))
+    failed = set()
+    for start in range(0, len(movie_ids), refresh_queue.REFRESH_BATCH_SIZE):
+        chunk = movie_ids[start:start + refresh_queue.REFRESH_BATCH_SIZE]
+        body = {
+            "name": "RefreshMovie",
+            "movieIds": chunk
+        }
+        status, resp = http_post_json(url, body, api_key)
+        if status in (200, 201):
+            log.info(f"Whisparr: refreshing {len(chunk)} movies")
+        else:
+            log.error(f"Whisparr: RefreshMovie for {len(chunk)} movies failed: {status} {resp}")
+            failed.update(chunk)
+    return failed
+
+def apply_refreshes(whisparr_url, api_key, entries):
+    """Send refresh targets and record the scenes whose refresh was accepted.
     
-    status, resp = http_post_json(url, body, api_key)
-    return status in (200, 201)
+    Args:
+        entries: Dicts with movie_id, scene_id, stashdb_id and fingerprint
+    """
+    failed = refresh_movies(whisparr_url, api_key, [entry["movie_id"] for entry in entries])
+    scene_fingerprints.record_many(whisparr_url, {
+        entry["scene_id"]: entry["fingerprint"] for entry in entries if entry["movie_id"] not in failed
+    })
+    for entry in entries:
+        if entry["movie_id"] in failed:
+            # The indexed id may belong to a movie deleted since
+            movie_index.forget(whisparr_url, entry["stashdb_id"])
 
-def load_plugin_settings(stash: StashInterface) -> dict:
-    """Return this plugin's settings using the manifest name."""
+def build_add_body(title, stashdb_id, quality_profile_id, root_folder_path, monitored):
+    """Build the /api/v3/movie add payload for a scene."""
+    return {
+        "title": title,
+        "qualityProfileId": quality_profile_id,
+        "rootFolderPath": root_folder_path,
+        "monitored": monitored,
+        "addOptions": {
+            "monitor": "movieOnly" if monitored else "none",
+            "searchForMovie": False
+        },
+        "foreignId": stashdb_id,
+        "stashId": stashdb_id
+    }
+
+def scene_stashdb_id(scene, match_substr):
+    """Return the scene's stash_id from the first endpoint matching match_substr, or None."""
+    for sid in scene.get("stash_ids") or []:
+        if match_substr in (sid.get("endpoint") or ""):
+            return sid.get("stash_id")
+    return None
+
+def load_plugin_settings(server_connection: dict) -> dict:
+    """Return this plugin's settings using the manifest name.
+
+    The configuration is cached across hook runs (see config_cache).
+    """
     try:
-        stash_config = stash.get_configuration()
+        stash_config = config_cache.get_configuration(
+            server_connection,
+            lambda: stash_graphql(
+                server_connection,
+                "query Configuration { configuration { general { configFilePath logLevel } plugins } }",
+            ).get("configuration"),
+        )
+        # Drop messages Stash would not show before they are formatted
+        log.set_level((stash_config or {}).get("general", {}).get("logLevel"))
+        log.debug(config_cache.summary())
     except Exception as e:
         log.error(f"get_configuration failed: {e}")
         return {}
@@ -146,35 +382,190 @@ def load_plugin_settings(stash: StashInterface) -> dict:
 
     return cfg
 
-# ---------- main ----------
-def main():
-    STASH_DATA = json.loads(sys.stdin.read())
-    ARGS = STASH_DATA.get("args") or {}
-    hook = ARGS.get("hookContext") or {}
-    scene_id = hook.get("id")
-    if not scene_id:
-        log.info("No scene id in hook; exit.")
-        return
+# ---------- bulk push ----------
+# Scenes requested from Stash per page during the bulk push task
+PUSH_PAGE_SIZE = 500
+DEFAULT_PUSH_CONCURRENCY = 4
+MAX_PUSH_CONCURRENCY = 16
 
-    # Stash API client
-    stash = StashInterface(STASH_DATA["server_connection"])
+# Progress of an interrupted bulk push, so the next run resumes after the
+# last fully processed page
+CHECKPOINT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "push_checkpoint.json")
 
-    plugin_cfg = load_plugin_settings(stash)
-    if not plugin_cfg:
-        return
+def load_checkpoint(whisparr_url):
+    """Return the saved bulk push progress for this Whisparr, or None."""
+    checkpoint = json_state.load(CHECKPOINT_FILE)
+    if checkpoint.get("whisparr_url") != whisparr_url:
+        return None
+    return checkpoint
 
-    whisparr_url = (plugin_cfg.get("WHISPARR_URL") or "").rstrip("/")
-    whisparr_key = plugin_cfg.get("WHISPARR_API_KEY") or ""
-    match_substr = plugin_cfg.get("STASHDB_ENDPOINT_SUBSTR") or "stashdb.org"
-    monitored = plugin_cfg.get("MONITORED", True)
+def save_checkpoint(checkpoint):
+    if not json_state.save(CHECKPOINT_FILE, checkpoint):
+        log.warning("Could not save bulk push checkpoint")
 
-    if not whisparr_url or not whisparr_key:
-        log.error("Missing Whisparr settings (URL/API key).")
+def clear_checkpoint():
+    try:
+        os.remove(CHECKPOINT_FILE)
+    except OSError:
+        pass
+
+def get_matched_scenes_page(stash, after_id):
+    """Fetch the next page of scenes that have a stash_id, in id order.
+    
+    Paging by id rather than page number keeps pages stable while scenes
+    are added or removed, and lets a run resume after a scene id.
+    
+    Returns tuple: (number of matching scenes after after_id, scenes)
+    """
+    scene_filter = {"stash_id_endpoint": {"modifier": "NOT_NULL"}}
+    if after_id:
+        scene_filter["id"] = {"value": after_id, "modifier": "GREATER_THAN"}
+    return stash.find_scenes(
+        f=scene_filter,
+        filter={"page": 1, "per_page": PUSH_PAGE_SIZE, "sort": "id", "direction": "ASC"},
+        fragment=SCENE_FRAGMENT,
+        get_count=True,
+    )
+
+def add_movies(whisparr_url, api_key, bodies, executor):
+    """Send adds through the worker pool.
+    
+    Args:
+        bodies: Dict of {stashdb_id: add payload}
+    
+    Returns dict of {stashdb_id: (status, resp)}; status is None if the
+    request could not be sent.
+    Raises WhisparrUnavailable once every add was tried if Whisparr could
+    not be reached for some of them.
+    """
+    from concurrent.futures import as_completed
+    url = f"{whisparr_url}/api/v3/movie"
+    futures = {executor.submit(http_post_json, url, body, api_key): stashdb_id for stashdb_id, body in bodies.items()}
+    results = {}
+    unavailable = None
+    for future in as_completed(futures):
+        try:
+            results[futures[future]] = future.result()
+        except WhisparrUnavailable as e:
+            unavailable = e
+        except Exception as e:
+            results[futures[future]] = (None, str(e))
+    if unavailable:
+        raise unavailable
+    return results
+
+def push_all_scenes(stash, whisparr_url, whisparr_key, match_substr, monitored, concurrency):
+    """Add every scene with a matching StashDB id that Whisparr doesn't have yet.
+    
+    Whisparr's movie list is downloaded once to rebuild the movie index, and
+    only scenes missing from it are added, up to `concurrency` at a time.
+    Progress is checkpointed after each page of scenes, and an interrupted
+    run resumes from there.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    concurrency = max(1, min(int(concurrency or DEFAULT_PUSH_CONCURRENCY), MAX_PUSH_CONCURRENCY))
+    checkpoint = load_checkpoint(whisparr_url)
+    if checkpoint:
+        log.info(f"Resuming bulk push after scene id {checkpoint['last_scene_id']} ({checkpoint['done']} scenes already processed)")
+    else:
+        checkpoint = {"whisparr_url": whisparr_url, "last_scene_id": 0, "done": 0, "added": 0, "existing": 0, "failed": 0}
+
+    status, movies = http_get_json(f"{whisparr_url}/api/v3/movie", whisparr_key)
+    if status != 200 or not isinstance(movies, list):
+        log.error(f"Whisparr: cannot load movies: {status}")
         return
+    index = movie_index.rebuild(whisparr_url, movies)
+    del movies
+    log.info(f"Whisparr has {len(index)} movies")
+
+    defaults = get_add_defaults(whisparr_url, whisparr_key)
+    if not defaults:
+        return
+
+    total = None
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            try:
+                remaining, scenes = get_matched_scenes_page(stash, checkpoint["last_scene_id"])
+            except Exception as e:
+                log.error(f"find_scenes failed: {e}")
+                return
+            if total is None:
+                total = checkpoint["done"] + remaining
+                log.info(f"{remaining} scenes with stash_ids to check, adding up to {concurrency} at a time")
+            if not scenes:
+                break
+
+            titles = {}
+            scene_ids = {}
+            fingerprints = {}
+            for scene in scenes:
+                stashdb_id = scene_stashdb_id(scene, match_substr)
+                if not stashdb_id:
+                    continue
+                fingerprint = scene_fingerprints.fingerprint(scene.get("title") or "", stashdb_id)
+                if stashdb_id in index:
+                    fingerprints[scene["id"]] = fingerprint
+                else:
+                    titles[stashdb_id] = scene.get("title") or ""
+                    scene_ids[stashdb_id] = (scene["id"], fingerprint)
+
+            bodies = {stashdb_id: build_add_body(title, stashdb_id, defaults[0], defaults[1], monitored) for stashdb_id, title in titles.items()}
+            results = add_movies(whisparr_url, whisparr_key, bodies, executor)
+            stale = [stashdb_id for stashdb_id, (status, resp) in results.items() if is_stale_defaults_error(status, resp)]
+            if stale and defaults[2]:
+                log.info("Whisparr rejected the cached quality profile/root folder, reloading them")
+                whisparr_defaults.invalidate(whisparr_url)
+                defaults = get_add_defaults(whisparr_url, whisparr_key)
+                if not defaults:
+                    return
+                bodies = {stashdb_id: build_add_body(titles[stashdb_id], stashdb_id, defaults[0], defaults[1], monitored) for stashdb_id in stale}
+                results.update(add_movies(whisparr_url, whisparr_key, bodies, executor))
+
+            refreshes = []
+            movie_ids = {}
+            for stashdb_id, (status, resp) in results.items():
+                if status in (200, 201) and isinstance(resp, dict):
+                    checkpoint["added"] += 1
+                    movie_ids[stashdb_id] = resp.get("id")
+                    fingerprints.update([scene_ids[stashdb_id]])
+                    continue
+                is_exists, existing_id = is_already_exists_error(status, resp)
+                if is_exists:
+                    checkpoint["existing"] += 1
+                    if existing_id:
+                        movie_ids[stashdb_id] = existing_id
+                        scene_id, fingerprint = scene_ids[stashdb_id]
+                        refreshes.append({"movie_id": existing_id, "scene_id": scene_id, "stashdb_id": stashdb_id, "fingerprint": fingerprint})
+                    else:
+                        fingerprints.update([scene_ids[stashdb_id]])
+                else:
+                    checkpoint["failed"] += 1
+                    log.error(f"Whisparr error {status} adding stashId={stashdb_id}: {resp}")
+            movie_index.record_many(whisparr_url, movie_ids)
+            scene_fingerprints.record_many(whisparr_url, fingerprints)
+            if refreshes:
+                # Movies added since the index was built, refreshed in batched commands
+                apply_refreshes(whisparr_url, whisparr_key, refreshes)
+
+            checkpoint["last_scene_id"] = int(scenes[-1]["id"])
+            checkpoint["done"] += len(scenes)
+            save_checkpoint(checkpoint)
+            log.info(f"Processed {checkpoint['done']}/{total} scenes: {checkpoint['added']} added, {checkpoint['existing']} already in Whisparr, {checkpoint['failed']} failed")
+            log.progress(checkpoint["done"] / max(total, 1))
+
+    clear_checkpoint()
+    log.info(f"Bulk push done: {checkpoint['added']} added, {checkpoint['existing']} already in Whisparr, {checkpoint['failed']} failed")
+    log.progress(1)
 
+def sync_scene(server_connection, whisparr_url, whisparr_key, match_substr, monitored, scene_id):
+    """Add a scene to Whisparr, or queue a refresh of its movie if Whisparr already has it.
+    
+    Raises WhisparrUnavailable if Whisparr could not be reached.
+    """
     # Fetch scene
     try:
-        scene = stash.find_scene(scene_id, fragment=SCENE_FRAGMENT)
+        scene = find_scene(server_connection, scene_id)
     except Exception as e:
         log.error(f"find_scene failed: {e}")
         return
@@ -187,46 +578,41 @@ def main():
     log.info(f"scene '{title}', id={scene_id}")
 
     # Extract matching StashDB id
-    stashdb_id = None
-    for sid in scene.get("stash_ids") or []:
-        if match_substr in (sid.get("endpoint") or ""):
-            stashdb_id = sid.get("stash_id")
-            break
+    stashdb_id = scene_stashdb_id(scene, match_substr)
 
     if not stashdb_id:
         log.info("No matching StashDB id; skip.")
         return
 
-    # Query Whisparr for defaults it requires
-    s_qp, qps = http_get_json(f"{whisparr_url}/api/v3/qualityprofile", whisparr_key)
-    if s_qp != 200 or not isinstance(qps, list) or not qps:
-        log.error(f"Whisparr: cannot load quality profiles: {s_qp} {qps}")
+    fingerprint = scene_fingerprints.fingerprint(title, stashdb_id)
+    if scene_fingerprints.get(whisparr_url, scene_id) == fingerprint:
+        log.info("Title and StashDB id unchanged since last sync; skip.")
         return
-    quality_profile_id = int(qps[0]["id"])
 
-    s_rf, rfs = http_get_json(f"{whisparr_url}/api/v3/rootfolder", whisparr_key)
-    if s_rf != 200 or not isinstance(rfs, list) or not rfs:
-        log.error(f"Whisparr: cannot load root folders: {s_rf} {rfs}")
+    # Defaults Whisparr requires for an add
+    defaults = get_add_defaults(whisparr_url, whisparr_key)
+    if not defaults:
         return
-    root_folder_path = rfs[0]["path"]
+    quality_profile_id, root_folder_path, defaults_cached = defaults
 
     # Build add payload
-    body = {
-        "title": title,
-        "qualityProfileId": quality_profile_id,
-        "rootFolderPath": root_folder_path,
-        "monitored": monitored,
-        "addOptions": {
-            "monitor": "movieOnly" if monitored else "none",
-            "searchForMovie": False
-        },
-        "foreignId": stashdb_id,
-        "stashId": stashdb_id
-    }
+    body = build_add_body(title, stashdb_id, quality_profile_id, root_folder_path, monitored)
 
     status, resp = http_post_json(f"{whisparr_url}/api/v3/movie", body, whisparr_key)
+    if defaults_cached and is_stale_defaults_error(status, resp):
+        # The cached profile or folder was removed in Whisparr; reload and retry once
+        log.info("Whisparr rejected the cached quality profile/root folder, reloading them")
+        whisparr_defaults.invalidate(whisparr_url)
+        defaults = get_add_defaults(whisparr_url, whisparr_key)
+        if not defaults:
+            return
+        body["qualityProfileId"], body["rootFolderPath"], _ = defaults
+        status, resp = http_post_json(f"{whisparr_url}/api/v3/movie", body, whisparr_key)
     if status in (200, 201):
         log.info(f"Whisparr add OK ({status})")
+        if isinstance(resp, dict):
+            movie_index.record(whisparr_url, stashdb_id, resp.get("id"))
+        scene_fingerprints.record(whisparr_url, scene_id, fingerprint)
     else:
         is_exists, existing_id_from_error = is_already_exists_error(status, resp)
         if is_exists:
@@ -242,14 +628,123 @@ def main():
             
             if movie_id:
                 log.info(f"Whisparr: found existing movie id={movie_id} for stashId={stashdb_id}")
-                if refresh_movie(whisparr_url, whisparr_key, movie_id):
-                    log.info(f"Whisparr: refreshed movie id={movie_id}")
-                else:
-                    log.error(f"Whisparr: failed to refresh movie id={movie_id}")
+                movie_index.record(whisparr_url, stashdb_id, movie_id)
+                # Refreshes from hooks fired together are sent as one command
+                refresh_queue.enqueue({"movie_id": movie_id, "scene_id": str(scene_id), "stashdb_id": stashdb_id, "fingerprint": fingerprint})
+                log.info(f"Whisparr: queued refresh of movie id={movie_id}")
             else:
                 log.info("Whisparr: could not lookup existing movie for refresh")
         else:
             log.error(f"Whisparr error {status}: {resp}")
 
+def retry_unavailable_scenes(server_connection, whisparr_url, whisparr_key, match_substr, monitored):
+    """Sync the scenes queued while Whisparr was unavailable (see retry_queue)."""
+    scene_ids = retry_queue.take()
+    if not scene_ids:
+        if scene_ids is not None:
+            retry_queue.finish()
+        return
+    log.info(f"Retrying {len(scene_ids)} scenes queued while Whisparr was unavailable")
+    for i, queued_id in enumerate(scene_ids):
+        retry_queue.refresh()
+        try:
+            sync_scene(server_connection, whisparr_url, whisparr_key, match_substr, monitored, queued_id)
+        except WhisparrUnavailable as e:
+            log.warning(f"{e}; {len(scene_ids) - i} scenes stay queued")
+            retry_queue.finish(scene_ids[i:])
+            return
+        except Exception as e:
+            log.error(f"Retrying scene {queued_id} failed: {e}")
+    retry_queue.finish()
+
+# ---------- main ----------
+def log_http_metrics():
+    """Log the HTTP requests made by this run, appending them to http_metrics.jsonl if enabled."""
+    http_metrics.log_summary("info" if run_name == "push_all" else "debug")
+    if write_metrics:
+        http_metrics.write(run_name)
+
+def main():
+    STASH_DATA = json.loads(sys.stdin.read())
+    ARGS = STASH_DATA.get("args") or {}
+    mode = ARGS.get("mode")
+    hook = ARGS.get("hookContext") or {}
+    global run_name
+    run_name = mode or hook.get("type") or run_name
+    scene_id = hook.get("id")
+    if not scene_id and mode != "push_all":
+        log.info("No scene id in hook; exit.")
+        return
+
+    plugin_cfg = load_plugin_settings(STASH_DATA["server_connection"])
+    if not plugin_cfg:
+        return
+
+    whisparr_url = (plugin_cfg.get("WHISPARR_URL") or "").rstrip("/")
+    whisparr_key = plugin_cfg.get("WHISPARR_API_KEY") or ""
+    match_substr = plugin_cfg.get("STASHDB_ENDPOINT_SUBSTR") or "stashdb.org"
+    monitored = plugin_cfg.get("MONITORED", True)
+
+    if not whisparr_url or not whisparr_key:
+        log.error("Missing Whisparr settings (URL/API key).")
+        return
+
+    global request_timeout, write_metrics
+    request_timeout = float(plugin_cfg.get("REQUEST_TIMEOUT") or DEFAULT_REQUEST_TIMEOUT)
+    write_metrics = bool(plugin_cfg.get("WRITE_METRICS"))
+    profiling.start(plugin_cfg.get("PROFILE"))
+
+    if mode == "push_all":
+        from stashapi.stashapp import StashInterface
+        stash = StashInterface(STASH_DATA["server_connection"])
+        try:
+            push_all_scenes(stash, whisparr_url, whisparr_key, match_substr, monitored, plugin_cfg.get("PUSH_CONCURRENCY"))
+        except WhisparrUnavailable as e:
+            log.error(f"{e}; run the task again later to resume the push")
+        return
+
+    # A scene already synced whose update touched none of the fields sent to
+    # Whisparr (e.g. only its rating) needs no work
+    input_fields = hook.get("inputFields")
+    if (
+        input_fields is not None
+        and scene_fingerprints.get(whisparr_url, scene_id)
+        and not scene_fingerprints.RELEVANT_SCENE_FIELDS.intersection(input_fields)
+    ):
+        log.debug(f"Scene {scene_id} update changed no Whisparr fields ({', '.join(input_fields)}); skip.")
+        return
+
+    # While Whisparr is down, queue the scene instead of waiting on requests
+    # that are going to fail. The probe is only claimed by the first request
+    # actually sent, as this run may not need Whisparr at all.
+    wait = whisparr_circuit.open_for(whisparr_url, claim_probe=False)
+    if wait:
+        retry_queue.enqueue([scene_id])
+        log.warning(f"Whisparr marked unavailable for another {wait:.0f}s; scene {scene_id} queued for retry")
+        return
+
+    try:
+        sync_scene(STASH_DATA["server_connection"], whisparr_url, whisparr_key, match_substr, monitored, scene_id)
+    except WhisparrUnavailable as e:
+        retry_queue.enqueue([scene_id])
+        log.warning(f"{e}; scene {scene_id} queued for retry")
+        return
+
+    retry_unavailable_scenes(STASH_DATA["server_connection"], whisparr_url, whisparr_key, match_substr, monitored)
+    if refresh_queue.pending() and refresh_queue.acquire_drainer():
+        try:
+            refresh_queue.drain(lambda entries: apply_refreshes(whisparr_url, whisparr_key, entries),
+                                retry_on=(WhisparrUnavailable,))
+        except WhisparrUnavailable as e:
+            # The batch stays in the queue and is sent by the next drainer
+            log.warning(f"{e}; queued refreshes will be sent later")
+
 if __name__ == "__main__":
-    main()
+    # Profiling requested through STASH_PLUGIN_PROFILE covers the whole run;
+    # the PROFILE setting is only known once the settings have been read
+    profiling.start()
+    try:
+        main()
+    finally:
+        log_http_metrics()
+        profiling.stop(run_name)
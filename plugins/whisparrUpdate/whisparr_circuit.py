@@ -0,0 +1,100 @@
+#
+# Circuit breaker for Whisparr, shared by hook processes through a file
+#
+# While Whisparr is restarting or unreachable, every scene hook used to wait
+# for its requests to time out, and hook processes piled up inside Stash.
+# Once a request has failed all of its retries, the circuit opens: requests
+# to that Whisparr are refused without being sent until OPEN_SECONDS have
+# passed. The first process to ask after that claims the probe: the circuit
+# is held open for everyone else for up to PROBE_SECONDS while that process
+# sends its requests. A success closes the circuit, a failure opens it again
+# for twice as long (at most MAX_OPEN_SECONDS).
+#
+
+import os
+import threading
+import time
+import urllib.parse
+import json_state
+import log
+
+CIRCUIT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "whisparr_circuit.json")
+
+# How long the circuit stays open after the first failure
+OPEN_SECONDS = 60.0
+
+# Longest the circuit stays open after repeated failed probes
+MAX_OPEN_SECONDS = 900.0
+
+# How long other processes wait for the probe before claiming it themselves;
+# longer than a request with all its retries, so only a probe whose process
+# was killed runs out
+PROBE_SECONDS = 300.0
+
+# Bulk push threads update the circuit at the same time
+_lock = threading.Lock()
+
+
+def _key(url):
+    parts = urllib.parse.urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def open_for(url, claim_probe=True):
+    """Return the seconds left before requests to this Whisparr may be sent again, 0 if they may be sent now.
+
+    Once the circuit's open time has passed, only the process that claims the
+    probe gets 0 until the probe succeeds or fails.
+
+    Args:
+        url: Any URL of the Whisparr
+        claim_probe: Claim the probe if it is free. Pass False when no
+            request is about to be sent, so other processes aren't held up
+    """
+    with _lock:
+        data = json_state.load(CIRCUIT_FILE)
+        entry = data.get(_key(url))
+        if not isinstance(entry, dict):
+            return 0
+        if entry.get("probe_pid") == os.getpid():
+            return 0
+        wait = entry.get("open_until", 0) - time.time()
+        if wait > 0 or not claim_probe:
+            return max(0.0, wait)
+        entry["open_until"] = time.time() + PROBE_SECONDS
+        entry["probe_pid"] = os.getpid()
+        if not json_state.save(CIRCUIT_FILE, data):
+            return PROBE_SECONDS
+        # Another process may have claimed the probe at the same moment; the
+        # last write wins
+        entry = json_state.load(CIRCUIT_FILE).get(_key(url))
+        if not isinstance(entry, dict):
+            return 0
+        if entry.get("probe_pid") != os.getpid():
+            return max(0.0, entry.get("open_until", 0) - time.time())
+    log.info(f"Whisparr pause over, probing {_key(url)}")
+    return 0
+
+
+def record_success(url):
+    """Close the circuit after a request got an answer."""
+    with _lock:
+        data = json_state.load(CIRCUIT_FILE)
+        if data.pop(_key(url), None) is not None:
+            json_state.save(CIRCUIT_FILE, data)
+
+
+def record_failure(url):
+    """Open the circuit after a request failed all its retries.
+
+    Returns:
+        Seconds the circuit stays open
+    """
+    with _lock:
+        data = json_state.load(CIRCUIT_FILE)
+        entry = data.get(_key(url))
+        opens = entry.get("opens", 0) + 1 if isinstance(entry, dict) else 1
+        seconds = min(OPEN_SECONDS * 2 ** (opens - 1), MAX_OPEN_SECONDS)
+        data[_key(url)] = {"opens": opens, "open_until": time.time() + seconds}
+        json_state.save(CIRCUIT_FILE, data)
+    return seconds
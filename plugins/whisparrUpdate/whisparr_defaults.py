@@ -0,0 +1,39 @@
+#
+# Cached Whisparr add defaults (quality profile id and root folder path)
+#
+# Every scene hook used to fetch /api/v3/qualityprofile and
+# /api/v3/rootfolder before adding. Both rarely change, so the values picked
+# from them are kept in the plugin directory for DEFAULTS_TTL_SECONDS, and
+# dropped early when Whisparr rejects an add because of them.
+#
+
+import os
+import time
+import json_state
+
+DEFAULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "whisparr_defaults.json")
+DEFAULTS_TTL_SECONDS = 6 * 3600
+
+
+def load(whisparr_url, ttl=DEFAULTS_TTL_SECONDS):
+    """Return the cached (quality profile id, root folder path), or None if missing or expired."""
+    entry = json_state.load(DEFAULTS_FILE).get(whisparr_url)
+    if not isinstance(entry, dict) or not 0 <= time.time() - entry.get("stored_at", 0) < ttl:
+        return None
+    return entry["quality_profile_id"], entry["root_folder_path"]
+
+
+def save(whisparr_url, quality_profile_id, root_folder_path):
+    data = json_state.load(DEFAULTS_FILE)
+    data[whisparr_url] = {
+        "stored_at": time.time(),
+        "quality_profile_id": quality_profile_id,
+        "root_folder_path": root_folder_path,
+    }
+    json_state.save(DEFAULTS_FILE, data)
+
+
+def invalidate(whisparr_url):
+    data = json_state.load(DEFAULTS_FILE)
+    if data.pop(whisparr_url, None) is not None:
+        json_state.save(DEFAULTS_FILE, data)